@@ -34,8 +34,9 @@ import aiohttp
 import aiohttp_cors
 from aiortc import RTCPeerConnection, RTCSessionDescription,RTCIceServer,RTCConfiguration
 from aiortc.rtcrtpsender import RTCRtpSender
-from webrtc import HumanPlayer
+from webrtc import HumanPlayer, set_bitrate_limits, apply_encoder_settings
 from basereal import BaseReal
+import avatarpack
 from llm import llm_response
 
 import argparse
@@ -43,6 +44,11 @@ import random
 import shutil
 import asyncio
 import torch
+import os
+import copy
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
 from typing import Dict
 from logger import logger
 import gc
@@ -54,6 +60,10 @@ nerfreals:Dict[int, BaseReal] = {} #sessionid:BaseReal
 opt = None
 model = None
 avatar = None
+avatars = OrderedDict() #avatar_id:avatar, lru of warm avatars
+avatar_loads = {} #avatar_id:Future of a load in progress
+avatar_lock = Lock() #avatars, avatar_loads and the session defaults of opt, never held during a load
+infer_scheduler = None
         
 
 #####webrtc###############################
@@ -65,26 +75,111 @@ def randN(N)->int:
     max = pow(10, N)
     return random.randint(min, max - 1)
 
-def build_nerfreal(sessionid:int)->BaseReal:
-    opt.sessionid=sessionid
+def check_avatar_id(avatar_id:str):
+    '''client supplied avatar ids name a directory of data/avatars, nothing else'''
+    if not isinstance(avatar_id,str) or not re.fullmatch(r"[\w\-.]+", avatar_id) or avatar_id.startswith("."):
+        raise ValueError(f"Invalid avatar id: {avatar_id}")
+    if not os.path.isdir(f"./data/avatars/{avatar_id}"):
+        raise ValueError(f"avatar {avatar_id} does not exist")
+
+def load_avatar(avatar_id:str):
+    logger.info('load avatar %s',avatar_id)
+    if opt.model == 'wav2lip':
+        from lipreal import load_avatar
+        return load_avatar(avatar_id)
+    elif opt.model == 'musetalk':
+        from musereal import load_avatar
+        return load_avatar(avatar_id)
+    elif opt.model == 'ultralight':
+        from lightreal import load_avatar,warm_up
+        new_avatar = load_avatar(avatar_id)
+        warm_up(opt.batch_size,new_avatar,160)
+        return new_avatar
+
+def get_avatar(avatar_id:str):
+    '''
+    avatar from the lru of warm avatars, loaded on a miss while the models stay resident.
+    the load runs outside avatar_lock, so sessions of warm avatars never wait for it;
+    a second request for an avatar being loaded waits for that load
+    '''
+    check_avatar_id(avatar_id)
+    with avatar_lock:
+        if avatar_id in avatars:
+            avatars.move_to_end(avatar_id)
+            return avatars[avatar_id]
+        future = avatar_loads.get(avatar_id)
+        loading = future is not None
+        if not loading:
+            future = avatar_loads[avatar_id] = Future()
+    if loading:
+        return future.result()
+    try:
+        new_avatar = load_avatar(avatar_id)
+    except BaseException as e:
+        with avatar_lock:
+            del avatar_loads[avatar_id]
+        future.set_exception(e)
+        raise
+    with avatar_lock:
+        del avatar_loads[avatar_id]
+        avatars[avatar_id] = new_avatar
+        while len(avatars) > max(1,opt.avatar_cache):
+            #running sessions keep their own reference, eviction only affects new sessions
+            evicted,_ = avatars.popitem(last=False)
+            logger.info('evict avatar %s',evicted)
+    future.set_result(new_avatar)
+    return new_avatar
+
+def build_nerfreal(sessionid:int,avatar_id:str=None)->BaseReal:
+    with avatar_lock: #avatar_id/REF_FILE/REF_TEXT of /load_avatar change together
+        sessopt = copy.copy(opt) #per session, later changes of the defaults do not touch running sessions
+    sessopt.sessionid=sessionid
+    if avatar_id:
+        sessopt.avatar_id = avatar_id
+    avatar = get_avatar(sessopt.avatar_id)
     if opt.model == 'wav2lip':
         from lipreal import LipReal
-        nerfreal = LipReal(opt,model,avatar)
+        nerfreal = LipReal(sessopt,model,avatar)
     elif opt.model == 'musetalk':
         from musereal import MuseReal
-        nerfreal = MuseReal(opt,model,avatar)
+        nerfreal = MuseReal(sessopt,model,avatar)
     # elif opt.model == 'ernerf':
     #     from nerfreal import NeRFReal
     #     nerfreal = NeRFReal(opt,model,avatar)
     elif opt.model == 'ultralight':
         from lightreal import LightReal
-        nerfreal = LightReal(opt,model,avatar)
+        nerfreal = LightReal(sessopt,model,avatar)
+    nerfreal.infer_scheduler = infer_scheduler
     return nerfreal
 
+def video_params(params):
+    '''(codec, bitrate, keyframe_interval) of an offer, ValueError on bad client input'''
+    codec = str(params.get('video_codec',opt.video_codec)).upper()
+    if codec not in ("H264","VP8"):
+        raise ValueError(f"unsupported video_codec {codec}")
+    try:
+        bitrate = int(params.get('video_bitrate',opt.video_bitrate))
+        keyframe_interval = float(params.get('keyframe_interval',opt.keyframe_interval))
+    except (TypeError,ValueError):
+        raise ValueError("video_bitrate and keyframe_interval must be numbers")
+    if bitrate<0 or not 0<=keyframe_interval<3600:
+        raise ValueError("video_bitrate or keyframe_interval out of range")
+    return codec,bitrate,keyframe_interval
+
 @app.route('/offer', methods=['POST'])
 async def offer(request):
     params = await request.json()
     offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
+    try:
+        #before the session and the peer connection exist
+        codec,bitrate,keyframe_interval = video_params(params)
+    except ValueError as e:
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps(
+                {"code": -1, "msg": str(e)}
+            ),
+        )
 
     if len(nerfreals) >= opt.max_session:
         logger.info('reach max session')
@@ -97,7 +192,17 @@ async def offer(request):
     sessionid = randN(6) #len(nerfreals)
     logger.info('sessionid=%d',sessionid)
     nerfreals[sessionid] = None
-    nerfreal = await asyncio.get_event_loop().run_in_executor(None, build_nerfreal,sessionid)
+    try:
+        nerfreal = await asyncio.get_event_loop().run_in_executor(None, build_nerfreal,sessionid,params.get('avatar_id'))
+    except Exception as e:
+        logger.exception('exception:')
+        del nerfreals[sessionid]
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps(
+                {"code": -1, "msg": str(e)}
+            ),
+        )
     nerfreals[sessionid] = nerfreal
     
     ice_server = RTCIceServer(urls='stun:stun.l.google.com:19302')
@@ -121,11 +226,14 @@ async def offer(request):
     audio_sender = pc.addTrack(player.audio)
     video_sender = pc.addTrack(player.video)
     capabilities = RTCRtpSender.getCapabilities("video")
-    preferences = list(filter(lambda x: x.name == "H264", capabilities.codecs))
-    preferences += list(filter(lambda x: x.name == "VP8", capabilities.codecs))
+    order = [codec] + [name for name in ("H264","VP8") if name!=codec]
+    preferences = []
+    for name in order:
+        preferences += list(filter(lambda x: x.name.upper() == name, capabilities.codecs))
     preferences += list(filter(lambda x: x.name == "rtx", capabilities.codecs))
     transceiver = pc.getTransceivers()[1]
     transceiver.setCodecPreferences(preferences)
+    asyncio.ensure_future(apply_encoder_settings(video_sender,bitrate,keyframe_interval,pc))
 
     await pc.setRemoteDescription(offer)
 
@@ -199,7 +307,8 @@ async def humanaudio(request):
         fileobj = form["file"]
         filename=fileobj.filename
         filebytes=fileobj.file.read()
-        nerfreals[sessionid].put_audio_file(filebytes)
+        #the audio queue is bounded, do not block the event loop while it drains
+        await asyncio.get_event_loop().run_in_executor(None, nerfreals[sessionid].put_audio_file, filebytes)
 
         return web.Response(
             content_type="application/json",
@@ -243,15 +352,17 @@ async def record(request):
         params = await request.json()
 
         sessionid = params.get('sessionid',0)
+        path = None
         if params['type']=='start_record':
             # nerfreals[sessionid].put_msg_txt(params['text'])
             nerfreals[sessionid].start_recording()
         elif params['type']=='end_record':
-            nerfreals[sessionid].stop_recording()
+            #flushing the encoders takes a while, keep it off the event loop
+            path = await asyncio.get_event_loop().run_in_executor(None, nerfreals[sessionid].stop_recording)
         return web.Response(
             content_type="application/json",
             text=json.dumps(
-                {"code": 0, "msg":"ok"}
+                {"code": 0, "msg":"ok", "path":path}
             ),
         )
     except Exception as e:
@@ -263,6 +374,66 @@ async def record(request):
             ),
         )
 
+async def stats(request):
+    try:
+        params = await request.json()
+
+        sessionid = params.get('sessionid',0)
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps(
+                {"code": 0, "data": nerfreals[sessionid].get_stats()}
+            ),
+        )
+    except Exception as e:
+        logger.exception('exception:')
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps(
+                {"code": -1, "msg": str(e)}
+            ),
+        )
+
+async def preload_avatar(request):
+    '''
+    load avatar_id into the lru of warm avatars. with default=1 it also becomes the avatar
+    (and ref_file/ref_text the voice) of new sessions that do not ask for one in /offer
+    '''
+    try:
+        params = await request.json()
+
+        avatar_id = params['avatar_id']
+        await asyncio.get_event_loop().run_in_executor(None, get_avatar, avatar_id)
+        if params.get('default'):
+            with avatar_lock:
+                opt.avatar_id = avatar_id
+                if params.get('ref_file'):
+                    opt.REF_FILE = params['ref_file']
+                if params.get('ref_text'):
+                    opt.REF_TEXT = params['ref_text']
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps(
+                {"code": 0, "msg":"ok", "avatars": list(avatars.keys())}
+            ),
+        )
+    except Exception as e:
+        logger.exception('exception:')
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps(
+                {"code": -1, "msg": str(e)}
+            ),
+        )
+
+async def list_avatars(request):
+    return web.Response(
+        content_type="application/json",
+        text=json.dumps(
+            {"code": 0, "data": {"default": opt.avatar_id, "avatars": list(avatars.keys())}}
+        ),
+    )
+
 async def is_speaking(request):
     params = await request.json()
 
@@ -329,8 +500,12 @@ if __name__ == '__main__':
 
     #musetalk opt
     parser.add_argument('--avatar_id', type=str, default='avator_1', help="define which avatar in data/avatars")
+    #device memory per cached avatar: musetalk keeps its latents (8x32x32 fp32, 32KB per frame),
+    #wav2lip/ultralight their face tensors (6xHxW uint8 per frame); blend face boxes stay memory mapped on the host
+    parser.add_argument('--avatar_cache', type=int, default=4, help="number of warm avatars kept loaded for new sessions")
     #parser.add_argument('--bbox_shift', type=int, default=5)
     parser.add_argument('--batch_size', type=int, default=16, help="infer batch")
+    parser.add_argument('--whisper_stream', type=int, default=1, help="musetalk: 1 encode only the sliding window with whisper, 0 pad every window to 30s")
 
     parser.add_argument('--customvideo_config', type=str, default='', help="custom action json")
 
@@ -338,6 +513,7 @@ if __name__ == '__main__':
     parser.add_argument('--REF_FILE', type=str, default="en-US-BrianNeural")
     parser.add_argument('--REF_TEXT', type=str, default=None)
     parser.add_argument('--TTS_SERVER', type=str, default='http://127.0.0.1:9880') # http://localhost:9000
+    parser.add_argument('--tts_prefetch', type=int, default=2, help="sentences synthesized concurrently ahead of playback")
     # parser.add_argument('--CHARACTER', type=str, default='test')
     # parser.add_argument('--EMOTION', type=str, default='default')
 
@@ -347,6 +523,17 @@ if __name__ == '__main__':
     parser.add_argument('--push_url', type=str, default='http://localhost:1985/rtc/v1/whip/?app=live&stream=livestream') #rtmp://localhost/live/livestream
 
     parser.add_argument('--max_session', type=int, default=1)  #multi session count
+    parser.add_argument('--shared_infer', type=int, default=0, help="1: all sessions share one inference thread with cross-session batching")
+    parser.add_argument('--infer_max_batch', type=int, default=64, help="max frames of a cross-session batch")
+    parser.add_argument('--idle_cache_mb', type=int, default=256, help="memory budget per session for converted silent frames")
+    parser.add_argument('--frame_cache_mb', type=int, default=0, help="decode compressed avatar packages on demand into a cache of this size per asset, 0: decode all on load")
+    parser.add_argument('--prefetch_frames', type=int, default=50, help="frames decoded ahead of playback when --frame_cache_mb is set")
+    parser.add_argument('--record_dir', type=str, default='data/record', help="directory of the session recordings")
+    parser.add_argument('--video_codec', type=str, default='H264', help="preferred webrtc video codec, H264 or VP8")
+    parser.add_argument('--video_bitrate', type=int, default=0, help="start bitrate of the video encoder in bps, 0: aiortc default")
+    parser.add_argument('--video_min_bitrate', type=int, default=0, help="lower bound of the video bitrate in bps, 0: aiortc default")
+    parser.add_argument('--video_max_bitrate', type=int, default=0, help="upper bound of the video bitrate in bps, 0: aiortc default")
+    parser.add_argument('--keyframe_interval', type=float, default=0, help="seconds between forced keyframes, 0: only on receiver request")
     parser.add_argument('--listenport', type=int, default=8105, help="web listen port")
 
     opt = parser.parse_args()
@@ -356,29 +543,34 @@ if __name__ == '__main__':
     if opt.customvideo_config!='':
         with open(opt.customvideo_config,'r') as file:
             opt.customopt = json.load(file)
+    set_bitrate_limits(opt.video_min_bitrate,opt.video_max_bitrate)
+    avatarpack.set_lazy_loading(opt.frame_cache_mb,opt.prefetch_frames)
 
     # if opt.model == 'ernerf':       
     #     from nerfreal import NeRFReal,load_model,load_avatar
     #     model = load_model(opt)
     #     avatar = load_avatar(opt) 
     if opt.model == 'musetalk':
-        from musereal import MuseReal,load_model,load_avatar,warm_up
+        from musereal import MuseReal,load_model,warm_up
         logger.info(opt)
         model = load_model()
-        avatar = load_avatar(opt.avatar_id) 
+        avatar = get_avatar(opt.avatar_id) 
         warm_up(opt.batch_size,model)      
     elif opt.model == 'wav2lip':
-        from lipreal import LipReal,load_model,load_avatar,warm_up
+        from lipreal import LipReal,load_model,warm_up
         logger.info(opt)
         model = load_model("./models/wav2lip.pth")
-        avatar = load_avatar(opt.avatar_id)
+        avatar = get_avatar(opt.avatar_id)
         warm_up(opt.batch_size,model,256)
     elif opt.model == 'ultralight':
-        from lightreal import LightReal,load_model,load_avatar,warm_up
+        from lightreal import LightReal,load_model
         logger.info(opt)
         model = load_model(opt)
-        avatar = load_avatar(opt.avatar_id)
-        warm_up(opt.batch_size,avatar,160)
+        avatar = get_avatar(opt.avatar_id) #warmed up on load
+
+    if opt.shared_infer:
+        from inferscheduler import InferScheduler
+        infer_scheduler = InferScheduler(opt.infer_max_batch)
 
     # if opt.transport=='rtmp':
     #     thread_quit = Event()
@@ -401,6 +593,9 @@ if __name__ == '__main__':
     appasync.router.add_post("/record", record)
     appasync.router.add_post("/interrupt_talk", interrupt_talk)
     appasync.router.add_post("/is_speaking", is_speaking)
+    appasync.router.add_post("/stats", stats)
+    appasync.router.add_post("/load_avatar", preload_avatar)
+    appasync.router.add_post("/avatars", list_avatars)
     appasync.router.add_static('/',path='web')
 
     # Configure default CORS settings.
@@ -0,0 +1,117 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+'''
+Preallocated 20ms audio frame buffers of a session.
+AudioFifo hands the frames of the tts thread to the asr step, AudioRing keeps the audio
+stream seen by the asr step so the feature window and the frames of an inference batch
+are read in place by index, without a queue item, a copy or a pickle per frame.
+'''
+
+from threading import Lock, Condition
+
+import numpy as np
+
+
+class AudioFifo:
+    '''bounded fifo of frames, put blocks while it is full'''
+    def __init__(self, chunk, capacity):
+        self.capacity = capacity
+        self.buf = np.zeros((capacity,chunk), dtype=np.float32)
+        self.events = [None]*capacity #eventpoint side channel
+        self.gens = np.zeros(capacity, dtype=np.int64) #generation of the producer when the frame was put
+        self.head = 0 #next frame to read
+        self.tail = 0 #next frame to write
+        self.mutex = Lock()
+        self.not_full = Condition(self.mutex)
+
+    def qsize(self):
+        return self.tail-self.head
+
+    def put(self, frame, eventpoint=None, generation=0):
+        '''generation is taken before put may block, so a frame that lands after clear() is still stale'''
+        with self.not_full:
+            while self.tail-self.head >= self.capacity:
+                self.not_full.wait()
+            pos = self.tail % self.capacity
+            self.buf[pos,:len(frame)] = frame
+            self.buf[pos,len(frame):] = 0
+            self.events[pos] = eventpoint
+            self.gens[pos] = generation
+            self.tail += 1
+
+    def get_into(self, out, generation=0):
+        '''copy the oldest frame of generation into out, older frames are dropped; returns (False,None) when empty'''
+        with self.mutex:
+            while self.tail!=self.head:
+                pos = self.head % self.capacity
+                eventpoint = self.events[pos]
+                self.events[pos] = None
+                self.head += 1
+                self.not_full.notify()
+                if self.gens[pos]==generation:
+                    out[:] = self.buf[pos]
+                    return True,eventpoint
+            return False,None
+
+    def clear(self):
+        with self.mutex:
+            self.events = [None]*self.capacity
+            self.head = self.tail
+            self.not_full.notify_all() #wake up a tts thread blocked in put
+
+
+class AudioRing:
+    '''
+    The audio stream by absolute frame index, with the type and eventpoint of every frame.
+    Storage is mirrored (frame i lives at i%capacity and i%capacity+capacity), so any window of
+    up to capacity frames is one contiguous view. One writer; readers must consume frame i
+    before frame i+capacity is written, capacity is sized from the bounded queues downstream.
+    '''
+    def __init__(self, chunk, capacity):
+        self.capacity = capacity
+        self.buf = np.zeros((2*capacity,chunk), dtype=np.float32)
+        self.types = np.zeros(capacity, dtype=np.int32)
+        self.gens = np.zeros(capacity, dtype=np.int64) #utterance generation, see BaseASR.flush_talk
+        self.events = [None]*capacity
+        self.count = 0 #frames written
+
+    def next_slot(self):
+        '''writable view of the frame to be committed next'''
+        return self.buf[self.count % self.capacity]
+
+    def commit(self, type, eventpoint=None, generation=0):
+        pos = self.count % self.capacity
+        self.buf[pos+self.capacity] = self.buf[pos]
+        self.types[pos] = type
+        self.gens[pos] = generation
+        self.events[pos] = eventpoint
+        self.count += 1
+        return self.count-1
+
+    def frame(self, idx):
+        return self.buf[idx % self.capacity]
+
+    def item(self, idx):
+        '''(frame,type,eventpoint,generation) of frame idx, frame is a view of the ring'''
+        pos = idx % self.capacity
+        return self.buf[pos],int(self.types[pos]),self.events[pos],int(self.gens[pos])
+
+    def window(self, start, n):
+        '''pcm of frames [start,start+n) as one contiguous view'''
+        pos = start % self.capacity
+        return self.buf[pos:pos+n].reshape(-1)
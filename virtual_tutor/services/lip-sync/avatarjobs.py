@@ -0,0 +1,326 @@
+"""
+Avatar creation jobs.
+
+Every job runs in its own work directory (data/avatar_jobs/<job_id>) with its own
+input, transcoded video, blur files and build output, so concurrent uploads never
+share a file. Jobs run on a bounded worker pool, their state is written to
+<job_id>/job.json after every change and reloaded when the server restarts.
+"""
+
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from create_avatar import convert_video_to_25fps, burr_video, get_config_value, WORKING_DIRECTORY, LIVEAVADIR
+
+STAGES = ["transcode", "blur", "landmarks", "latents", "masks", "package"]
+BUILD_STAGES = ("landmarks", "latents", "masks")
+ACTIVE_STATES = ("queued", "running")
+
+_percent = re.compile(r"(\d+)%\|")
+
+
+class JobQueueFull(RuntimeError):
+    pass
+
+
+class JobConflict(ValueError):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class AvatarJob:
+    def __init__(self, job_id, avatar_name, burr, work_dir):
+        self.job_id = job_id
+        self.avatar_name = avatar_name
+        self.burr = burr
+        self.work_dir = work_dir
+        self.state = "created"  # created queued running succeeded failed cancelled
+        self.stage = None
+        self.stages = {name: {"state": "pending", "progress": 0.0, "started": None, "ended": None}
+                       for name in STAGES}
+        if not burr:
+            self.stages["blur"]["state"] = "skipped"
+        self.error = None
+        self.image_path = None
+        self.created = time.time()
+        self.updated = self.created
+        self.cancel_event = threading.Event()
+        self.process = None  # running subprocess, killed on cancel
+
+    @property
+    def input_path(self):
+        return os.path.join(self.work_dir, "input.mp4")
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "avatar_name": self.avatar_name,
+            "burr": self.burr,
+            "state": self.state,
+            "stage": self.stage,
+            "stages": self.stages,
+            "error": self.error,
+            "image_path": self.image_path,
+            "created": self.created,
+            "updated": self.updated,
+        }
+
+    @classmethod
+    def from_dict(cls, data, work_dir):
+        job = cls(data["job_id"], data["avatar_name"], data["burr"], work_dir)
+        for key in ("state", "stage", "stages", "error", "image_path", "created", "updated"):
+            setattr(job, key, data[key])
+        return job
+
+
+class AvatarJobManager:
+    """
+    Bounded queue of avatar creation jobs.
+
+    Args:
+        jobs_dir (str): parent of the job work directories
+        workers (int): jobs built at the same time
+        max_pending (int): queued jobs accepted before submit raises JobQueueFull
+    """
+
+    def __init__(self, jobs_dir, workers=1, max_pending=16):
+        self.jobs_dir = jobs_dir
+        self.max_pending = max_pending
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="avatar_job")
+        os.makedirs(jobs_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Reload the jobs of a previous run, requeue the queued ones and fail the ones that can not resume"""
+        requeue = []
+        for job_id in sorted(os.listdir(self.jobs_dir)):
+            path = os.path.join(self.jobs_dir, job_id, "job.json")
+            if not os.path.isfile(path):
+                continue
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    job = AvatarJob.from_dict(json.load(f), os.path.dirname(path))
+            except Exception as e:
+                print(f"Failed to load avatar job {job_id}: {e}")
+                continue
+            self.jobs[job.job_id] = job
+            if job.state == "running":
+                # the build process died with the server
+                self._finish(job, "failed", "interrupted by a server restart")
+            elif job.state == "created":
+                # the server died while the video was uploaded
+                self._finish(job, "failed", "upload interrupted by a server restart")
+            elif job.state == "queued":
+                if os.path.exists(job.input_path):
+                    requeue.append(job)
+                else:
+                    self._finish(job, "failed", "input video missing after a server restart")
+        for job in sorted(requeue, key=lambda job: job.created):
+            self.pool.submit(self._run, job)
+        print(f"Loaded {len(self.jobs)} avatar jobs, requeued {len(requeue)}")
+
+    def _save(self, job):
+        job.updated = time.time()
+        path = os.path.join(job.work_dir, "job.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(job.to_dict(), f, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def new_job(self, avatar_name, burr=False):
+        """
+        Create a job and its work directory, the caller puts the video at job.input_path
+        and then calls enqueue(job)
+        """
+        if not re.fullmatch(r"[\w\-.]+", avatar_name) or avatar_name.startswith("."):
+            raise ValueError(f"Invalid avatar name: {avatar_name}")
+        with self.lock:
+            for job in self.jobs.values():
+                if job.avatar_name == avatar_name and job.state in ACTIVE_STATES + ("created",):
+                    raise JobConflict(f"Avatar '{avatar_name}' is already being created by job {job.job_id}")
+            if sum(job.state == "queued" for job in self.jobs.values()) >= self.max_pending:
+                raise JobQueueFull(f"Too many pending avatar jobs (max {self.max_pending})")
+            job_id = uuid.uuid4().hex[:12]
+            job = AvatarJob(job_id, avatar_name, burr, os.path.join(self.jobs_dir, job_id))
+            os.makedirs(job.work_dir)
+            self.jobs[job_id] = job
+        self._save(job)
+        return job
+
+    def enqueue(self, job):
+        with self.lock:
+            job.state = "queued"
+            self._save(job)
+        self.pool.submit(self._run, job)
+        return job
+
+    def submit(self, video_path, avatar_name, burr=False):
+        """Copy video_path into a new job and queue it"""
+        job = self.new_job(avatar_name, burr)
+        try:
+            shutil.copyfile(video_path, job.input_path)
+        except Exception as e:
+            self._finish(job, "failed", f"Failed to copy video: {e}")
+            raise
+        return self.enqueue(job)
+
+    def get(self, job_id):
+        return self.jobs[job_id]
+
+    def list(self):
+        with self.lock:
+            return sorted(self.jobs.values(), key=lambda job: job.created, reverse=True)
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job, a running build process is killed"""
+        job = self.jobs[job_id]
+        with self.lock:
+            if job.state not in ACTIVE_STATES + ("created",):
+                return job
+            job.cancel_event.set()
+            process = job.process
+            if job.state != "running":
+                self._finish(job, "cancelled", None)
+        if process is not None and process.poll() is None:
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        return job
+
+    def _finish(self, job, state, error):
+        job.state = state
+        job.error = error
+        if job.stage is not None and job.stages[job.stage]["state"] == "running":
+            job.stages[job.stage]["state"] = state
+            job.stages[job.stage]["ended"] = time.time()
+        self._save(job)
+        # intermediate files are not needed any more, the state and the build log stay
+        for name in os.listdir(job.work_dir):
+            if name not in ("job.json", "build.log"):
+                path = os.path.join(job.work_dir, name)
+                shutil.rmtree(path, ignore_errors=True) if os.path.isdir(path) else os.remove(path)
+
+    def _stage(self, job, name):
+        if job.cancel_event.is_set():
+            raise JobCancelled()
+        with self.lock:
+            if job.stage is not None and job.stages[job.stage]["state"] == "running":
+                job.stages[job.stage].update(state="done", progress=1.0, ended=time.time())
+            job.stage = name
+            job.stages[name].update(state="running", started=time.time())
+            self._save(job)
+        print(f"[avatar job {job.job_id}] {name}")
+
+    def _progress(self, job, progress):
+        stage = job.stages[job.stage]
+        if progress - stage["progress"] >= 0.05 or progress >= 1.0:
+            with self.lock:
+                stage["progress"] = round(progress, 3)
+                self._save(job)
+
+    def _run(self, job):
+        with self.lock:
+            if job.state != "queued":  # cancelled while waiting
+                return
+            job.state = "running"
+            self._save(job)
+        try:
+            self._stage(job, "transcode")
+            video_path = os.path.join(job.work_dir, "input_25fps.mp4")
+            if not convert_video_to_25fps(job.input_path, video_path):
+                raise RuntimeError("Video frame rate conversion failed")
+
+            if job.burr:
+                self._stage(job, "blur")
+                if not burr_video(video_path, tag=job.job_id):
+                    raise RuntimeError("Blur processing failed")
+
+            save_path = os.path.join(job.work_dir, "avatar")
+            self._build(job, video_path, save_path)
+
+            self._stage(job, "package")
+            self._package(job, save_path)
+            with self.lock:
+                job.stages["package"].update(state="done", progress=1.0, ended=time.time())
+                self._finish(job, "succeeded", None)
+            print(f"[avatar job {job.job_id}] avatar {job.avatar_name} created")
+        except JobCancelled:
+            with self.lock:
+                self._finish(job, "cancelled", None)
+            print(f"[avatar job {job.job_id}] cancelled")
+        except Exception as e:
+            with self.lock:
+                self._finish(job, "cancelled" if job.cancel_event.is_set() else "failed", str(e))
+            print(f"[avatar job {job.job_id}] failed: {e}")
+
+    def _build(self, job, video_path, save_path):
+        """musetalk/simple_musetalk.py in its own process group, stage markers and tqdm percentages are the progress"""
+        musetalk_dir = os.path.join(WORKING_DIRECTORY, "musetalk")
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.join(musetalk_dir, "utils"), env.get("PYTHONPATH")]))
+        python = get_config_value("avatar_jobs.python", sys.executable)
+        command = [python, "simple_musetalk.py", "--file", video_path, "--avatar_id", job.avatar_name,
+                   "--save_path", save_path]
+        for key in ("batch_size_fa", "batch_size_vae", "batch_size_parse", "workers"):
+            value = get_config_value(f"avatar_jobs.{key}")
+            if value is not None:
+                command += [f"--{key}", str(value)]
+        self._stage(job, "landmarks")
+        with self.lock:
+            if job.cancel_event.is_set():
+                raise JobCancelled()
+            job.process = subprocess.Popen(command, cwd=musetalk_dir, env=env, stdout=subprocess.PIPE,
+                                           stderr=subprocess.STDOUT, text=True, bufsize=1,
+                                           start_new_session=True)
+        process = job.process
+        log_path = os.path.join(job.work_dir, "build.log")
+        with open(log_path, "w", encoding="utf-8") as log:
+            # text mode turns the \r of tqdm into line breaks
+            for line in process.stdout:
+                log.write(line)
+                line = line.strip()
+                if line.startswith("stage: "):
+                    name = line[len("stage: "):]
+                    if name in BUILD_STAGES and name != job.stage:
+                        self._stage(job, name)
+                    continue
+                match = _percent.search(line)
+                if match and job.stage in BUILD_STAGES:
+                    self._progress(job, int(match.group(1)) / 100)
+        process.wait()
+        job.process = None
+        if job.cancel_event.is_set():
+            raise JobCancelled()
+        if process.returncode != 0:
+            with open(log_path, "r", encoding="utf-8") as log:
+                tail = log.read()[-500:]
+            raise RuntimeError(f"Avatar build failed with return code {process.returncode}: {tail}")
+
+    def _package(self, job, save_path):
+        """Move the finished avatar into data/avatars, replacing an older avatar of the same name"""
+        target = os.path.join(LIVEAVADIR, job.avatar_name)
+        staging = os.path.join(LIVEAVADIR, f".{job.avatar_name}.{job.job_id}")
+        shutil.move(save_path, staging)
+        if os.path.exists(target):
+            old = os.path.join(LIVEAVADIR, f".{job.avatar_name}.{job.job_id}.old")
+            os.rename(target, old)
+            os.rename(staging, target)
+            shutil.rmtree(old, ignore_errors=True)
+        else:
+            os.rename(staging, target)
+        image_path = os.path.join(target, "full_imgs", "00000000.png")
+        job.image_path = image_path if os.path.exists(image_path) else None
@@ -0,0 +1,539 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+'''
+Single file avatar package, data/avatars/<avatar_id>/avatar.avpk.
+
+Layout: a fixed header (magic, version, offset and length of the index), then the
+chunks, then the json index. Every asset is either a frame sequence or an array.
+A frame sequence has a codec (raw, lz4, jpeg, png, qoi) and a chunk table
+(offset,length,h,w,c) per frame, stored as an array chunk itself; raw frames of one
+asset are written back to back, so same size raw frames are one memory mapped
+(N,h,w,c) view like the packed/ directory of avatarstore. Arrays (coords, latents,
+blend material) are stored raw or lz4 with their dtype and shape, no pickle.
+The index is written last and the file renamed into place, so a partial package
+is never opened. One file copies across nodes in one transfer.
+With app.py --frame_cache_mb the compressed full_imgs and masks are not decoded on
+load but on demand, see LazyFrames.
+Convert: python avatarpack.py --avatar_id <avatar_id> [--codec lz4] [--bench 1]
+'''
+
+import os
+import json
+import time
+import struct
+import argparse
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import avatarstore
+from logger import logger
+
+try:
+    import lz4.block as lz4block
+except ImportError:
+    lz4block = None
+try:
+    import qoi
+except ImportError:
+    qoi = None
+
+PACK_VERSION = 2
+PACK_FILE = 'avatar.avpk'
+MAGIC = b'AVPK'
+HEADER = struct.Struct('<4sIQQ') #magic, version, index offset, index length
+ALIGN = 64
+DECODE_WORKERS = min(8, os.cpu_count() or 1)
+#lazy loading of compressed frames, set by set_lazy_loading (app.py --frame_cache_mb --prefetch_frames)
+LAZY_KINDS = ('full_imgs','mask') #face_imgs go to the device whole anyway
+frame_cache_mb = 0
+prefetch_frames = 50
+
+def set_lazy_loading(cache_mb, prefetch):
+    '''cache_mb>0: compressed frames are decoded on demand into an lru of cache_mb per asset'''
+    global frame_cache_mb,prefetch_frames
+    frame_cache_mb = cache_mb
+    prefetch_frames = prefetch
+
+
+# ---------- codecs ----------
+def _encode(codec, img, quality):
+    if codec=='raw':
+        return np.ascontiguousarray(img).data
+    if codec=='lz4':
+        return lz4block.compress(np.ascontiguousarray(img).data, store_size=True)
+    if codec=='jpeg':
+        ok,buf = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    elif codec=='png':
+        ok,buf = cv2.imencode('.png', img, [cv2.IMWRITE_PNG_COMPRESSION, 1]) #lossless, fast level
+    elif codec=='qoi':
+        return qoi.encode(np.ascontiguousarray(img))
+    else:
+        raise ValueError(f'unknown codec {codec}')
+    if not ok:
+        raise ValueError(f'{codec} encode failed')
+    return buf.data
+
+def _decode(codec, buf, shape, out=None):
+    '''decode one frame into out (or a new array) of shape (h,w,c)'''
+    if codec=='lz4':
+        img = np.frombuffer(lz4block.decompress(buf), dtype=np.uint8).reshape(shape)
+    elif codec in ('jpeg','png'):
+        img = cv2.imdecode(np.asarray(buf), cv2.IMREAD_UNCHANGED if shape[2]!=3 else cv2.IMREAD_COLOR).reshape(shape)
+    elif codec=='qoi':
+        img = qoi.decode(bytes(buf)).reshape(shape)
+    else:
+        raise ValueError(f'unknown codec {codec}')
+    if out is None:
+        return img
+    out[...] = img
+    return out
+
+def check_codec(codec):
+    if codec=='lz4' and lz4block is None:
+        raise ValueError('codec lz4 needs the lz4 package')
+    if codec=='qoi' and qoi is None:
+        raise ValueError('codec qoi needs the qoi package')
+    if codec not in ('raw','lz4','jpeg','png','qoi'):
+        raise ValueError(f'unknown codec {codec}')
+
+def default_codec():
+    '''lossless and fast to decode'''
+    return 'lz4' if lz4block is not None else 'raw'
+
+
+# ---------- writer ----------
+class PackWriter:
+    '''writes path+".tmp", close() renames it to path'''
+    def __init__(self, path, workers=DECODE_WORKERS):
+        self.path = path
+        self.f = open(path+'.tmp', 'wb')
+        self.f.write(HEADER.pack(MAGIC, PACK_VERSION, 0, 0))
+        self.assets = {}
+        self.meta = {}
+        self.workers = workers
+
+    def _align(self):
+        pad = -self.f.tell() % ALIGN
+        if pad:
+            self.f.write(b'\0'*pad)
+        return self.f.tell()
+
+    def _chunk(self, data):
+        offset = self._align()
+        self.f.write(data)
+        return offset,self.f.tell()-offset
+
+    def add_array(self, name, array, codec='raw'):
+        array = np.ascontiguousarray(array)
+        data = array.data if codec=='raw' else lz4block.compress(array.data, store_size=True)
+        offset,length = self._chunk(data)
+        self.assets[name] = {'kind':'array','codec':codec,'dtype':array.dtype.str,'shape':list(array.shape),
+                             'offset':offset,'length':length}
+
+    def add_frames(self, name, frames, codec='raw', quality=95, mark=False):
+        '''frames: sequence of uint8 (h,w,c) images, encoded on a thread pool'''
+        check_codec(codec)
+        def encode(img):
+            if mark and img[0,0,0]&1: #webrtc frame marker of full_imgs, see avatarstore._pack_images
+                img = img.copy()
+                img[0,:] &= 0xFE
+            return img.shape,_encode(codec, img, quality)
+        table = np.zeros((len(frames),5), dtype=np.int64)
+        self._align()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for i,(shape,data) in enumerate(pool.map(encode, frames)):
+                offset = self.f.tell() #back to back: raw frames of one asset stay contiguous
+                self.f.write(data)
+                h,w = shape[:2]
+                table[i] = (offset,self.f.tell()-offset,h,w,shape[2] if len(shape)==3 else 1)
+        self.add_array(name+'.table', table)
+        self.assets[name] = {'kind':'frames','codec':codec,'count':len(frames),'table':name+'.table',
+                             'quality':quality if codec=='jpeg' else None}
+
+    def close(self):
+        index = json.dumps({'version':PACK_VERSION,'assets':self.assets,'meta':self.meta}).encode()
+        offset,length = self._chunk(index)
+        self.f.seek(0)
+        self.f.write(HEADER.pack(MAGIC, PACK_VERSION, offset, length))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        os.replace(self.path+'.tmp', self.path)
+
+
+# ---------- lazy frames ----------
+class LazyFrames:
+    '''
+    Frame sequence decoded on demand, shared by all sessions of the avatar. Decoded
+    frames are kept in an lru bounded by cache_bytes, frames are read-only.
+    Every session reads through its own FrameReader (reader()), which keeps the
+    playback position and direction of that session; a background thread decodes the
+    next `window` frames of every reader (mirror_index ping-pong, reflected at both
+    ends), nearest frames of all readers first. A miss decodes on the calling thread.
+    '''
+    def __init__(self, decode, count, frame_bytes, cache_bytes, window, name=''):
+        self.decode = decode
+        self.count = count
+        self.frame_bytes = frame_bytes
+        self.capacity = max(window+1, cache_bytes//max(frame_bytes,1))
+        self.window = min(window, self.capacity-1)
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.readers = weakref.WeakSet()
+        self.stats = {'prefetched':0,'evicted':0}
+        #the thread only holds a weak reference, it ends when the avatar is released
+        threading.Thread(target=LazyFrames._prefetch, args=(weakref.ref(self),self.wakeup),
+                         daemon=True, name=f'prefetch_{name}').start()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        return self.get(int(idx))
+
+    def reader(self, prefetch=True, cache=True):
+        '''
+        view with its own playback position. prefetch=False: reads do not steer the
+        prefetch, cache=False: misses are not kept (one pass walks like the idle cache warm up)
+        '''
+        reader = FrameReader(self, cache)
+        if prefetch:
+            with self.lock:
+                self.readers.add(reader)
+        return reader
+
+    def _ahead(self, idx, direction, window):
+        '''the next window frames after idx, reflected like mirror_index'''
+        out = []
+        for _ in range(window):
+            if not 0<=idx+direction<self.count:
+                direction = -direction
+            idx += direction
+            if not 0<=idx<self.count: #single frame avatar
+                break
+            out.append(idx)
+        return out
+
+    def _reader_window(self):
+        '''lock held. the windows of all readers have to fit in the lru together'''
+        return min(self.window, (self.capacity-1)//max(1,len(self.readers)))
+
+    def _put(self, idx, img):
+        '''lock held'''
+        self.cache[idx] = img
+        while len(self.cache)>self.capacity:
+            self.cache.popitem(last=False)
+            self.stats['evicted'] += 1
+
+    def get(self, idx, stats=None, cache=True):
+        '''frame idx, hit/miss counted into stats (a reader's) if given'''
+        if idx<0:
+            idx += self.count
+        with self.lock:
+            img = self.cache.get(idx)
+            if img is not None:
+                self.cache.move_to_end(idx)
+                if stats is not None:
+                    stats['hits'] += 1
+                return img
+        t = time.perf_counter()
+        img = self.decode(idx)
+        img.flags.writeable = False
+        with self.lock:
+            if stats is not None:
+                stats['misses'] += 1
+                stats['miss_ms'] += (time.perf_counter()-t)*1000
+            if cache:
+                self._put(idx, img)
+        return img
+
+    @staticmethod
+    def _prefetch(ref, wakeup):
+        while True:
+            with wakeup:
+                frames = ref()
+                if frames is None:
+                    return
+                window = frames._reader_window()
+                #rank k of every reader before rank k+1 of any: all sessions keep up
+                windows = [frames._ahead(reader.cursor, reader.direction, window) for reader in list(frames.readers)]
+                idx = next((w[k] for k in range(window) for w in windows
+                            if k<len(w) and w[k] not in frames.cache), None)
+                if idx is None:
+                    del frames
+                    wakeup.wait(1.0)
+                    continue
+            img = frames.decode(idx)
+            img.flags.writeable = False
+            with wakeup:
+                if idx not in frames.cache:
+                    frames.stats['prefetched'] += 1
+                    frames._put(idx, img)
+            del frames
+
+    def get_stats(self):
+        '''shared by all readers of the avatar'''
+        with self.lock:
+            stats = {f'frame_cache_{k}':v for k,v in self.stats.items()}
+            stats['frame_cache_frames'] = len(self.cache)
+            stats['frame_cache_mb'] = round(len(self.cache)*self.frame_bytes/2**20, 1)
+            stats['frame_cache_readers'] = len(self.readers)
+        return stats
+
+
+class FrameReader:
+    '''one session's view of LazyFrames: playback position, direction and hit/miss stats'''
+    def __init__(self, frames, cache=True):
+        self.frames = frames
+        self.cache = cache
+        self.cursor = 0
+        self.direction = 1
+        self.stats = {'hits':0,'misses':0,'late':0,'miss_ms':0.0}
+
+    def __len__(self):
+        return self.frames.count
+
+    def reader(self, prefetch=True, cache=True):
+        return self.frames.reader(prefetch, cache)
+
+    def __getitem__(self, idx):
+        frames = self.frames
+        idx = int(idx)
+        if idx<0:
+            idx += frames.count
+        with frames.lock:
+            #a miss of a frame the prefetch should have decoded: the prefetch fell behind
+            late = idx not in frames.cache and idx in frames._ahead(self.cursor, self.direction, frames._reader_window())
+            step = idx-self.cursor
+            if step in (1,-1):  #a jump (start, interruption) keeps the direction
+                self.direction = step
+            if step:
+                self.cursor = idx
+                frames.wakeup.notify()
+        self.stats['late'] += late
+        return frames.get(idx, self.stats, self.cache)
+
+    def get_stats(self):
+        frames = self.frames
+        stats = frames.get_stats()
+        stats.update({f'frame_cache_{k}':v for k,v in self.stats.items()})
+        stats['frame_cache_miss_ms'] = round(stats['frame_cache_miss_ms'], 1)
+        with frames.lock:
+            #frames decoded ahead of this session's playback
+            stats['frame_cache_ahead'] = sum(1 for i in frames._ahead(self.cursor, self.direction, frames._reader_window())
+                                             if i in frames.cache)
+        return stats
+
+
+# ---------- reader ----------
+def read_header(path):
+    with open(path, 'rb') as f:
+        magic,version,offset,length = HEADER.unpack(f.read(HEADER.size))
+    if magic!=MAGIC:
+        raise ValueError(f'{path} is not an avatar package')
+    return version,offset,length
+
+def is_valid(path):
+    '''a package of the current version'''
+    try:
+        return read_header(path)[0]==PACK_VERSION
+    except (OSError,ValueError,struct.error):
+        return False
+
+
+class AvatarPack:
+    '''
+    Read-only avatar package, same interface as avatarstore.PackedAvatar.
+    raw assets are views of the memory mapped file, compressed frames are decoded
+    on a thread pool when the asset is first requested.
+    '''
+    def __init__(self, path):
+        version,offset,length = read_header(path)
+        if version!=PACK_VERSION:
+            raise ValueError(f'{path}: package version {version}, expected {PACK_VERSION}')
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        index = json.loads(bytes(self.data[offset:offset+length]))
+        self.assets = index['assets']
+        self.meta = index['meta']
+
+    def __contains__(self, kind):
+        return kind in self.assets
+
+    def array(self, name):
+        asset = self.assets[name]
+        buf = self.data[asset['offset']:asset['offset']+asset['length']]
+        if asset['codec']=='lz4':
+            buf = np.frombuffer(lz4block.decompress(buf), dtype=np.uint8)
+        return buf.view(np.dtype(asset['dtype'])).reshape(asset['shape'])
+
+    def table(self, kind):
+        return self.array(self.assets[kind]['table'])
+
+    def images(self, kind, workers=DECODE_WORKERS):
+        asset = self.assets[kind]
+        table = self.table(kind)
+        uniform = len(table)>0 and (table[:,2:]==table[0,2:]).all()
+        if asset['codec']=='raw':
+            index = np.ascontiguousarray(table[:,[0,2,3,4]])
+            if uniform:
+                shape = (len(table),)+tuple(int(v) for v in table[0,2:])
+                return self.data[table[0,0]:table[0,0]+int(np.prod(shape))].reshape(shape)
+            return avatarstore.PackedFrames(self.data, index)
+        codec = asset['codec']
+        check_codec(codec)
+        if frame_cache_mb>0 and kind in LAZY_KINDS:
+            return self.lazy_images(kind, table)
+        frames = np.empty((len(table),)+tuple(int(v) for v in table[0,2:]), dtype=np.uint8) if uniform else [None]*len(table)
+        def decode(i):
+            offset,length,h,w,c = (int(v) for v in table[i])
+            img = _decode(codec, self.data[offset:offset+length], (h,w,c), frames[i] if uniform else None)
+            if kind=='full_imgs':
+                img[0,:] &= 0xFE #lossy codecs do not keep the marker bit
+            if not uniform:
+                img.flags.writeable = False
+                frames[i] = img
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(decode, range(len(table))))
+        if uniform:
+            frames.flags.writeable = False #shared by all sessions, like the memory mapped frames
+        return frames
+
+    def lazy_images(self, kind, table):
+        codec = self.assets[kind]['codec']
+        def decode(i):
+            offset,length,h,w,c = (int(v) for v in table[i])
+            img = _decode(codec, self.data[offset:offset+length], (h,w,c))
+            if kind=='full_imgs':
+                img[0,:] &= 0xFE
+            return img
+        frame_bytes = int(table[:,2:].prod(axis=1).max())
+        logger.info('%s %s: lazy, %d frames cache, prefetch %d', self.path, kind,
+                    frame_cache_mb*2**20//frame_bytes, prefetch_frames)
+        return LazyFrames(decode, len(table), frame_bytes, frame_cache_mb*2**20, prefetch_frames, kind)
+
+    def coords(self, kind):
+        return [tuple(int(v) for v in row) for row in self.array(kind)]
+
+    def latents(self):
+        return self.array('latents')
+
+    def blend(self):
+        '''(blend mask views, face box views, geometry) of a musetalk avatar'''
+        geometry = np.array(self.array(avatarstore.BLEND_GEOMETRY))
+        return avatarstore.blend_mask_views(self.array(avatarstore.BLEND_MASKS),geometry),\
+               avatarstore.blend_body_views(self.array(avatarstore.BLEND_BODIES),geometry),geometry
+
+
+# ---------- converter ----------
+def pack_file_of(avatar_path):
+    return os.path.join(avatar_path, PACK_FILE)
+
+def convert_avatar(avatar_path, codec=None, mask_codec=None, quality=95, out=None):
+    '''
+    Package the assets of avatar_path (png folders + pkl/pt, or the packed/ directory)
+    into one file. codec applies to full_imgs and face_imgs, mask_codec to the masks.
+    '''
+    codec = codec or default_codec()
+    mask_codec = mask_codec or codec
+    src = avatarstore.open_packed(avatar_path)
+    out = out or pack_file_of(avatar_path)
+    t = time.perf_counter()
+    writer = PackWriter(out)
+    for kind in avatarstore.IMAGE_KINDS:
+        if kind in src:
+            logger.info('packaging %s %s (%s)...', avatar_path, kind, mask_codec if kind=='mask' else codec)
+            writer.add_frames(kind, src.images(kind), mask_codec if kind=='mask' else codec, quality, mark=(kind=='full_imgs'))
+    for kind in avatarstore.COORD_KINDS:
+        if kind in src:
+            writer.add_array(kind, np.asarray(src.coords(kind), dtype=np.int64).reshape(-1,4))
+    if 'latents' in src:
+        writer.add_array('latents', src.latents())
+    if 'blend' in src:
+        blend_masks,blend_bodies,geometry = src.blend()
+        writer.add_array(avatarstore.BLEND_MASKS, blend_masks.data)
+        writer.add_array(avatarstore.BLEND_BODIES, blend_bodies.data)
+        writer.add_array(avatarstore.BLEND_GEOMETRY, geometry)
+    info_path = os.path.join(avatar_path, 'avator_info.json')
+    if os.path.exists(info_path):
+        with open(info_path) as f:
+            writer.meta['avatar_info'] = json.load(f)
+    writer.close()
+    logger.info('packaged %s: %.1fMB in %.1fs', out, os.path.getsize(out)/2**20, time.perf_counter()-t)
+    return out
+
+
+# ---------- benchmark ----------
+def _touch(frames):
+    '''read every pixel, so lazily mapped pages count in the load time'''
+    total = 0
+    for i in range(len(frames)):
+        total += int(frames[i][::16,::16].sum())
+    return total
+
+def benchmark(avatar_path, codecs, quality=95):
+    '''size, write and cold-ish load time of full_imgs per codec, against png decoding'''
+    rows = []
+    png_dir = os.path.join(avatar_path, 'full_imgs')
+    img_list = avatarstore._sorted_imgs(png_dir)
+    if img_list:
+        t = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=DECODE_WORKERS) as pool:
+            frames = list(pool.map(avatarstore._read_img, img_list))
+        rows.append(('png dir', sum(os.path.getsize(p) for p in img_list), 0.0, time.perf_counter()-t))
+        del frames
+    for codec in codecs:
+        try:
+            check_codec(codec)
+        except ValueError as e:
+            logger.info('skip %s: %s', codec, e)
+            continue
+        out = os.path.join(avatar_path, f'bench_{codec}.avpk')
+        t = time.perf_counter()
+        convert_avatar(avatar_path, codec, codec, quality, out)
+        write_time = time.perf_counter()-t
+        t = time.perf_counter()
+        _touch(AvatarPack(out).images('full_imgs'))
+        rows.append((f'avpk {codec}', os.path.getsize(out), write_time, time.perf_counter()-t))
+        os.remove(out)
+    print(f'{"format":<12}{"size MB":>10}{"write s":>10}{"load s":>10}')
+    for name,size,write_time,load_time in rows:
+        print(f'{name:<12}{size/2**20:>10.1f}{write_time:>10.2f}{load_time:>10.2f}')
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--avatar_id', type=str, nargs='+', required=True, help="avatars in data/avatars to package")
+    parser.add_argument('--codec', type=str, default=None, help="full_imgs/face_imgs codec: raw lz4 jpeg png qoi, default lz4 if installed else raw")
+    parser.add_argument('--mask_codec', type=str, default=None, help="mask codec, default --codec")
+    parser.add_argument('--quality', type=int, default=95, help="jpeg quality")
+    parser.add_argument('--bench', type=int, default=0, help="1: compare the load time of the codecs instead of packaging")
+    args = parser.parse_args()
+    for avatar_id in args.avatar_id:
+        avatar_path = f"./data/avatars/{avatar_id}"
+        if args.bench:
+            benchmark(avatar_path, ['raw','lz4','jpeg','png','qoi'], args.quality)
+        else:
+            convert_avatar(avatar_path, args.codec, args.mask_codec, args.quality)
@@ -0,0 +1,322 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+'''
+Packed avatar assets.
+
+The png folders of an avatar (full_imgs, face_imgs, mask) are packed once into
+data/avatars/<avatar_id>/packed/ as one contiguous uint8 array per asset kind, next to
+coords/mask_coords/latents stored as plain arrays. Musetalk avatars also get their blend
+material: float16 single channel masks and the uint8 frame pixels cut to the face box, plus a
+geometry table. Loading a packed avatar is a read-only
+memory map: no png decoding at startup, and the pages are shared through the os page
+cache by every session and every worker process using the same avatar.
+Pack ahead of time with: python avatarstore.py --avatar_id <avatar_id>
+'''
+
+import os
+import glob
+import json
+import pickle
+import shutil
+import argparse
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+from logger import logger
+
+PACK_VERSION = 3
+PACK_DIR = 'packed'
+IMAGE_KINDS = ('full_imgs','face_imgs','mask')
+COORD_KINDS = ('coords','mask_coords')
+#blend_geometry columns: face box x,y,x1,y1 | mask crop box x_s,y_s,x_e,y_e | resize size w,h
+BLEND_MASKS = 'blend_masks.npy'
+BLEND_GEOMETRY = 'blend_geometry.npy'
+#uint8 face box of every full frame, flat like blend_masks: the blender never reads the full frames
+BLEND_BODIES = 'blend_bodies.npy'
+
+
+class PackedFrames:
+    '''
+    Frames of different sizes (e.g. musetalk masks) stored in one flat buffer.
+    index[i] = (offset,h,w,c), frame i is returned as a read-only view, no copy.
+    '''
+    def __init__(self, data, index):
+        self.data = data
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        offset,h,w,c = (int(v) for v in self.index[idx])
+        return self.data[offset:offset+h*w*c].reshape(h,w,c)
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+
+def _sorted_imgs(path):
+    img_list = glob.glob(os.path.join(path, '*.[jpJP][pnPN]*[gG]'))
+    return sorted(img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+
+def _read_img(path):
+    img = cv2.imread(path)
+    if img is None:
+        raise ValueError(f'can not read image {path}')
+    return img
+
+def _pack_images(img_list, out_path, mark):
+    '''decode img_list once, append the pixels to out_path.bin and write the (offset,h,w,c) table'''
+    index = np.zeros((len(img_list),4), dtype=np.int64)
+    offset = 0
+    with open(out_path+'.bin', 'wb') as f:
+        for i,img_path in enumerate(tqdm(img_list)):
+            img = _read_img(img_path)
+            if mark:
+                img[0,:] &= 0xFE  #webrtc frame marker, applied once here instead of on every sent frame
+            index[i] = (offset,)+img.shape
+            f.write(np.ascontiguousarray(img).data)
+            offset += img.size
+    np.save(out_path+'_index.npy', index)
+
+def _load_images(pack_path, kind):
+    index = np.load(os.path.join(pack_path, f'{kind}_index.npy'))
+    data = np.memmap(os.path.join(pack_path, f'{kind}.bin'), dtype=np.uint8, mode='r')
+    if len(index) and (index[:,1:]==index[0,1:]).all():
+        #same size frames: one (N,h,w,c) read-only view of the mapping
+        return data[:index[-1,0]+index[-1,1:].prod()].reshape((len(index),)+tuple(int(v) for v in index[0,1:]))
+    return PackedFrames(data, index)
+
+
+def get_blend_material(mask, face_box, crop_box):
+    '''float16 blend weight of the face box and the geometry row of one frame'''
+    x, y, x1, y1 = (int(v) for v in face_box)
+    x_s, y_s, x_e, y_e = (int(v) for v in crop_box)
+    if x1<=x or y1<=y: #no face in this frame
+        return np.zeros((0,0), dtype=np.float16),(x,y,x1,y1,x_s,y_s,x_e,y_e,0,0)
+    if mask.ndim==3:
+        mask = cv2.cvtColor(mask,cv2.COLOR_BGR2GRAY)
+    blend_mask = (mask[y-y_s:y1-y_s, x-x_s:x1-x_s]/255.).astype(np.float16)
+    return blend_mask,(x,y,x1,y1,x_s,y_s,x_e,y_e,x1-x,y1-y)
+
+def build_blend_material(mask_list, coord_list, mask_coords_list):
+    '''flat float16 masks + (N,10) int32 geometry for all frames'''
+    blend_masks = []
+    geometry = []
+    for mask,face_box,crop_box in zip(mask_list, coord_list, mask_coords_list):
+        blend_mask,row = get_blend_material(mask, face_box, crop_box)
+        blend_masks.append(blend_mask.reshape(-1))
+        geometry.append(row)
+    return np.concatenate(blend_masks),np.asarray(geometry, dtype=np.int32)
+
+def build_blend_bodies(frames, geometry, out_path=None):
+    '''flat uint8 face box crops (h,w,3) of all frames, written to the .npy out_path if given'''
+    geometry = np.asarray(geometry)
+    sizes = geometry[:,8].astype(np.int64)*geometry[:,9]*3
+    total = int(sizes.sum())
+    if out_path:
+        bodies = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.uint8, shape=(total,))
+    else:
+        bodies = np.empty(total, dtype=np.uint8)
+    offset = 0
+    for idx,(row,size) in enumerate(zip(geometry,sizes)):
+        if size:
+            x, y, x1, y1 = (int(v) for v in row[:4])
+            bodies[offset:offset+size] = np.asarray(frames[idx][y:y1, x:x1]).reshape(-1)
+        offset += size
+    if out_path:
+        bodies.flush()
+    return bodies
+
+def _box_views(data, geometry, channels):
+    sizes = geometry[:,8].astype(np.int64)*geometry[:,9]*channels
+    index = np.zeros((len(geometry),4), dtype=np.int64)
+    index[1:,0] = np.cumsum(sizes)[:-1]
+    index[:,1] = geometry[:,9]
+    index[:,2] = geometry[:,8]
+    index[:,3] = channels
+    return PackedFrames(data, index)
+
+def blend_mask_views(blend_masks, geometry):
+    '''(h,w,1) view of the blend mask of every frame'''
+    return _box_views(blend_masks, geometry, 1)
+
+def blend_body_views(blend_bodies, geometry):
+    '''(h,w,3) view of the face box of every frame'''
+    return _box_views(blend_bodies, geometry, 3)
+
+
+def pack_path_of(avatar_path):
+    return os.path.join(avatar_path, PACK_DIR)
+
+def is_packed(avatar_path):
+    '''a pack exists, has the current version and is newer than the regenerated source assets'''
+    meta_path = os.path.join(pack_path_of(avatar_path), 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as f:
+        if json.load(f).get('version')!=PACK_VERSION:
+            return False
+    coords_path = os.path.join(avatar_path, 'coords.pkl')
+    return not os.path.exists(coords_path) or os.path.getmtime(coords_path)<=os.path.getmtime(meta_path)
+
+def _install_pack(tmp_path, pack_path):
+    '''
+    swap tmp_path in as pack_path. files of the old pack are unlinked, not rewritten:
+    sessions and processes that still map them keep reading the old pages
+    '''
+    for _ in range(10):
+        try:
+            os.rename(tmp_path, pack_path)
+            return
+        except OSError:
+            if not os.path.exists(pack_path):
+                raise
+        old_path = f'{pack_path}.old.{os.getpid()}'
+        try:
+            os.rename(pack_path, old_path)
+        except FileNotFoundError: #moved aside by a concurrent pack
+            continue
+        shutil.rmtree(old_path, ignore_errors=True)
+    raise OSError(f'can not install {tmp_path} as {pack_path}')
+
+def pack_avatar(avatar_path):
+    '''
+    pack the png/pkl/pt assets found in avatar_path into a private temp directory that
+    replaces packed/ when complete, so concurrent packs never write the same files
+    '''
+    pack_path = pack_path_of(avatar_path)
+    tmp_path = f'{pack_path}.tmp.{os.getpid()}.{os.urandom(4).hex()}'
+    os.makedirs(tmp_path)
+    try:
+        meta = _pack_assets(avatar_path, tmp_path)
+        _install_pack(tmp_path, pack_path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    logger.info('packed avatar %s: %s', avatar_path, meta['assets'])
+    return meta
+
+def _pack_assets(avatar_path, pack_path):
+    meta_path = os.path.join(pack_path, 'meta.json')
+    meta = {'version':PACK_VERSION,'assets':{}}
+    for kind in IMAGE_KINDS:
+        img_list = _sorted_imgs(os.path.join(avatar_path, kind))
+        if not img_list:
+            continue
+        logger.info('packing %s %s...', avatar_path, kind)
+        _pack_images(img_list, os.path.join(pack_path, kind), mark=(kind=='full_imgs'))
+        meta['assets'][kind] = len(img_list)
+    for kind in COORD_KINDS:
+        coords_path = os.path.join(avatar_path, f'{kind}.pkl')
+        if not os.path.exists(coords_path):
+            continue
+        with open(coords_path, 'rb') as f:
+            coords = pickle.load(f)
+        np.save(os.path.join(pack_path, f'{kind}.npy'), np.asarray(coords, dtype=np.int64).reshape(len(coords),4))
+        meta['assets'][kind] = len(coords)
+    if os.path.exists(os.path.join(avatar_path, BLEND_GEOMETRY)):
+        #emitted by the avatar build step
+        for name in (BLEND_MASKS,BLEND_GEOMETRY):
+            shutil.copyfile(os.path.join(avatar_path, name), os.path.join(pack_path, name))
+        meta['assets']['blend'] = len(np.load(os.path.join(pack_path, BLEND_GEOMETRY)))
+    elif 'mask' in meta['assets'] and 'mask_coords' in meta['assets']:
+        logger.info('building blend material of %s...', avatar_path)
+        avatar = PackedAvatar(avatar_path, meta, pack_path)
+        blend_masks,geometry = build_blend_material(avatar.images('mask'), avatar.coords('coords'), avatar.coords('mask_coords'))
+        np.save(os.path.join(pack_path, BLEND_MASKS), blend_masks)
+        np.save(os.path.join(pack_path, BLEND_GEOMETRY), geometry)
+        meta['assets']['blend'] = len(geometry)
+    if 'blend' in meta['assets']:
+        if 'full_imgs' not in meta['assets']:
+            del meta['assets']['blend']
+        else:
+            logger.info('cutting blend face boxes of %s...', avatar_path)
+            avatar = PackedAvatar(avatar_path, meta, pack_path)
+            build_blend_bodies(avatar.images('full_imgs'), np.load(os.path.join(pack_path, BLEND_GEOMETRY)),
+                               os.path.join(pack_path, BLEND_BODIES))
+    latents_path = os.path.join(avatar_path, 'latents.pt')
+    if os.path.exists(latents_path):
+        import torch
+        latents = torch.stack([latent.cpu() for latent in torch.load(latents_path)])
+        np.save(os.path.join(pack_path, 'latents.npy'), latents.numpy())
+        meta['assets']['latents'] = len(latents)
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+class PackedAvatar:
+    '''read-only view of a packed avatar, every asset is memory mapped on first access'''
+    def __init__(self, avatar_path, meta=None, pack_path=None):
+        self.pack_path = pack_path or pack_path_of(avatar_path)
+        if meta is None:
+            with open(os.path.join(self.pack_path, 'meta.json')) as f:
+                meta = json.load(f)
+        self.meta = meta
+
+    def __contains__(self, kind):
+        return kind in self.meta['assets']
+
+    def images(self, kind):
+        return _load_images(self.pack_path, kind)
+
+    def coords(self, kind):
+        coords = np.load(os.path.join(self.pack_path, f'{kind}.npy'))
+        return [tuple(int(v) for v in row) for row in coords]
+
+    def latents(self):
+        return np.load(os.path.join(self.pack_path, 'latents.npy'), mmap_mode='r')
+
+    def blend(self):
+        '''(blend mask views, face box views, geometry) of a musetalk avatar, memory mapped'''
+        blend_masks = np.load(os.path.join(self.pack_path, BLEND_MASKS), mmap_mode='r')
+        blend_bodies = np.load(os.path.join(self.pack_path, BLEND_BODIES), mmap_mode='r')
+        geometry = np.load(os.path.join(self.pack_path, BLEND_GEOMETRY))
+        return blend_mask_views(blend_masks, geometry),blend_body_views(blend_bodies, geometry),geometry
+
+def open_packed(avatar_path):
+    '''packed view of avatar_path, the avatar is packed on its first load'''
+    if not is_packed(avatar_path):
+        pack_avatar(avatar_path)
+    return PackedAvatar(avatar_path)
+
+def open_avatar(avatar_path):
+    '''the single file package (avatarpack) if there is a current one, else the packed view'''
+    import avatarpack
+    pack_file = avatarpack.pack_file_of(avatar_path)
+    coords_path = os.path.join(avatar_path, 'coords.pkl')
+    if avatarpack.is_valid(pack_file) and \
+       (not os.path.exists(coords_path) or os.path.getmtime(coords_path)<=os.path.getmtime(pack_file)):
+        return avatarpack.AvatarPack(pack_file)
+    return open_packed(avatar_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--avatar_id', type=str, nargs='+', required=True, help="avatars in data/avatars to pack")
+    parser.add_argument('--force', type=int, default=0, help="repack even if the avatar is already packed")
+    args = parser.parse_args()
+    for avatar_id in args.avatar_id:
+        avatar_path = f"./data/avatars/{avatar_id}"
+        if args.force or not is_packed(avatar_path):
+            pack_avatar(avatar_path)
+        else:
+            logger.info('avatar %s already packed', avatar_id)
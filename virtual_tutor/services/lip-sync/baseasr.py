@@ -18,11 +18,13 @@
 import time
 import numpy as np
 
-import queue
 from queue import Queue
-import torch.multiprocessing as mp
 
 from basereal import BaseReal
+from audioring import AudioFifo,AudioRing
+
+#batches of audio in flight after the asr step: feat_queue(2), inference(1), res_frame_queue(2), process_frames(1), margin
+AUDIO_RING_BATCHES = 8
 
 
 class BaseASR:
@@ -33,53 +35,73 @@ class BaseASR:
         self.fps = opt.fps # 20 ms per frame
         self.sample_rate = 16000
         self.chunk = self.sample_rate // self.fps # 320 samples per chunk (20ms * 16000 / 1000)
-        self.queue = Queue()
-        self.output_queue = mp.Queue()
+        self.queue = AudioFifo(self.chunk,self.fps*10) #10s of audio, beyond that put blocks the tts thread
 
         self.batch_size = opt.batch_size
 
-        self.frames = []
         self.stride_left_size = opt.l
         self.stride_right_size = opt.r
+        #audio stream read in place by the asr window and by inference
+        self.ring = AudioRing(self.chunk,self.stride_left_size+self.stride_right_size+AUDIO_RING_BATCHES*self.batch_size*2)
+        self.out_index = 0 #next frame handed to inference
+        self.generation = 0 #bumped by flush_talk, frames of older generations are stale
+        self.silence = np.zeros(self.chunk, dtype=np.float32)
         #self.context_size = 10
-        self.feat_queue = mp.Queue(2)
+        #in process handoff: the features are views of a reused chunk ring, an mp.Queue pickles them later in its feeder thread
+        self.feat_queue = Queue(2)
 
         #self.warm_up()
 
     def flush_talk(self):
-        self.queue.queue.clear()
+        self.generation += 1
+        self.queue.clear()
+
+    def drop_stale(self,frames):
+        '''speech frames of an interrupted utterance become silence'''
+        return [(self.silence,1,None,self.generation) if frame[1]==0 and frame[3]!=self.generation else frame
+                for frame in frames]
 
     def put_audio_frame(self,audio_chunk,eventpoint=None): #16khz 20ms pcm
-        self.queue.put((audio_chunk,eventpoint))
+        self.queue.put(audio_chunk,eventpoint,self.generation)
 
     #return frame:audio pcm; type: 0-normal speak, 1-silence; eventpoint:custom event sync with audio
+    #the frame is appended to self.ring and returned as a view of it
     def get_audio_frame(self):        
-        try:
-            frame,eventpoint = self.queue.get(block=True,timeout=0.01)
+        frame = self.ring.next_slot()
+        generation = self.generation
+        ok,eventpoint = self.queue.get_into(frame,generation) #paced by the media clock of render, no polling
+        if ok:
             type = 0
-            #print(f'[INFO] get frame {frame.shape}')
-        except queue.Empty:
-            if self.parent and self.parent.curr_state>1: #播放自定义音频
-                frame = self.parent.get_audio_stream(self.parent.curr_state)
-                type = self.parent.curr_state
-            else:
-                frame = np.zeros(self.chunk, dtype=np.float32)
-                type = 1
-            eventpoint = None
-
+        elif self.parent and self.parent.curr_state>1: #播放自定义音频
+            stream = self.parent.get_audio_stream(self.parent.curr_state)
+            frame[:len(stream)] = stream
+            frame[len(stream):] = 0
+            type = self.parent.curr_state
+        else:
+            frame[:] = 0
+            type = 1
+        self.ring.commit(type,eventpoint,generation)
         return frame,type,eventpoint 
 
-    #return frame:audio pcm; type: 0-normal speak, 1-silence; eventpoint:custom event sync with audio
-    def get_audio_out(self): 
-        return self.output_queue.get()
+    #return n (frame,type,eventpoint,generation) of the audio stream, in order, frames are views of self.ring
+    #speech interrupted since the asr step is returned as silence, so it is not sent to inference
+    def get_audio_out(self,n=1): 
+        frames = [self.ring.item(self.out_index+i) for i in range(n)]
+        self.out_index += n
+        return self.drop_stale(frames)
+
+    def get_window(self):
+        '''pcm of the frames of the current feature window: stride_left + new + stride_right'''
+        n = self.window_frames()
+        return self.ring.window(self.ring.count-n,n)
+
+    def window_frames(self):
+        return min(self.ring.count,self.stride_left_size+self.stride_right_size+self.batch_size*2)
     
     def warm_up(self):
         for _ in range(self.stride_left_size + self.stride_right_size):
-            audio_frame,type,eventpoint=self.get_audio_frame()
-            self.frames.append(audio_frame)
-            self.output_queue.put((audio_frame,type,eventpoint))
-        for _ in range(self.stride_left_size):
-            self.output_queue.get()
+            self.get_audio_frame()
+        self.out_index = self.stride_left_size
 
     def run_step(self):
         pass
@@ -19,7 +19,6 @@ import math
 import torch
 import numpy as np
 
-import subprocess
 import os
 import time
 import cv2
@@ -28,17 +27,20 @@ import resampy
 
 import queue
 from queue import Queue
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 from io import BytesIO
 import soundfile as sf
 
 import asyncio
+import concurrent.futures
 from av import AudioFrame, VideoFrame
 
 import av
 from fractions import Fraction
 
 from ttsreal import EdgeTTS,SovitsTTS,XTTS,CosyVoiceTTS,FishTTS,TencentTTS
+from mediaclock import MediaClock
+from recorder import SessionRecorder
 from logger import logger
 
 from tqdm import tqdm
@@ -50,6 +52,18 @@ def read_imgs(img_list):
         frames.append(frame)
     return frames
 
+def drain_queue(q:asyncio.Queue):
+    '''drop what is waiting in an asyncio queue, run on its event loop'''
+    while True:
+        try:
+            q.get_nowait()
+        except asyncio.QueueEmpty:
+            break
+
+def get_speaking_flags(audio_frames,batch_size):
+    #每个视频帧对应两帧音频，两帧都不是说话时该视频帧不需要推理
+    return [not (audio_frames[i*2][1]!=0 and audio_frames[i*2+1][1]!=0) for i in range(batch_size)]
+
 def play_audio(quit_event,queue):        
     import pyaudio
     p = pyaudio.PyAudio()
@@ -88,11 +102,23 @@ class BaseReal:
             self.tts = TencentTTS(opt,self)
         
         self.speaking = False
+        #render sends a batch when the produced video is about to run out, 2 batches ahead
+        self.clock = MediaClock(25,lead=2*opt.batch_size/25)
+        self._video_track = None
+        self._audio_track = None
+        self._loop = None
+        self._interrupt_time = None #flush_talk not yet followed by a silent frame
+        self.interrupt_stats = {'interrupts':0,'interrupt_latency_ms':0.0,'interrupt_latency_max_ms':0.0}
+        self.infer_scheduler = None #set by app when the sessions share one inference thread
+        self.infer_stats = {'infer_frames':0,'skip_frames':0,'idle_cache_hits':0}
+        self._frame_buffer = None
+        self._idle_frames = {} #idx:yuv420p VideoFrame of the silent loop
+        self._idle_cache_bytes = 0
+        self._idle_cache_lock = Lock()
+        self._idle_cache_budget = opt.idle_cache_mb*1024*1024
 
         self.recording = False
-        self._record_video_pipe = None
-        self._record_audio_pipe = None
-        self.width = self.height = 0
+        self.recorder = None #SessionRecorder of the current or last recording
 
         self.curr_state=0
         self.custom_img_cycle = {}
@@ -135,11 +161,123 @@ class BaseReal:
         return stream
 
     def flush_talk(self):
-        self.tts.flush_talk()
-        self.asr.flush_talk()
+        '''barge-in: cancel the utterance in every stage, the next frame sent is silent'''
+        self._interrupt_time = time.perf_counter()
+        self.interrupt_stats['interrupts'] += 1
+        self.tts.flush_talk() #cancels synthesis, aborts the http streams
+        self.asr.flush_talk() #new generation: queued features and rendered frames of the utterance turn silent
+        if self._loop is not None and self._video_track is not None:
+            #frames already waiting in the webrtc tracks
+            for track in (self._video_track,self._audio_track):
+                self._loop.call_soon_threadsafe(drain_queue,track._queue)
 
     def is_speaking(self)->bool:
         return self.speaking
+
+    def get_stats(self)->dict:
+        stats = dict(self.infer_stats)
+        stats['idle_cache_frames'] = len(self._idle_frames)
+        #queue depths along tts -> asr -> inference -> process_frames -> track
+        stats['asr_queue'] = self.asr.queue.qsize()
+        stats['feat_queue'] = self.asr.feat_queue.qsize()
+        stats['res_frame_queue'] = self.res_frame_queue.qsize()
+        if self._video_track is not None:
+            stats['video_queue'] = self._video_track._queue.qsize()
+            stats['audio_queue'] = self._audio_track._queue.qsize()
+        stats.update(self.clock.get_stats())
+        stats.update(self.tts.get_stats())
+        stats.update(self.interrupt_stats)
+        if self.recorder is not None:
+            stats.update(self.recorder.get_stats())
+        if hasattr(self.frame_list_cycle,'get_stats'):  #lazily decoded avatar frames
+            stats.update(self.frame_list_cycle.get_stats())
+        return stats
+
+    def put_track_frame(self,track,item,loop,quit_event):
+        '''put into the bounded queue of a webrtc track, blocks while the track is full'''
+        future = asyncio.run_coroutine_threadsafe(track._queue.put(item), loop)
+        while not quit_event.is_set():
+            try:
+                future.result(timeout=1)
+                return
+            except concurrent.futures.TimeoutError:
+                continue
+        future.cancel()
+
+    def finish_infer(self,res_frames,indices):
+        '''per session post processing of the frames of a shared batch, indices are their avatar frames'''
+        return res_frames
+
+    def copy_frame(self,idx:int):
+        '''copy of avatar frame idx into a buffer reused by the next call, no new allocation per frame'''
+        frame = self.frame_list_cycle[idx]
+        if self._frame_buffer is None or self._frame_buffer.shape!=frame.shape:
+            self._frame_buffer = np.empty_like(frame)
+        np.copyto(self._frame_buffer,frame)
+        return self._frame_buffer
+
+    def get_idle_frame(self,idx:int,count_hit=True,frames=None)->VideoFrame:
+        '''avatar frame idx as the yuv420p frame the encoder takes as is, converted once'''
+        new_frame = self._idle_frames.get(idx)
+        if new_frame is not None:
+            if count_hit:
+                self.infer_stats['idle_cache_hits'] += 1
+            return new_frame
+        image = (self.frame_list_cycle if frames is None else frames)[idx]
+        if image.flags.writeable:  #packed avatar frames are read-only and already marked
+            image[0,:] &= 0xFE
+        new_frame = VideoFrame.from_ndarray(image, format="bgr24")
+        if image.shape[0]%2==0 and image.shape[1]%2==0:
+            new_frame = new_frame.reformat(format="yuv420p")
+        nbytes = image.shape[0]*image.shape[1]*3//2
+        with self._idle_cache_lock:
+            if idx not in self._idle_frames and self._idle_cache_bytes+nbytes <= self._idle_cache_budget:
+                self._idle_frames[idx] = new_frame
+                self._idle_cache_bytes += nbytes
+        return new_frame
+
+    def warm_idle_cache(self,quit_event):
+        '''convert the silent loop ahead of time, within the cache budget'''
+        t = time.perf_counter()
+        frames = self.frame_list_cycle
+        if hasattr(frames,'reader'):  #lazily decoded avatar: do not steer the prefetch or flush its cache
+            frames = frames.reader(prefetch=False,cache=False)
+        for idx in range(len(frames)):
+            if quit_event.is_set() or self._idle_cache_bytes >= self._idle_cache_budget:
+                break
+            self.get_idle_frame(idx,count_hit=False,frames=frames)
+        logger.info('idle cache: %d frames in %.2fs',len(self._idle_frames),time.perf_counter()-t)
+
+    def face_box(self,idx:int):
+        '''(x1,y1,x2,y2) of the region paste_back_frame changes in avatar frame idx, None if unknown'''
+        return None
+
+    def speaking_frame(self,image,idx:int)->VideoFrame:
+        '''
+        yuv420p frame of a speaking frame: the converted idle frame with only the pasted
+        face box converted from bgr, instead of converting the whole image for the encoder
+        '''
+        box = self.face_box(idx)
+        idle_frame = self._idle_frames.get(idx)
+        if box is None or idle_frame is None or idle_frame.format.name!='yuv420p':
+            return VideoFrame.from_ndarray(image, format="bgr24")
+        h,w = image.shape[:2]
+        x1,y1,x2,y2 = box
+        #chroma is subsampled 2x2: even aligned box
+        x1,y1 = max(x1,0)&~1,max(y1,0)&~1
+        x2,y2 = min((x2+1)&~1,w),min((y2+1)&~1,h)
+        if x2<=x1 or y2<=y1:
+            return idle_frame
+        yuv = idle_frame.to_ndarray() #(h*3/2,w) copy of the idle frame
+        roi = cv2.cvtColor(np.ascontiguousarray(image[y1:y2,x1:x2]),cv2.COLOR_BGR2YUV_I420).reshape(-1)
+        rh,rw = y2-y1,x2-x1
+        flat = yuv.reshape(-1)
+        yuv[:h].reshape(h,w)[y1:y2,x1:x2] = roi[:rh*rw].reshape(rh,rw)
+        for plane in range(2): #u,v
+            dst = flat[h*w+plane*(h*w//4):h*w+(plane+1)*(h*w//4)].reshape(h//2,w//2)
+            src = roi[rh*rw+plane*(rh*rw//4):rh*rw+(plane+1)*(rh*rw//4)].reshape(rh//2,rw//2)
+            dst[y1//2:y2//2,x1//2:x2//2] = src
+        return VideoFrame.from_ndarray(yuv, format="yuv420p")
     
     def __loadcustom(self):
         for item in self.opt.customopt:
@@ -166,104 +304,27 @@ class BaseReal:
         """开始录制视频"""
         if self.recording:
             return
-
-        command = ['ffmpeg',
-                    '-y', '-an',
-                    '-f', 'rawvideo',
-                    '-vcodec','rawvideo',
-                    '-pix_fmt', 'bgr24', #像素格式
-                    '-s', "{}x{}".format(self.width, self.height),
-                    '-r', str(25),
-                    '-i', '-',
-                    '-pix_fmt', 'yuv420p', 
-                    '-vcodec', "h264",
-                    #'-f' , 'flv',                  
-                    f'temp{self.opt.sessionid}.mp4']
-        self._record_video_pipe = subprocess.Popen(command, shell=False, stdin=subprocess.PIPE)
-
-        acommand = ['ffmpeg',
-                    '-y', '-vn',
-                    '-f', 's16le',
-                    #'-acodec','pcm_s16le',
-                    '-ac', '1',
-                    '-ar', '16000',
-                    '-i', '-',
-                    '-acodec', 'aac',
-                    #'-f' , 'wav',                  
-                    f'temp{self.opt.sessionid}.aac']
-        self._record_audio_pipe = subprocess.Popen(acommand, shell=False, stdin=subprocess.PIPE)
-
+        height,width = self.frame_list_cycle[0].shape[:2]
+        path = os.path.join(self.opt.record_dir,f'{self.opt.sessionid}_{time.strftime("%Y%m%d_%H%M%S")}.mp4')
+        self.recorder = SessionRecorder(path,width,height,fps=25,sample_rate=16000)
+        self.recorder.start()
         self.recording = True
-        # self.recordq_video.queue.clear()
-        # self.recordq_audio.queue.clear()
-        # self.container = av.open(path, mode="w")
-    
-        # process_thread = Thread(target=self.record_frame, args=())
-        # process_thread.start()
-    
+        logger.info('start recording %s',path)
+
     def record_video_data(self,image):
-        if self.width == 0:
-            print("image.shape:",image.shape)
-            self.height,self.width,_ = image.shape
         if self.recording:
-            self._record_video_pipe.stdin.write(image.tostring())
+            self.recorder.put_video(image)
 
     def record_audio_data(self,frame):
         if self.recording:
-            self._record_audio_pipe.stdin.write(frame.tostring())
-    
-    # def record_frame(self): 
-    #     videostream = self.container.add_stream("libx264", rate=25)
-    #     videostream.codec_context.time_base = Fraction(1, 25)
-    #     audiostream = self.container.add_stream("aac")
-    #     audiostream.codec_context.time_base = Fraction(1, 16000)
-    #     init = True
-    #     framenum = 0       
-    #     while self.recording:
-    #         try:
-    #             videoframe = self.recordq_video.get(block=True, timeout=1)
-    #             videoframe.pts = framenum #int(round(framenum*0.04 / videostream.codec_context.time_base))
-    #             videoframe.dts = videoframe.pts
-    #             if init:
-    #                 videostream.width = videoframe.width
-    #                 videostream.height = videoframe.height
-    #                 init = False
-    #             for packet in videostream.encode(videoframe):
-    #                 self.container.mux(packet)
-    #             for k in range(2):
-    #                 audioframe = self.recordq_audio.get(block=True, timeout=1)
-    #                 audioframe.pts = int(round((framenum*2+k)*0.02 / audiostream.codec_context.time_base))
-    #                 audioframe.dts = audioframe.pts
-    #                 for packet in audiostream.encode(audioframe):
-    #                     self.container.mux(packet)
-    #             framenum += 1
-    #         except queue.Empty:
-    #             print('record queue empty,')
-    #             continue
-    #         except Exception as e:
-    #             print(e)
-    #             #break
-    #     for packet in videostream.encode(None):
-    #         self.container.mux(packet)
-    #     for packet in audiostream.encode(None):
-    #         self.container.mux(packet)
-    #     self.container.close()
-    #     self.recordq_video.queue.clear()
-    #     self.recordq_audio.queue.clear()
-    #     print('record thread stop')
-		
+            self.recorder.put_audio(frame)
+
     def stop_recording(self):
-        """停止录制视频"""
+        """停止录制视频, 返回录像文件路径"""
         if not self.recording:
-            return
-        self.recording = False 
-        self._record_video_pipe.stdin.close()  #wait() 
-        self._record_video_pipe.wait()
-        self._record_audio_pipe.stdin.close()
-        self._record_audio_pipe.wait()
-        cmd_combine_audio = f"ffmpeg -y -i temp{self.opt.sessionid}.aac -i temp{self.opt.sessionid}.mp4 -c:v copy -c:a copy data/record.mp4"
-        os.system(cmd_combine_audio) 
-        #os.remove(output_path)
+            return None
+        self.recording = False
+        return self.recorder.stop()
 
     def mirror_index(self,size, index):
         #size = len(self.coord_list_cycle)
@@ -290,6 +351,8 @@ class BaseReal:
             self.custom_index[audiotype] = 0
 
     def process_frames(self,quit_event,loop=None,audio_track=None,video_track=None):
+        if hasattr(self.frame_list_cycle,'reader'):  #own playback position over the lazily decoded avatar frames
+            self.frame_list_cycle = self.frame_list_cycle.reader()
         enable_transition = False  # 设置为False禁用过渡效果，True启用
         
         if enable_transition:
@@ -306,12 +369,20 @@ class BaseReal:
             audio_tmp = queue.Queue(maxsize=3000)
             audio_thread = Thread(target=play_audio, args=(quit_event,audio_tmp,), daemon=True, name="pyaudio_stream")
             audio_thread.start()
+        else:
+            self._loop = loop
+            self._video_track = video_track
+            self._audio_track = audio_track
+            Thread(target=self.warm_idle_cache, args=(quit_event,), daemon=True, name="idle_cache").start()
         
         while not quit_event.is_set():
             try:
                 res_frame,idx,audio_frames = self.res_frame_queue.get(block=True, timeout=1)
             except queue.Empty:
                 continue
+            audio_frames = self.asr.drop_stale(audio_frames)
+            if res_frame is not None and audio_frames[0][1]!=0 and audio_frames[1][1]!=0:
+                res_frame = None #rendered for an interrupted utterance
             
             if enable_transition:
                 # 检测状态变化
@@ -321,6 +392,8 @@ class BaseReal:
                     _transition_start = time.time()
                 _last_speaking = current_speaking
 
+            idle_frame = None
+            pasted = False #combine_frame is frame idx with only the face box changed
             if audio_frames[0][1]!=0 and audio_frames[1][1]!=0: #全为静音数据，只需要取fullimg
                 self.speaking = False
                 audiotype = audio_frames[0][1]
@@ -330,6 +403,8 @@ class BaseReal:
                     self.custom_index[audiotype] += 1
                 else:
                     target_frame = self.frame_list_cycle[idx]
+                    if not enable_transition and self.opt.transport!='virtualcam':
+                        idle_frame = self.get_idle_frame(idx)
                 
                 if enable_transition:
                     # 说话→静音过渡
@@ -360,21 +435,35 @@ class BaseReal:
                     _last_speaking_frame = combine_frame.copy()
                 else:
                     combine_frame = current_frame
+                    pasted = True
 
             if self.opt.transport=='virtualcam':
                 if vircam==None:
                     height, width,_= combine_frame.shape
                     vircam = pyvirtualcam.Camera(width=width, height=height, fps=25, fmt=pyvirtualcam.PixelFormat.BGR,print_fps=True)
                 vircam.send(combine_frame)
+            elif idle_frame is not None: #webrtc, silent loop frame already converted
+                self.put_track_frame(video_track,(idle_frame,None),loop,quit_event)
             else: #webrtc
                 image = combine_frame
-                image[0,:] &= 0xFE
-                new_frame = VideoFrame.from_ndarray(image, format="bgr24")
-                asyncio.run_coroutine_threadsafe(video_track._queue.put((new_frame,None)), loop)
+                if image.flags.writeable:
+                    image[0,:] &= 0xFE
+                if pasted:
+                    new_frame = self.speaking_frame(image,idx)
+                else:
+                    new_frame = VideoFrame.from_ndarray(image, format="bgr24")
+                self.put_track_frame(video_track,(new_frame,None),loop,quit_event)
             self.record_video_data(combine_frame)
 
+            if self._interrupt_time is not None and audio_frames[0][1]!=0:
+                latency = (time.perf_counter()-self._interrupt_time)*1000
+                self._interrupt_time = None
+                self.interrupt_stats['interrupt_latency_ms'] = round(latency,1)
+                self.interrupt_stats['interrupt_latency_max_ms'] = max(self.interrupt_stats['interrupt_latency_max_ms'],round(latency,1))
+                logger.info('interrupt to silence: %.1fms',latency)
+
             for audio_frame in audio_frames:
-                frame,type,eventpoint = audio_frame
+                frame,type,eventpoint,_ = audio_frame
                 frame = (frame * 32767).astype(np.int16)
 
                 if self.opt.transport=='virtualcam':
@@ -383,7 +472,7 @@ class BaseReal:
                     new_frame = AudioFrame(format='s16', layout='mono', samples=frame.shape[0])
                     new_frame.planes[0].update(frame.tobytes())
                     new_frame.sample_rate=16000
-                    asyncio.run_coroutine_threadsafe(audio_track._queue.put((new_frame,eventpoint)), loop)
+                    self.put_track_frame(audio_track,(new_frame,eventpoint),loop,quit_event)
                 self.record_audio_data(frame)
             if self.opt.transport=='virtualcam':
                 vircam.sleep_until_next_frame()
@@ -0,0 +1,314 @@
+"""
+blur_engine.py
+
+流式人像抠图引擎: ffmpeg 解码 → 批量分割 → 合成 → ffmpeg 编码, 四个线程流水线并行。
+帧缓冲预先分配, 在线程之间循环使用; 分割可以每 mask_interval 帧做一次,
+中间帧的 mask 由前后两个关键帧线性插值。
+"""
+
+import json
+import queue
+import subprocess
+import threading
+import time
+
+import cv2 as cv
+import numpy as np
+
+FFMPEG = "/usr/bin/ffmpeg"
+FFPROBE = "/usr/bin/ffprobe"
+
+
+# ---------- 分割模型 ----------
+class Segmenter:
+    """PPHumanSeg, runtime 'cv' (cv.dnn) 或 'ort' (onnxruntime), threads=0 使用默认线程数"""
+
+    def __init__(self, model_path, runtime="cv", threads=0):
+        self.runtime = runtime
+        if runtime == "ort":
+            import onnxruntime as ort
+            opts = ort.SessionOptions()
+            if threads > 0:
+                opts.intra_op_num_threads = threads
+                opts.inter_op_num_threads = 1
+            self.sess = ort.InferenceSession(model_path, opts, providers=["CPUExecutionProvider"])
+            inp = self.sess.get_inputs()[0]
+            self.input_name = inp.name
+            self.batched = not isinstance(inp.shape[0], int) or inp.shape[0] != 1  # 动态 batch
+        elif runtime == "cv":
+            if threads > 0:
+                cv.setNumThreads(threads)
+            self.net = cv.dnn.readNet(model_path)
+            self.batched = None  # 第一次调用时探测
+        else:
+            raise ValueError(f"未知 runtime: {runtime}")
+
+    def _forward(self, blob):
+        if self.runtime == "ort":
+            return self.sess.run(None, {self.input_name: blob})[0]
+        self.net.setInput(blob)
+        return self.net.forward()
+
+    def __call__(self, blob):
+        """blob: B×3×S×S RGB 0~1, 返回 B×S×S 背景概率"""
+        if len(blob) > 1 and self.batched is not False:
+            try:
+                out = self._forward(blob)
+                if len(out) == len(blob):
+                    self.batched = True
+                    return out[:, 0]
+            except Exception:
+                if self.batched:
+                    raise
+            self.batched = False  # 模型固定 batch=1
+        return np.concatenate([self._forward(blob[i:i + 1])[:, 0] for i in range(len(blob))])
+
+
+def probe(path):
+    """(w, h, fps) of the first video stream"""
+    cmd = [FFPROBE, "-v", "error", "-select_streams", "v:0",
+           "-show_entries", "stream=width,height,avg_frame_rate,r_frame_rate:stream_tags=rotate:stream_side_data=rotation",
+           "-of", "json", str(path)]
+    stream = json.loads(subprocess.run(cmd, capture_output=True, check=True).stdout)["streams"][0]
+    w, h = int(stream["width"]), int(stream["height"])
+    # ffmpeg 解码时按旋转信息自动旋转, 竖屏手机视频宽高互换
+    rotation = stream.get("tags", {}).get("rotate", 0)
+    for side_data in stream.get("side_data_list", []):
+        rotation = side_data.get("rotation", rotation)
+    if abs(int(float(rotation))) % 180 == 90:
+        w, h = h, w
+    fps = 0.0
+    for key in ("avg_frame_rate", "r_frame_rate"):
+        num, _, den = stream.get(key, "0/0").partition("/")
+        if float(den or 0) > 0 and float(num) > 0:
+            fps = float(num) / float(den)
+            break
+    return w, h, fps or 30.0
+
+
+def _read_exact(stream, view):
+    got = 0
+    while got < len(view):
+        n = stream.readinto(view[got:])
+        if not n:
+            return got
+        got += n
+    return got
+
+
+# ---------- 流水线 ----------
+class BGPipeline:
+    """
+    一个视频的处理过程。
+    decode → infer → composite → encode 各一个线程, 队列有界, 帧缓冲池固定大小:
+    解码线程拿不到空闲缓冲就等待, 整条流水线的内存不随视频长度增长。
+    """
+
+    def __init__(self, segmenter, inp, out, mode="blur", blur_kernel=101, bg_img=None,
+                 in_size=192, batch=8, mask_interval=1, blur_scale=1, preset="veryfast", crf=18):
+        self.seg = segmenter
+        self.inp, self.out = str(inp), str(out)
+        self.mode = mode
+        self.kernel = blur_kernel | 1
+        self.in_size = in_size
+        self.batch = max(1, batch)
+        self.interval = max(1, mask_interval)
+        self.blur_scale = max(1, blur_scale)
+        self.preset, self.crf = preset, crf
+        self.w, self.h, self.fps = probe(self.inp)
+        self.bg_img = cv.resize(bg_img, (self.w, self.h)) if bg_img is not None else None
+
+        # 一次推理覆盖 batch 个关键帧
+        self.chunk = self.batch * self.interval
+        depth = 2
+        self.q_infer = queue.Queue(maxsize=depth)                  # 帧块
+        self.q_comp = queue.Queue(maxsize=depth * self.chunk)      # (buf, 低分辨率 mask)
+        self.q_enc = queue.Queue(maxsize=depth * self.chunk)       # buf
+        npool = self.chunk * (2 * depth + 2) + self.interval
+        self.free = queue.Queue()
+        for _ in range(npool):
+            self.free.put(np.empty((self.h, self.w, 3), dtype=np.uint8))
+        self.blob = np.empty((self.batch, 3, in_size, in_size), dtype=np.float32)
+
+        self.error = None
+        self.stop = threading.Event()
+        self.frames = 0
+        self.busy = {"decode": 0.0, "infer": 0.0, "composite": 0.0, "encode": 0.0}
+        self.procs = []
+
+    # ---------- 线程 ----------
+    def _guard(self, fn):
+        def run():
+            try:
+                fn()
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+                self.stop.set()
+                for proc in self.procs:
+                    if proc.poll() is None:
+                        proc.kill()
+        return run
+
+    def _put(self, q, item):
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def _decode(self):
+        cmd = [FFMPEG, "-v", "error", "-i", self.inp, "-map", "0:v:0",
+               "-f", "rawvideo", "-pix_fmt", "bgr24", "-"]
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=0)
+        self.procs.append(proc)
+        nbytes = self.w * self.h * 3
+        chunk = []
+        while True:
+            buf = self._get(self.free)
+            if buf is None:
+                break
+            t = time.perf_counter()
+            got = _read_exact(proc.stdout, memoryview(buf).cast("B"))
+            self.busy["decode"] += time.perf_counter() - t
+            if got < nbytes:  # 结束
+                self.free.put(buf)
+                break
+            chunk.append(buf)
+            if len(chunk) == self.chunk:
+                self._put(self.q_infer, chunk)
+                chunk = []
+        if proc.wait() != 0 and not self.stop.is_set():
+            raise RuntimeError(f"ffmpeg 解码失败: {proc.returncode}")
+        if chunk:
+            self._put(self.q_infer, chunk)
+        self._put(self.q_infer, None)
+
+    def _segment(self, frames):
+        n = len(frames)
+        s = self.in_size
+        for i, frame in enumerate(frames):
+            small = cv.resize(frame, (s, s))
+            cv.cvtColor(small, cv.COLOR_BGR2RGB, dst=small)
+            np.multiply(small.transpose(2, 0, 1), 1 / 255.0, out=self.blob[i], casting="unsafe")
+        return self.seg(self.blob[:n])
+
+    def _infer(self):
+        index = 0
+        prev = None     # (帧号, mask) 上一个关键帧
+        waiting = []    # 等待下一个关键帧的中间帧
+        chunk = self._get(self.q_infer)
+        while chunk is not None:
+            nxt = self._get(self.q_infer)
+            last = nxt is None
+            t = time.perf_counter()
+            keys = [i for i in range(len(chunk)) if (index + i) % self.interval == 0]
+            if last and (not keys or keys[-1] != len(chunk) - 1):
+                keys.append(len(chunk) - 1)  # 最后一帧总是关键帧
+            masks = {}
+            for start in range(0, len(keys), self.batch):
+                part = keys[start:start + self.batch]
+                for i, mask in zip(part, self._segment([chunk[i] for i in part])):
+                    masks[i] = mask
+            self.busy["infer"] += time.perf_counter() - t
+            for i, buf in enumerate(chunk):
+                waiting.append((index + i, buf))
+                if i not in masks:
+                    continue
+                key = (index + i, masks[i])
+                for idx, wbuf in waiting:
+                    if idx == key[0] or prev is None:
+                        mask = key[1]
+                    else:
+                        a = (idx - prev[0]) / (key[0] - prev[0])
+                        mask = cv.addWeighted(prev[1], 1 - a, key[1], a, 0)
+                    if not self._put(self.q_comp, (wbuf, mask)):
+                        return
+                prev = key
+                waiting = []
+            index += len(chunk)
+            chunk = nxt
+        self._put(self.q_comp, None)
+
+    def _composite(self):
+        w, h = self.w, self.h
+        full = np.empty((h, w), dtype=np.float32)
+        alpha = np.empty((h, w), dtype=np.float32)
+        beta = np.empty((h, w), dtype=np.float32)
+        bg = np.empty((h, w, 3), dtype=np.uint8) if self.bg_img is None else self.bg_img
+        if self.blur_scale > 1:
+            sw, sh = max(1, w // self.blur_scale), max(1, h // self.blur_scale)
+            small = np.empty((sh, sw, 3), dtype=np.uint8)
+            skernel = max(3, (self.kernel // self.blur_scale) | 1)
+        while True:
+            item = self._get(self.q_comp)
+            if item is None:
+                break
+            t = time.perf_counter()
+            frame, mask = item
+            cv.resize(mask, (w, h), dst=full)            # 背景=1
+            np.subtract(1.0, full, out=full)             # 人物=1
+            cv.GaussianBlur(full, (15, 15), 0, dst=alpha)
+            np.subtract(1.0, alpha, out=beta)
+            if self.mode == "blur":
+                if self.blur_scale > 1:
+                    cv.resize(frame, (sw, sh), dst=small, interpolation=cv.INTER_AREA)
+                    cv.GaussianBlur(small, (skernel, skernel), 0, dst=small)
+                    cv.resize(small, (w, h), dst=bg, interpolation=cv.INTER_LINEAR)
+                else:
+                    cv.GaussianBlur(frame, (self.kernel, self.kernel), 0, dst=bg)
+            if self.mode == "blur" or self.bg_img is not None:
+                cv.blendLinear(frame, bg, alpha, beta, dst=frame)
+            self.busy["composite"] += time.perf_counter() - t
+            if not self._put(self.q_enc, frame):
+                return
+        self._put(self.q_enc, None)
+
+    def _encode(self):
+        cmd = [FFMPEG, "-v", "error", "-y",
+               "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{self.w}x{self.h}", "-r", f"{self.fps}", "-i", "-",
+               "-i", self.inp,
+               "-map", "0:v:0", "-map", "1:a:0?",
+               "-c:v", "libx264", "-preset", self.preset, "-crf", str(self.crf), "-pix_fmt", "yuv420p",
+               "-c:a", "copy", self.out]
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        self.procs.append(proc)
+        try:
+            while True:
+                frame = self._get(self.q_enc)
+                if frame is None:
+                    break
+                t = time.perf_counter()
+                proc.stdin.write(memoryview(frame).cast("B"))
+                self.busy["encode"] += time.perf_counter() - t
+                self.frames += 1
+                self.free.put(frame)
+        finally:
+            proc.stdin.close()
+        if proc.wait() != 0 and not self.stop.is_set():
+            raise RuntimeError(f"ffmpeg 编码失败: {proc.returncode}")
+
+    def run(self):
+        t = time.perf_counter()
+        threads = [threading.Thread(target=self._guard(fn), name=f"bg_{fn.__name__}", daemon=True)
+                   for fn in (self._decode, self._infer, self._composite, self._encode)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        if self.error is not None:
+            raise self.error
+        elapsed = time.perf_counter() - t
+        busy = ", ".join(f"{k} {v:.1f}s" for k, v in self.busy.items())
+        print(f"{self.inp}: {self.frames} 帧 {elapsed:.1f}s ({self.frames / max(elapsed, 1e-6):.1f} fps), {busy}")
+        return {"frames": self.frames, "seconds": round(elapsed, 2), **{k: round(v, 2) for k, v in self.busy.items()}}
@@ -77,12 +77,13 @@ class Result(BaseDoc):
 
 
 
-def convert_video_to_25fps(input_path):
+def convert_video_to_25fps(input_path, output_path=None):
     """
-    Convert video to 25fps and modify in place
+    Convert video to 25fps
     
     Args:
         input_path (str): input video file path
+        output_path (str): converted video path, data/video/temp.mp4 by default
     
     Returns:
         bool: whether conversion is successful
@@ -90,7 +91,7 @@ def convert_video_to_25fps(input_path):
     temp_path = None
     try:
         # Create temporary file path
-        temp_path = os.path.join(LIVEVIDEODIR, "temp.mp4")
+        temp_path = output_path or os.path.join(LIVEVIDEODIR, "temp.mp4")
 
         # Use ffmpeg to convert video to 25fps
         cmd = [
@@ -122,25 +123,26 @@ def convert_video_to_25fps(input_path):
         pass
         
 
-def burr_video(input_path):
+def burr_video(input_path, tag="burr"):
     """
     Function to blur video
     
     Args:
         input_path (str): input video file path
+        tag (str): prefix of the workspace files, unique per concurrent caller
     
     Returns:
         bool: whether blur processing is successful
     """
     try:
         # Copy input video to workspace
-        output_path = os.path.join(WORKSPACE, "burr_input.mp4")
+        output_path = os.path.join(WORKSPACE, f"{tag}_input.mp4")
         subprocess.run(["cp", input_path, output_path], check=True)
         print(f"Copied video file to workspace: {input_path} -> {output_path}")
         cli = Client(port=PORT)
         req = VideoBGTask(
-            input_video_path="burr_input.mp4",
-            output_video_path="burr_output.mp4",
+            input_video_path=f"{tag}_input.mp4",
+            output_video_path=f"{tag}_output.mp4",
             blur_background=True,
         )
         resp = cli.post(
@@ -152,7 +154,7 @@ def burr_video(input_path):
         # Check processing result
         if resp[0].result == "success":
             # Overwrite input video with output
-            burr_output_path = os.path.join(WORKSPACE, "burr_output.mp4")
+            burr_output_path = os.path.join(WORKSPACE, f"{tag}_output.mp4")
             subprocess.run(["cp", burr_output_path, input_path], check=True)
             print(f"Blur processing successful, original file overwritten: {input_path}")
             return True
@@ -167,8 +169,8 @@ def burr_video(input_path):
         return False
     finally:
         # Clean up temporary files in workspace
-        temp_input = os.path.join(WORKSPACE, "burr_input.mp4")
-        temp_output = os.path.join(WORKSPACE, "burr_output.mp4")
+        temp_input = os.path.join(WORKSPACE, f"{tag}_input.mp4")
+        temp_output = os.path.join(WORKSPACE, f"{tag}_output.mp4")
         for temp_file in [temp_input, temp_output]:
             if os.path.exists(temp_file):
                 try:
@@ -0,0 +1,193 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import time
+import queue
+from threading import Thread, Event, Lock
+
+import numpy as np
+import torch
+
+from basereal import get_speaking_flags
+from logger import logger
+
+
+def _concat(parts):
+    if torch.is_tensor(parts[0]):
+        return torch.cat(parts, dim=0)
+    return np.concatenate(parts, axis=0)
+
+
+class _SessionSlot:
+    '''scheduler side state of one registered session'''
+    def __init__(self, nerfreal):
+        self.nerfreal = nerfreal
+        self.index = 0
+        self.capacity = nerfreal.batch_size*2 #res_frame_queue maxsize
+        self.busy = False  #a batch of this session is waiting for the gpu
+        self.late = 0
+
+
+class _InferJob:
+    def __init__(self, slot, indices, speak_ids, audio_frames, inputs, deadline):
+        self.slot = slot
+        self.indices = indices
+        self.speak_ids = speak_ids #positions of the frames that go through the model
+        self.audio_frames = audio_frames
+        self.inputs = inputs
+        self.deadline = deadline
+
+
+class InferScheduler:
+    '''
+    One inference thread per process shared by all sessions.
+    Collects the pending feature batches of every registered session, runs them through
+    the shared model as one cross-session batch and scatters the frames back to the
+    res_frame_queue of each session. Batches are picked earliest-deadline-first, the
+    deadline being the moment the session's already rendered frames run out.
+    '''
+    def __init__(self, max_batch=64, max_wait=0.005, fps=25):
+        self.max_batch = max_batch
+        self.max_wait = max_wait  #time to wait for other sessions to fill the batch
+        self.frame_time = 1.0/fps
+        self._slots = {}  #sessionid:_SessionSlot
+        self._lock = Lock()
+        self._quit = Event()
+        self._thread = None
+
+    def register(self, nerfreal):
+        with self._lock:
+            self._slots[nerfreal.sessionid] = _SessionSlot(nerfreal)
+            if self._thread is None or not self._thread.is_alive():
+                self._quit.clear()
+                self._thread = Thread(target=self._run, name='infer_scheduler', daemon=True)
+                self._thread.start()
+        logger.info('infer scheduler register session %s', nerfreal.sessionid)
+
+    def unregister(self, nerfreal):
+        with self._lock:
+            slot = self._slots.pop(nerfreal.sessionid, None)
+        if slot is not None:
+            logger.info('infer scheduler unregister session %s, late batches:%d', nerfreal.sessionid, slot.late)
+
+    def stop(self):
+        self._quit.set()
+
+    def _collect(self, pending):
+        '''take at most one batch from every session that has room for its result'''
+        with self._lock:
+            slots = list(self._slots.values())
+        for slot in slots:
+            if slot.busy:
+                continue
+            nerfreal = slot.nerfreal
+            queued = nerfreal.res_frame_queue.qsize()
+            if queued + nerfreal.batch_size > slot.capacity:
+                continue
+            try:
+                feats = nerfreal.asr.feat_queue.get_nowait()
+            except queue.Empty:
+                continue
+            batch_size = nerfreal.batch_size
+            audio_frames = nerfreal.asr.get_audio_out(batch_size*2)
+            length = len(nerfreal.frame_list_cycle)
+            indices = [nerfreal.mirror_index(length, slot.index+i) for i in range(batch_size)]
+            slot.index += batch_size
+            speak_ids = [i for i,speaking in enumerate(get_speaking_flags(audio_frames,batch_size)) if speaking]
+            nerfreal.infer_stats['skip_frames'] += batch_size-len(speak_ids)
+            if not speak_ids:
+                for i in range(batch_size):
+                    nerfreal.res_frame_queue.put((None,indices[i],audio_frames[i*2:i*2+2]))
+                continue
+            inputs = nerfreal.prepare_infer([feats[i] for i in speak_ids], [indices[i] for i in speak_ids])
+            deadline = time.perf_counter() + queued*self.frame_time
+            slot.busy = True
+            pending.append(_InferJob(slot, indices, speak_ids, audio_frames, inputs, deadline))
+
+    def _scatter(self, job, res_frames):
+        nerfreal = job.slot.nerfreal
+        if time.perf_counter() > job.deadline:
+            job.slot.late += 1
+            logger.debug('session %s batch late %.3fs', nerfreal.sessionid, time.perf_counter()-job.deadline)
+        frames = [None]*len(job.indices)
+        if res_frames is not None:
+            try:
+                res_frames = nerfreal.finish_infer(res_frames,[job.indices[i] for i in job.speak_ids])
+            except Exception:
+                logger.exception('session %s finish infer failed:', nerfreal.sessionid)
+                res_frames = None
+        if res_frames is not None:
+            nerfreal.infer_stats['infer_frames'] += len(job.speak_ids)
+            for i,res_frame in zip(job.speak_ids,res_frames):
+                frames[i] = res_frame
+        for i,idx in enumerate(job.indices):
+            nerfreal.res_frame_queue.put((frames[i],idx,job.audio_frames[i*2:i*2+2]))
+        job.slot.busy = False
+
+    def _run(self):
+        pending = []
+        count = 0
+        counttime = 0
+        logger.info('start infer scheduler')
+        while not self._quit.is_set():
+            self._collect(pending)
+            if not pending:
+                time.sleep(0.002)
+                continue
+            pending.sort(key=lambda job: job.deadline)
+            nframes = sum(len(job.speak_ids) for job in pending)
+            if nframes < self.max_batch and pending[0].deadline - time.perf_counter() > 2*self.max_wait:
+                time.sleep(self.max_wait)
+                self._collect(pending)
+                pending.sort(key=lambda job: job.deadline)
+
+            #sessions of different models (e.g. ultralight avatars) can not share a batch
+            batch_key = pending[0].slot.nerfreal.batch_key
+            batch = []
+            nframes = 0
+            for job in pending:
+                if job.slot.nerfreal.batch_key is not batch_key:
+                    continue
+                if batch and nframes+len(job.speak_ids) > self.max_batch:
+                    break
+                batch.append(job)
+                nframes += len(job.speak_ids)
+            for job in batch:
+                pending.remove(job)
+
+            t = time.perf_counter()
+            try:
+                inputs = [_concat(list(parts)) for parts in zip(*[job.inputs for job in batch])]
+                res_frames = batch[0].slot.nerfreal.infer(*inputs)
+            except Exception:
+                logger.exception('infer scheduler batch failed:')
+                for job in batch:
+                    self._scatter(job, None)
+                continue
+            counttime += (time.perf_counter() - t)
+            count += nframes
+            if count>=100:
+                logger.info(f"------scheduler avg infer fps:{count/counttime:.4f}, sessions:{len(self._slots)}")
+                count = 0
+                counttime = 0
+
+            offset = 0
+            for job in batch:
+                n = len(job.speak_ids)
+                self._scatter(job, res_frames[offset:offset+n])
+                offset += n
+        logger.info('infer scheduler stop')
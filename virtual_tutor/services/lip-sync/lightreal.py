@@ -25,7 +25,6 @@ import time
 import cv2
 import glob
 import pickle
-import copy
 
 import queue
 from queue import Queue
@@ -36,7 +35,8 @@ import torch.multiprocessing as mp
 from hubertasr import HubertASR
 import asyncio
 from av import AudioFrame, VideoFrame
-from basereal import BaseReal
+from basereal import BaseReal,get_speaking_flags
+import avatarstore
 
 #from imgcache import ImgCache
 
@@ -70,7 +70,14 @@ def load_avatar(avatar_id):
     coords_path = f"{avatar_path}/coords.pkl" 
     
     model = Model(6, 'hubert').to(device)  # 假设Model是你自定义的类
-    model.load_state_dict(torch.load(f"{avatar_path}/ultralight.pth"))
+    model.load_state_dict(torch.load(f"{avatar_path}/ultralight.pth",map_location=device))
+
+    try:
+        avatar = avatarstore.open_avatar(avatar_path)  #memory mapped, shared by all sessions
+        face_list_cycle = avatar.images('face_imgs')
+        return model.eval(),avatar.images('full_imgs'),face_list_cycle,avatar.coords('coords'),load_face_tensors(face_list_cycle)
+    except Exception:
+        logger.exception('pack avatar failed, read images:')
     
     with open(coords_path, 'rb') as f:
         coord_list_cycle = pickle.load(f)
@@ -82,13 +89,24 @@ def load_avatar(avatar_id):
     input_face_list = sorted(input_face_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
     face_list_cycle = read_imgs(input_face_list)
 
-    return model.eval(),frame_list_cycle,face_list_cycle,coord_list_cycle
+    return model.eval(),frame_list_cycle,face_list_cycle,coord_list_cycle,load_face_tensors(face_list_cycle)
+
+def load_face_tensors(face_list_cycle):
+    '''
+    ultralight image input of every avatar frame, built once on the configured device:
+    (N,6,160,160) uint8, face crop + face crop with the mouth rectangle blacked out.
+    normalized when gathered.
+    '''
+    faces = torch.from_numpy(np.array(face_list_cycle)[:, 4:164, 4:164]).permute(0,3,1,2) #N,3,160,160
+    masked = faces.clone()
+    masked[:, :, 5:150, 5:155] = 0 #cv2.rectangle(img,(5,5,150,145),(0,0,0),-1)
+    return torch.cat((faces,masked),dim=1).contiguous().to(device)
 
 
 @torch.no_grad()
 def warm_up(batch_size,avatar,modelres):
     logger.info('warmup model...')
-    model,_,_,_ = avatar
+    model = avatar[0]
     img_batch = torch.ones(batch_size, 6, modelres, modelres).to(device)
     mel_batch = torch.ones(batch_size, 32, 32, 32).to(device)
     model(img_batch, mel_batch)
@@ -145,8 +163,20 @@ def __mirror_index(size, index):
         return size - res - 1 
 
 
-def inference(quit_event, batch_size, face_list_cycle, audio_feat_queue, audio_out_queue, res_frame_queue, model):
-    length = len(face_list_cycle)
+def prepare_batch(mel_batch, face_tensors, indices):
+    index = torch.as_tensor(indices, device=face_tensors.device)
+    img_batch = face_tensors.index_select(0, index) #B,6,160,160 uint8 on device
+    mel_batch = torch.from_numpy(np.asarray(mel_batch).reshape(len(mel_batch), 32, 32, 32))
+    return img_batch, mel_batch
+
+@torch.no_grad()
+def infer_batch(img_batch, mel_batch, model):
+    img_batch = img_batch.to(device).float().div_(255.)
+    pred = model(img_batch, mel_batch.to(device))
+    return pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+
+def inference(quit_event, batch_size, face_tensors, audio_feat_queue, asr, res_frame_queue, model, infer_stats):
+    length = len(face_tensors)
     index = 0
     count = 0
     counttime = 0
@@ -158,65 +188,30 @@ def inference(quit_event, batch_size, face_list_cycle, audio_feat_queue, audio_o
             mel_batch = audio_feat_queue.get(block=True, timeout=1)
         except queue.Empty:
             continue
-        is_all_silence=True
-        audio_frames = []
-        for _ in range(batch_size*2):
-            frame,type_,eventpoint = audio_out_queue.get()
-            audio_frames.append((frame,type_,eventpoint))
-            if type_==0:
-                is_all_silence=False
-        if is_all_silence:
-            for i in range(batch_size):
-                res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
-                index = index + 1
-        else:
-            t = time.perf_counter()
-            img_batch = []
-
-            for i in range(batch_size):
-                idx = __mirror_index(length, index + i)
-                #face = face_list_cycle[idx]
-                crop_img = face_list_cycle[idx] #face[ymin:ymax, xmin:xmax]
-#                h, w = crop_img.shape[:2]
-                #crop_img = cv2.resize(crop_img, (168, 168), cv2.INTER_AREA)
-                #crop_img_ori = crop_img.copy()
-                img_real_ex = crop_img[4:164, 4:164].copy()
-                img_real_ex_ori = img_real_ex.copy()
-                img_masked = cv2.rectangle(img_real_ex_ori,(5,5,150,145),(0,0,0),-1)
-    
-                img_masked = img_masked.transpose(2,0,1).astype(np.float32)
-                img_real_ex = img_real_ex.transpose(2,0,1).astype(np.float32)
-    
-                img_real_ex_T = torch.from_numpy(img_real_ex / 255.0)
-                img_masked_T = torch.from_numpy(img_masked / 255.0)
-                img_concat_T = torch.cat([img_real_ex_T, img_masked_T], axis=0)[None]
-                img_batch.append(img_concat_T)
-
-            reshaped_mel_batch = [arr.reshape(32, 32, 32) for arr in mel_batch]
-            mel_batch = torch.stack([torch.from_numpy(arr) for arr in reshaped_mel_batch])
-            img_batch = torch.stack(img_batch).squeeze(1)
-
-
-            with torch.no_grad():
-                pred = model(img_batch.cuda(),mel_batch.cuda())
-            pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
-
+        audio_frames = asr.get_audio_out(batch_size*2)
+        indices = [__mirror_index(length,index+i) for i in range(batch_size)]
+        index = index + batch_size
+        #只有说话的帧送去推理，静音帧直接使用原图
+        speak_ids = [i for i,speaking in enumerate(get_speaking_flags(audio_frames,batch_size)) if speaking]
+        infer_stats['skip_frames'] += batch_size-len(speak_ids)
+        res_frames = [None]*batch_size
+        if speak_ids:
+            # print('infer=======')
+            t=time.perf_counter()
+            img_batch, mel_batch = prepare_batch([mel_batch[i] for i in speak_ids], face_tensors, [indices[i] for i in speak_ids])
+            pred = infer_batch(img_batch, mel_batch, model)
             counttime += (time.perf_counter() - t)
-            count += batch_size
-            if count >= 100:
-                logger.info(f"------actual avg infer fps:{count / counttime:.4f}")
-                count = 0
-                counttime = 0
-            for i,res_frame in enumerate(pred):
-                #self.__pushmedia(res_frame,loop,audio_track,video_track)
-                res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
-                index = index + 1
-
-#            for i, pred_frame in enumerate(pred):
-#                pred_frame_uint8 = np.array(pred_frame, dtype=np.uint8)
-#                res_frame_queue.put((pred_frame_uint8, __mirror_index(length, index), audio_frames[i * 2:i * 2 + 2]))
-#                index = (index + 1) % length
-
+            count += len(speak_ids)
+            infer_stats['infer_frames'] += len(speak_ids)
+            if count>=100:
+                logger.info(f"------actual avg infer fps:{count/counttime:.4f}")
+                count=0
+                counttime=0
+            for i,res_frame in zip(speak_ids,pred):
+                res_frames[i] = res_frame
+        for i in range(batch_size):
+            #self.__pushmedia(res_frame,loop,audio_track,video_track)
+            res_frame_queue.put((res_frames[i],indices[i],audio_frames[i*2:i*2+2]))
         #print('total batch time:', time.perf_counter() - starttime)
 
     logger.info('lightreal inference processor stop')
@@ -237,7 +232,8 @@ class LightReal(BaseReal):
         self.res_frame_queue = Queue(self.batch_size*2)  #mp.Queue
         #self.__loadavatar()
         audio_processor = model
-        self.model,self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle = avatar
+        self.model,self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle,self.face_tensors = avatar
+        self.batch_key = self.model #ultralight weights belong to the avatar, only same-avatar sessions share a batch
 
         self.asr = HubertASR(opt,self,audio_processor)
         self.asr.warm_up()
@@ -248,9 +244,18 @@ class LightReal(BaseReal):
     def __del__(self):
         logger.info(f'lightreal({self.sessionid}) delete')
 
+    def prepare_infer(self,mel_batch,indices):
+        return prepare_batch(mel_batch,self.face_tensors,indices)
+
+    def infer(self,img_batch,mel_batch):
+        return infer_batch(img_batch,mel_batch,self.model)
+
+    def face_box(self,idx:int):
+        return self.coord_list_cycle[idx]
+
     def paste_back_frame(self,pred_frame,idx:int):
         bbox = self.coord_list_cycle[idx]
-        combine_frame = copy.deepcopy(self.frame_list_cycle[idx])
+        combine_frame = self.copy_frame(idx)
         x1, y1, x2, y2 = bbox
 
         crop_img = self.face_list_cycle[idx]
@@ -270,8 +275,11 @@ class LightReal(BaseReal):
         self.init_customindex()
         process_thread = Thread(target=self.process_frames, args=(quit_event,loop,audio_track,video_track))
         process_thread.start()
-        Thread(target=inference, args=(quit_event,self.batch_size,self.face_list_cycle,self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
-                                           self.model,)).start()  #mp.Process
+        if self.infer_scheduler:
+            self.infer_scheduler.register(self)
+        else:
+            Thread(target=inference, args=(quit_event,self.batch_size,self.face_tensors,self.asr.feat_queue,self.asr,self.res_frame_queue,
+                                           self.model,self.infer_stats)).start()  #mp.Process
         
 
         #self.render_event.set() #start infer process render
@@ -279,23 +287,25 @@ class LightReal(BaseReal):
         totaltime=0
         _starttime=time.perf_counter()
         #_totalframe=0
+        self.clock.reset()
         while not quit_event.is_set(): 
             # update texture every frame
             # audio stream thread...
+            #一个batch的音频按25fps媒体时钟送入,下游队列满时阻塞
+            self.clock.advance(self.batch_size,quit_event)
             t = time.perf_counter()
             self.asr.run_step()
 
             # if video_track._queue.qsize()>=2*self.opt.batch_size:
             #     print('sleep qsize=',video_track._queue.qsize())
             #     time.sleep(0.04*video_track._queue.qsize()*0.8)
-            if video_track and video_track._queue.qsize()>=5:
-                logger.debug('sleep qsize=%d',video_track._queue.qsize())
-                time.sleep(0.04*video_track._queue.qsize()*0.8)
                 
             # delay = _starttime+_totalframe*0.04-time.perf_counter() #40ms
             # if delay > 0:
             #     time.sleep(delay)
         #self.render_event.clear() #end infer process render
+        if self.infer_scheduler:
+            self.infer_scheduler.unregister(self)
         logger.info('lightreal thread stop')
             
 
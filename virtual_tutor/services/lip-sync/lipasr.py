@@ -25,40 +25,39 @@ from queue import Queue
 
 from baseasr import BaseASR
 from wav2lip import audio
+from wav2lip.hparams import hparams as hp
 
 class LipASR(BaseASR):
+    def __init__(self, opt, parent=None):
+        super().__init__(opt,parent)
+        self.mel_stream = audio.MelStream()
+        self.mel_step_size = 16
+        self.mel_per_frame = 80./self.fps  # mel frames per 20ms audio frame
+        self.frame_offsets = 2*np.arange(self.batch_size)  # first audio frame of each video frame in a step
+        self.next_frame = self.stride_left_size  # stream index of the first audio frame of the next video frame
+        # chunks are written in place; feat_queue holds 2 batches, so 4 slots are never overwritten while in use
+        self.chunk_ring = np.zeros((4,self.batch_size,hp.num_mels,self.mel_step_size), dtype=np.float32)
+        self.ring_index = 0
+
+    def warm_up(self):
+        super().warm_up()
+        self.mel_stream.push(self.get_window())
 
     def run_step(self):
         ############################################## extract audio feature ##############################################
         # get a frame of audio
+        start = self.ring.count
         for _ in range(self.batch_size*2):
-            frame,type,eventpoint = self.get_audio_frame()
-            self.frames.append(frame)
-            # put to output
-            self.output_queue.put((frame,type,eventpoint))
+            self.get_audio_frame()
+        # only the stft frames completed by the new audio are computed
+        self.mel_stream.push(self.ring.window(start,self.batch_size*2))
         # context not enough, do not run network.
-        if len(self.frames) <= self.stride_left_size + self.stride_right_size:
+        if self.window_frames() <= self.stride_left_size + self.stride_right_size:
             return
         
-        inputs = np.concatenate(self.frames) # [N * chunk]
-        mel = audio.melspectrogram(inputs)
-        #print(mel.shape[0],mel.shape,len(mel[0]),len(self.frames))
-        # cut off stride
-        left = max(0, self.stride_left_size*80/50)
-        right = min(len(mel[0]), len(mel[0]) - self.stride_right_size*80/50)
-        mel_idx_multiplier = 80.*2/self.fps 
-        mel_step_size = 16
-        i = 0
-        mel_chunks = []
-        while i < (len(self.frames)-self.stride_left_size-self.stride_right_size)/2:
-            start_idx = int(left + i * mel_idx_multiplier)
-            #print(start_idx)
-            if start_idx + mel_step_size > len(mel[0]):
-                mel_chunks.append(mel[:, len(mel[0]) - mel_step_size:])
-            else:
-                mel_chunks.append(mel[:, start_idx : start_idx + mel_step_size])
-            i += 1
+        starts = ((self.next_frame + self.frame_offsets)*self.mel_per_frame).astype(int)
+        self.next_frame += self.batch_size*2
+        mel_chunks = self.chunk_ring[self.ring_index]
+        self.ring_index = (self.ring_index+1) % len(self.chunk_ring)
+        self.mel_stream.get_chunks(starts,self.mel_step_size,mel_chunks)
         self.feat_queue.put(mel_chunks)
-        
-        # discard the old part to save memory
-        self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
@@ -25,7 +25,6 @@ import time
 import cv2
 import glob
 import pickle
-import copy
 
 import queue
 from queue import Queue
@@ -37,7 +36,8 @@ from lipasr import LipASR
 import asyncio
 from av import AudioFrame, VideoFrame
 from wav2lip.models import Wav2Lip
-from basereal import BaseReal
+from basereal import BaseReal,get_speaking_flags
+import avatarstore
 
 #from imgcache import ImgCache
 
@@ -73,6 +73,13 @@ def load_avatar(avatar_id):
     full_imgs_path = f"{avatar_path}/full_imgs" 
     face_imgs_path = f"{avatar_path}/face_imgs" 
     coords_path = f"{avatar_path}/coords.pkl"
+
+    try:
+        avatar = avatarstore.open_avatar(avatar_path)  #memory mapped, shared by all sessions
+        face_list_cycle = avatar.images('face_imgs')
+        return avatar.images('full_imgs'),face_list_cycle,avatar.coords('coords'),load_face_tensors(face_list_cycle)
+    except Exception:
+        logger.exception('pack avatar failed, read images:')
     
     with open(coords_path, 'rb') as f:
         coord_list_cycle = pickle.load(f)
@@ -84,7 +91,17 @@ def load_avatar(avatar_id):
     input_face_list = sorted(input_face_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
     face_list_cycle = read_imgs(input_face_list)
 
-    return frame_list_cycle,face_list_cycle,coord_list_cycle
+    return frame_list_cycle,face_list_cycle,coord_list_cycle,load_face_tensors(face_list_cycle)
+
+def load_face_tensors(face_list_cycle):
+    '''
+    wav2lip image input of every avatar frame, built once and kept on the device:
+    (N,6,H,W) uint8, lower half masked face + reference face. normalized when gathered.
+    '''
+    faces = torch.from_numpy(np.array(face_list_cycle)).permute(0,3,1,2) #N,3,H,W
+    masked = faces.clone()
+    masked[:, :, faces.shape[2]//2:] = 0
+    return torch.cat((masked,faces),dim=1).contiguous().to(device)
 
 @torch.no_grad()
 def warm_up(batch_size,model,modelres):
@@ -111,7 +128,19 @@ def __mirror_index(size, index):
     else:
         return size - res - 1 
 
-def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_queue,res_frame_queue,model):
+def prepare_batch(mel_batch,face_tensors,indices):
+    index = torch.as_tensor(indices,device=face_tensors.device)
+    img_batch = face_tensors.index_select(0,index) #B,6,H,W uint8 on device
+    mel_batch = torch.from_numpy(np.asarray(mel_batch,dtype=np.float32)).unsqueeze(1) #B,1,80,16
+    return mel_batch,img_batch
+
+@torch.no_grad()
+def infer_batch(mel_batch,img_batch,model):
+    img_batch = img_batch.to(device).float().div_(255.)
+    pred = model(mel_batch.to(device,non_blocking=True), img_batch)
+    return pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+
+def inference(quit_event,batch_size,face_tensors,audio_feat_queue,asr,res_frame_queue,model,infer_stats):
     
     #model = load_model("./models/wav2lip.pth")
     # input_face_list = glob.glob(os.path.join(face_imgs_path, '*.[jpJP][pnPN]*[gG]'))
@@ -119,7 +148,7 @@ def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_q
     # face_list_cycle = read_imgs(input_face_list)
     
     #input_latent_list_cycle = torch.load(latents_out_path)
-    length = len(face_list_cycle)
+    length = len(face_tensors)
     index = 0
     count=0
     counttime=0
@@ -132,52 +161,30 @@ def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_q
         except queue.Empty:
             continue
             
-        is_all_silence=True
-        audio_frames = []
-        for _ in range(batch_size*2):
-            frame,type,eventpoint = audio_out_queue.get()
-            audio_frames.append((frame,type,eventpoint))
-            if type==0:
-                is_all_silence=False
-
-        if is_all_silence:
-            for i in range(batch_size):
-                res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
-                index = index + 1
-        else:
+        audio_frames = asr.get_audio_out(batch_size*2)
+        indices = [__mirror_index(length,index+i) for i in range(batch_size)]
+        index = index + batch_size
+        #只有说话的帧送去推理，静音帧直接使用原图
+        speak_ids = [i for i,speaking in enumerate(get_speaking_flags(audio_frames,batch_size)) if speaking]
+        infer_stats['skip_frames'] += batch_size-len(speak_ids)
+        res_frames = [None]*batch_size
+        if speak_ids:
             # print('infer=======')
             t=time.perf_counter()
-            img_batch = []
-            for i in range(batch_size):
-                idx = __mirror_index(length,index+i)
-                face = face_list_cycle[idx]
-                img_batch.append(face)
-            img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
-
-            img_masked = img_batch.copy()
-            img_masked[:, face.shape[0]//2:] = 0
-
-            img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
-            mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
-            
-            img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
-            mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
-
-            with torch.no_grad():
-                pred = model(mel_batch, img_batch)
-            pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
-
+            mel_batch,img_batch = prepare_batch([mel_batch[i] for i in speak_ids],face_tensors,[indices[i] for i in speak_ids])
+            pred = infer_batch(mel_batch,img_batch,model)
             counttime += (time.perf_counter() - t)
-            count += batch_size
-            #_totalframe += 1
+            count += len(speak_ids)
+            infer_stats['infer_frames'] += len(speak_ids)
             if count>=100:
                 logger.info(f"------actual avg infer fps:{count/counttime:.4f}")
                 count=0
                 counttime=0
-            for i,res_frame in enumerate(pred):
-                #self.__pushmedia(res_frame,loop,audio_track,video_track)
-                res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
-                index = index + 1
+            for i,res_frame in zip(speak_ids,pred):
+                res_frames[i] = res_frame
+        for i in range(batch_size):
+            #self.__pushmedia(res_frame,loop,audio_track,video_track)
+            res_frame_queue.put((res_frames[i],indices[i],audio_frames[i*2:i*2+2]))
             #print('total batch time:',time.perf_counter()-starttime)            
     logger.info('lipreal inference processor stop')
 
@@ -196,7 +203,8 @@ class LipReal(BaseReal):
         self.res_frame_queue = Queue(self.batch_size*2)  #mp.Queue
         #self.__loadavatar()
         self.model = model
-        self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle = avatar
+        self.batch_key = model #sessions sharing the model can be batched together
+        self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle,self.face_tensors = avatar
 
         self.asr = LipASR(opt,self)
         self.asr.warm_up()
@@ -206,9 +214,19 @@ class LipReal(BaseReal):
     def __del__(self):
         logger.info(f'lipreal({self.sessionid}) delete')
 
+    def prepare_infer(self,mel_batch,indices):
+        return prepare_batch(mel_batch,self.face_tensors,indices)
+
+    def infer(self,mel_batch,img_batch):
+        return infer_batch(mel_batch,img_batch,self.model)
+
+    def face_box(self,idx:int):
+        y1, y2, x1, x2 = self.coord_list_cycle[idx]
+        return x1, y1, x2, y2
+
     def paste_back_frame(self,pred_frame,idx:int):
         bbox = self.coord_list_cycle[idx]
-        combine_frame = copy.deepcopy(self.frame_list_cycle[idx])
+        combine_frame = self.copy_frame(idx)
         #combine_frame = copy.deepcopy(self.imagecache.get_img(idx))
         y1, y2, x1, x2 = bbox
         res_frame = cv2.resize(pred_frame.astype(np.uint8),(x2-x1,y2-y1))
@@ -226,31 +244,36 @@ class LipReal(BaseReal):
         process_thread = Thread(target=self.process_frames, args=(quit_event,loop,audio_track,video_track))
         process_thread.start()
 
-        Thread(target=inference, args=(quit_event,self.batch_size,self.face_list_cycle,
-                                           self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
-                                           self.model,)).start()  #mp.Process
+        if self.infer_scheduler:
+            self.infer_scheduler.register(self)
+        else:
+            Thread(target=inference, args=(quit_event,self.batch_size,self.face_tensors,
+                                           self.asr.feat_queue,self.asr,self.res_frame_queue,
+                                           self.model,self.infer_stats)).start()  #mp.Process
 
         #self.render_event.set() #start infer process render
         count=0
         totaltime=0
         _starttime=time.perf_counter()
         #_totalframe=0
+        self.clock.reset()
         while not quit_event.is_set(): 
             # update texture every frame
             # audio stream thread...
+            #一个batch的音频按25fps媒体时钟送入,下游队列满时阻塞
+            self.clock.advance(self.batch_size,quit_event)
             t = time.perf_counter()
             self.asr.run_step()
 
             # if video_track._queue.qsize()>=2*self.opt.batch_size:
             #     print('sleep qsize=',video_track._queue.qsize())
             #     time.sleep(0.04*video_track._queue.qsize()*0.8)
-            if video_track and video_track._queue.qsize()>=5:
-                logger.debug('sleep qsize=%d',video_track._queue.qsize())
-                time.sleep(0.04*video_track._queue.qsize()*0.8)
                 
             # delay = _starttime+_totalframe*0.04-time.perf_counter() #40ms
             # if delay > 0:
             #     time.sleep(delay)
         #self.render_event.clear() #end infer process render
+        if self.infer_scheduler:
+            self.infer_scheduler.unregister(self)
         logger.info('lipreal thread stop')
             
\ No newline at end of file
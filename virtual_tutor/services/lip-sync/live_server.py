@@ -8,9 +8,14 @@ import uvicorn
 import tempfile
 import shutil
 import threading
+import requests
+import asyncio
+from fastapi.concurrency import run_in_threadpool
 
-# Import create_avatar related functions
-from create_avatar import create_avatar
+from avatarjobs import AvatarJobManager, JobQueueFull, JobConflict
+
+# Avatar creation jobs, created at startup
+job_manager = None
 
 # Global configuration variable
 CONFIG = {}
@@ -113,6 +118,26 @@ def switch_avatar(
     
     print(f"Avatar and reference audio file checks passed")
 
+    # A running app.py keeps its models loaded, ask it to load the avatar instead of restarting it
+    try:
+        response = requests.post(
+            f"http://127.0.0.1:{listenport}/load_avatar",
+            json={"avatar_id": avatar_id, "default": 1, "ref_file": ref_file, "ref_text": ref_text},
+            timeout=get_config_value("app_config.avatar_load_timeout", 600)
+        )
+        result = response.json()
+        if result.get("code") == 0:
+            print(f"Avatar {avatar_id} loaded by the running service, cached avatars: {result.get('avatars')}")
+            return {
+                "status": "success",
+                "message": f"Successfully switched to avatar {avatar_id}, service running on port {listenport}"
+            }
+        print(f"Running service failed to load avatar: {result.get('msg')}, restarting it")
+    except requests.exceptions.ConnectionError:
+        print(f"No service running on port {listenport}, starting a new one")
+    except Exception as e:
+        print(f"Error loading avatar in the running service: {e}, restarting it")
+
     # Build command
     app_command = (
         f"python3 app.py --transport {transport} --model {model} --avatar_id {avatar_id} "
@@ -255,8 +280,35 @@ def monitor_process_output(process, avatar_id, listenport):
     except Exception as e:
         print(f"Error occurred while monitoring Avatar {avatar_id} output: {e}")
 
+def submit_job(submit, *args):
+    """Run a job manager call, its errors become HTTP errors"""
+    try:
+        return submit(*args)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except JobConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def wait_job(job, poll=1.0):
+    """Wait for a job without holding a server worker"""
+    while job.state in ("created", "queued", "running"):
+        await asyncio.sleep(poll)
+    return job
+
+async def save_upload(upload, job):
+    """Write an uploaded video to the input of job"""
+    with open(job.input_path, "wb") as f:
+        while True:
+            chunk = await upload.read(1 << 20)
+            if not chunk:
+                break
+            f.write(chunk)
+    return os.path.getsize(job.input_path)
+
 @app.post("/create_avatar")
-def api_create_avatar_from_path(
+async def api_create_avatar_from_path(
     avatar_name: str = Query(..., description="Avatar name, e.g., avatar_1"),
     video_path: str = Query(..., description="Video file path"),
     burr: bool = Query(False, description="Whether to apply blur processing")
@@ -291,8 +343,10 @@ def api_create_avatar_from_path(
                 detail="Unsupported video format, please use .mp4, .avi, .mov or .mkv files"
             )
         
-        # Call create_avatar function
-        result = create_avatar(video_path, avatar_name, burr=burr)
+        # Build in the job queue, the request only waits for it
+        job = await run_in_threadpool(submit_job, job_manager.submit, video_path, avatar_name, burr)
+        job = await wait_job(job)
+        result = job.image_path if job.state == "succeeded" else False
         
         if result:
             print(f"Avatar created successfully: {avatar_name}")
@@ -306,7 +360,8 @@ def api_create_avatar_from_path(
             print(f"Avatar creation failed: {avatar_name}")
             return {
                 "status": "error",
-                "message": f"Failed to create avatar {avatar_name}, please check input file and parameters"
+                "message": f"Failed to create avatar {avatar_name}: {job.error or job.state}",
+                "job_id": job.job_id
             }
             
     except HTTPException:
@@ -432,53 +487,67 @@ async def avatar_add(
     avatar_model: str = Form(""),
     description: str = Form("")
 ):
-    """Avatar creation endpoint - handles file upload"""
-    import tempfile
-    
+    """Avatar creation endpoint - handles file upload, waits for the creation job"""
+    job = await submit_avatar_job(name, prompt_face, avatar_blur)
+    job = await wait_job(job)
+    if job.state == "succeeded":
+        print(f"Avatar created successfully: {job.image_path}")
+        return {"status": "success", "message": "Avatar created", "image_path": job.image_path}
+    print(f"Avatar creation failed for: {name}")
+    raise HTTPException(status_code=500, detail=f"Failed to create avatar: {job.error or job.state}")
+
+async def submit_avatar_job(name, prompt_face, avatar_blur):
+    """Queue a creation job for an uploaded video"""
+    # 校验格式
+    video_suffix = os.path.splitext(prompt_face.filename or "")[1].lower() or ".mp4"
+    if video_suffix not in ('.mp4', '.avi', '.mov', '.mkv'):
+        raise HTTPException(status_code=400, detail="Unsupported video format.")
+
+    burr = (avatar_blur.lower() == "true")
+    job = submit_job(job_manager.new_job, name, burr)
     try:
-        # 临时保存视频文件
-        video_suffix = os.path.splitext(prompt_face.filename)[1] or ".mp4"
-        with tempfile.NamedTemporaryFile(delete=False, suffix=video_suffix) as tmp_vid:
-            video_content = await prompt_face.read()
-            if len(video_content) == 0:
-                raise HTTPException(status_code=400, detail="Empty video file uploaded")
-            tmp_vid.write(video_content)
-            video_path = tmp_vid.name
-        
-        # 检查文件大小
-        file_size = os.path.getsize(video_path)
-        print(f"Received video file: {prompt_face.filename}, size: {file_size} bytes, saved to {video_path}")
-        
-        if file_size == 0:
-            raise HTTPException(status_code=400, detail="Empty video file")
+        file_size = await save_upload(prompt_face, job)
+    except Exception:
+        job_manager.cancel(job.job_id)
+        raise
+    print(f"Received video file: {prompt_face.filename}, size: {file_size} bytes, job {job.job_id}")
+    if file_size == 0:
+        job_manager.cancel(job.job_id)
+        raise HTTPException(status_code=400, detail="Empty video file")
+    return job_manager.enqueue(job)
 
-        # 校验格式
-        if not video_path.lower().endswith(('.mp4', '.avi', '.mov', '.mkv')):
-            raise HTTPException(status_code=400, detail="Unsupported video format.")
+@app.post("/avatar/jobs")
+async def avatar_job_submit(
+    name: str = Form(...),
+    prompt_face: UploadFile = File(...),
+    avatar_blur: str = Form("false")
+):
+    """Queue an avatar creation job and return at once, poll /avatar/jobs/{job_id} for progress"""
+    job = await submit_avatar_job(name, prompt_face, avatar_blur)
+    return {"status": "success", "job": job.to_dict()}
 
-        # 调用 create_avatar 函数
-        print(f"Starting avatar creation for: {name}")
-        burr = (avatar_blur.lower() == "true")
-        result = create_avatar(video_path, name, burr=burr)
+@app.get("/avatar/jobs")
+def avatar_job_list():
+    """All avatar creation jobs, newest first"""
+    return {"status": "success", "jobs": [job.to_dict() for job in job_manager.list()]}
 
-        if result:
-            print(f"Avatar created successfully: {result}")
-            return {"status": "success", "message": "Avatar created", "image_path": result}
-        else:
-            print(f"Avatar creation failed for: {name}")
-            raise HTTPException(status_code=500, detail="Failed to create avatar - check video file format and content")
+@app.get("/avatar/jobs/{job_id}")
+def avatar_job_status(job_id: str):
+    """State and per stage progress of a job"""
+    try:
+        job = job_manager.get(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' does not exist")
+    return {"status": "success", "job": job.to_dict()}
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        # 清理临时文件
-        try:
-            if 'video_path' in locals() and os.path.exists(video_path):
-                os.remove(video_path)
-        except Exception as cleanup_err:
-            print(f"[WARN] cleanup failed: {cleanup_err}")
+@app.post("/avatar/jobs/{job_id}/cancel")
+def avatar_job_cancel(job_id: str):
+    """Cancel a queued or running job"""
+    try:
+        job = job_manager.cancel(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' does not exist")
+    return {"status": "success", "job": job.to_dict()}
 
 @app.post("/avatar/delete")
 def avatar_delete(name: str = Form(...)):
@@ -505,6 +574,13 @@ async def startup_event():
     """Load configuration when application starts"""
     if not load_config():
         print("Warning: Configuration file loading failed, default values will be used")
+    global job_manager
+    working_directory = get_config_value("paths.working_directory", "/workspace/share/yuntao/LiveTalking")
+    job_manager = AvatarJobManager(
+        get_config_value("avatar_jobs.jobs_dir", os.path.join(working_directory, "data", "avatar_jobs")),
+        workers=get_config_value("avatar_jobs.workers", 1),
+        max_pending=get_config_value("avatar_jobs.max_pending", 16)
+    )
 
 if __name__ == "__main__":
     # Load configuration before startup
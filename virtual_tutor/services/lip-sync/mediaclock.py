@@ -0,0 +1,67 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import time
+
+
+class MediaClock:
+    '''
+    Paces a producer of video frames against wall time.
+    advance(n) returns once the frames produced so far are about to run out (lead seconds
+    before the end of their playback) and then accounts n more frames. A producer that is
+    late is reported as lag; after more than max_lag the clock is resynced instead of
+    bursting frames to catch up.
+    '''
+    def __init__(self, fps=25, lead=1.0, max_lag=1.0):
+        self.period = 1.0/fps
+        self.lead = lead
+        self.max_lag = max_lag
+        self.reset()
+
+    def reset(self):
+        self._start = None
+        self._frames = 0
+        self.lag = 0.0
+        self.max_seen_lag = 0.0
+        self.late_ticks = 0
+        self.resyncs = 0
+
+    def advance(self, frames=1, quit_event=None):
+        now = time.perf_counter()
+        if self._start is None:
+            self._start = now
+        due = self._start + self._frames*self.period - self.lead
+        wait = due - now
+        if wait > 0:
+            if quit_event is not None:
+                quit_event.wait(wait)
+            else:
+                time.sleep(wait)
+            self.lag = 0.0
+        else:
+            self.lag = -wait
+            if self._frames*self.period > self.lead: #the first frames are always due
+                self.late_ticks += 1
+                self.max_seen_lag = max(self.max_seen_lag, self.lag)
+            if self.lag > self.max_lag:
+                self._start += self.lag
+                self.resyncs += 1
+        self._frames += frames
+
+    def get_stats(self)->dict:
+        return {'clock_lag':round(self.lag,4),'clock_max_lag':round(self.max_seen_lag,4),
+                'clock_late_ticks':self.late_ticks,'clock_resyncs':self.resyncs}
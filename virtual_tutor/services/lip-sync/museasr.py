@@ -22,26 +22,39 @@ import queue
 from queue import Queue
 #import multiprocessing as mp
 from baseasr import BaseASR
-from musetalk.whisper.audio2feature import Audio2Feature
+from musetalk.whisper.audio2feature import Audio2Feature,Audio2FeatureStream
 
 class MuseASR(BaseASR):
     def __init__(self, opt, parent,audio_processor:Audio2Feature):
         super().__init__(opt,parent)
         self.audio_processor = audio_processor
+        self.feature_stream = None
+        if opt.whisper_stream:
+            self.feature_stream = Audio2FeatureStream(audio_processor)
+
+    def warm_up(self):
+        super().warm_up()
+        if self.feature_stream:
+            self.feature_stream.push(self.get_window())
 
     def run_step(self):
         ############################################## extract audio feature ##############################################
         start_time = time.time()
+        start = self.ring.count
         for _ in range(self.batch_size*2):
-            audio_frame,type,eventpoint = self.get_audio_frame()
-            self.frames.append(audio_frame)
-            self.output_queue.put((audio_frame,type,eventpoint))
+            self.get_audio_frame()
+        if self.feature_stream:
+            self.feature_stream.push(self.ring.window(start,self.batch_size*2))
         
-        if len(self.frames) <= self.stride_left_size + self.stride_right_size:
+        if self.window_frames() <= self.stride_left_size + self.stride_right_size:
             return
         
-        inputs = np.concatenate(self.frames) # [N * chunk]
-        whisper_feature = self.audio_processor.audio2feat(inputs)
+        if self.feature_stream:
+            # only the current window is encoded, mel frames of the overlap are reused
+            whisper_feature = self.feature_stream.encode(self.window_frames()*self.chunk)
+        else:
+            inputs = self.get_window() # [N * chunk], contiguous view of the ring
+            whisper_feature = self.audio_processor.audio2feat(inputs)
         # for feature in whisper_feature:
         #     self.audio_feats.append(feature)        
         #print(f"processing audio costs {(time.time() - start_time) * 1000}ms, inputs shape:{inputs.shape} whisper_feature len:{len(whisper_feature)}")
@@ -49,5 +62,3 @@ class MuseASR(BaseASR):
         #print(f"whisper_chunks len:{len(whisper_chunks)},self.audio_feats len:{len(self.audio_feats)},self.output_queue len:{self.output_queue.qsize()}")
         #self.audio_feats = self.audio_feats[-(self.stride_left_size + self.stride_right_size):]
         self.feat_queue.put(whisper_chunks)
-        # discard the old part to save memory
-        self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
@@ -27,7 +27,6 @@ import torch.nn.functional as F
 import cv2
 import glob
 import pickle
-import copy
 
 import queue
 from queue import Queue
@@ -36,14 +35,15 @@ import torch.multiprocessing as mp
 
 from musetalk.utils.utils import get_file_type,get_video_fps,datagen
 #from musetalk.utils.preprocessing import get_landmark_and_bbox,read_imgs,coord_placeholder
-from musetalk.utils.blending import get_image,get_image_prepare_material,get_image_blending
+from musetalk.utils.blending import get_image,get_image_prepare_material,FaceBlender
 from musetalk.utils.utils import load_all_model,load_diffusion_model,load_audio_model
 from musetalk.whisper.audio2feature import Audio2Feature
 
 from museasr import MuseASR
 import asyncio
 from av import AudioFrame, VideoFrame
-from basereal import BaseReal
+from basereal import BaseReal,get_speaking_flags
+import avatarstore
 
 from tqdm import tqdm
 from logger import logger
@@ -76,6 +76,19 @@ def load_avatar(avatar_id):
     #     "video_path":self.video_path,
     #     "bbox_shift":self.bbox_shift   
     # }
+    device = torch.device("cuda" if torch.cuda.is_available() else ("mps" if (hasattr(torch.backends, "mps") and torch.backends.mps.is_available()) else "cpu"))
+
+    try:
+        avatar = avatarstore.open_avatar(avatar_path)  #memory mapped, shared by all sessions
+    except Exception:
+        logger.exception('pack avatar failed, read images:')
+        avatar = None
+    if avatar is not None:
+        input_latent_list_cycle = torch.from_numpy(np.ascontiguousarray(avatar.latents())).to(device)
+        frame_list_cycle,mask_list_cycle = avatar.images('full_imgs'),avatar.images('mask')
+        coord_list_cycle,mask_coords_list_cycle = avatar.coords('coords'),avatar.coords('mask_coords')
+        blender = FaceBlender(*avatar.blend(),device)  #face boxes from the pack, the full frames stay lazy
+        return frame_list_cycle,mask_list_cycle,coord_list_cycle,mask_coords_list_cycle,input_latent_list_cycle,blender
 
     input_latent_list_cycle = torch.load(latents_out_path)  #,weights_only=True
     with open(coords_path, 'rb') as f:
@@ -88,7 +101,10 @@ def load_avatar(avatar_id):
     input_mask_list = glob.glob(os.path.join(mask_out_path, '*.[jpJP][pnPN]*[gG]'))
     input_mask_list = sorted(input_mask_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
     mask_list_cycle = read_imgs(input_mask_list)
-    return frame_list_cycle,mask_list_cycle,coord_list_cycle,mask_coords_list_cycle,input_latent_list_cycle
+    blend_masks,geometry = avatarstore.build_blend_material(mask_list_cycle,coord_list_cycle,mask_coords_list_cycle)
+    blend_bodies = avatarstore.build_blend_bodies(frame_list_cycle,geometry)
+    blender = FaceBlender(avatarstore.blend_mask_views(blend_masks,geometry),avatarstore.blend_body_views(blend_bodies,geometry),geometry,device)
+    return frame_list_cycle,mask_list_cycle,coord_list_cycle,mask_coords_list_cycle,input_latent_list_cycle,blender
 
 @torch.no_grad()
 def warm_up(batch_size,model):
@@ -126,9 +142,35 @@ def __mirror_index(size, index):
     else:
         return size - res - 1 
 
+def prepare_batch(whisper_chunks,input_latent_list_cycle,indices):
+    whisper_batch = np.stack(whisper_chunks)
+    latent_batch = []
+    for idx in indices:
+        latent = input_latent_list_cycle[idx]
+        latent_batch.append(latent)
+    latent_batch = torch.cat(latent_batch, dim=0)
+    return whisper_batch,latent_batch
+
+@torch.no_grad()
+def infer_batch(whisper_batch,latent_batch,vae,unet,pe,timesteps):
+    audio_feature_batch = torch.from_numpy(whisper_batch)
+    audio_feature_batch = audio_feature_batch.to(device=unet.device,
+                                                    dtype=unet.model.dtype)
+    audio_feature_batch = pe(audio_feature_batch)
+    latent_batch = latent_batch.to(dtype=unet.model.dtype)
+    # print('prepare time:',time.perf_counter()-t)
+    # t=time.perf_counter()
+
+    pred_latents = unet.model(latent_batch, 
+                                timesteps, 
+                                encoder_hidden_states=audio_feature_batch).sample
+    # print('unet time:',time.perf_counter()-t)
+    # t=time.perf_counter()
+    return vae.decode_latents_tensor(pred_latents) #stays on the device for FaceBlender
+
 @torch.no_grad()
-def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,audio_out_queue,res_frame_queue,
-              vae, unet, pe,timesteps): #vae, unet, pe,timesteps
+def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,asr,res_frame_queue,
+              vae, unet, pe,timesteps,blender,infer_stats): #vae, unet, pe,timesteps
     
     # vae, unet, pe = load_diffusion_model()
     # device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -148,61 +190,31 @@ def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,a
             whisper_chunks = audio_feat_queue.get(block=True, timeout=1)
         except queue.Empty:
             continue
-        is_all_silence=True
-        audio_frames = []
-        for _ in range(batch_size*2):
-            frame,type,eventpoint = audio_out_queue.get()
-            audio_frames.append((frame,type,eventpoint))
-            if type==0:
-                is_all_silence=False
-        if is_all_silence:
-            for i in range(batch_size):
-                res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
-                index = index + 1
-        else:
+        audio_frames = asr.get_audio_out(batch_size*2)
+        indices = [__mirror_index(length,index+i) for i in range(batch_size)]
+        index = index + batch_size
+        #只有说话的帧送去推理，静音帧直接使用原图
+        speak_ids = [i for i,speaking in enumerate(get_speaking_flags(audio_frames,batch_size)) if speaking]
+        infer_stats['skip_frames'] += batch_size-len(speak_ids)
+        res_frames = [None]*batch_size
+        if speak_ids:
             # print('infer=======')
             t=time.perf_counter()
-            whisper_batch = np.stack(whisper_chunks)
-            latent_batch = []
-            for i in range(batch_size):
-                idx = __mirror_index(length,index+i)
-                latent = input_latent_list_cycle[idx]
-                latent_batch.append(latent)
-            latent_batch = torch.cat(latent_batch, dim=0)
-            
-            # for i, (whisper_batch,latent_batch) in enumerate(gen):
-            audio_feature_batch = torch.from_numpy(whisper_batch)
-            audio_feature_batch = audio_feature_batch.to(device=unet.device,
-                                                            dtype=unet.model.dtype)
-            audio_feature_batch = pe(audio_feature_batch)
-            latent_batch = latent_batch.to(dtype=unet.model.dtype)
-            # print('prepare time:',time.perf_counter()-t)
-            # t=time.perf_counter()
-
-            pred_latents = unet.model(latent_batch, 
-                                        timesteps, 
-                                        encoder_hidden_states=audio_feature_batch).sample
-            # print('unet time:',time.perf_counter()-t)
-            # t=time.perf_counter()
-            recon = vae.decode_latents(pred_latents)
-            # infer_inqueue.put((whisper_batch,latent_batch,sessionid))
-            # recon,outsessionid = infer_outqueue.get()
-            # if outsessionid != sessionid:
-            #     print('outsessionid:',outsessionid,' mysessionid:',sessionid)
-
-            # print('vae time:',time.perf_counter()-t)
-            #print('diffusion len=',len(recon))
+            whisper_batch,latent_batch = prepare_batch([whisper_chunks[i] for i in speak_ids],input_latent_list_cycle,[indices[i] for i in speak_ids])
+            recon = infer_batch(whisper_batch,latent_batch,vae,unet,pe,timesteps)
+            recon = blender(recon,[indices[i] for i in speak_ids])
             counttime += (time.perf_counter() - t)
-            count += batch_size
-            #_totalframe += 1
+            count += len(speak_ids)
+            infer_stats['infer_frames'] += len(speak_ids)
             if count>=100:
                 logger.info(f"------actual avg infer fps:{count/counttime:.4f}")
                 count=0
                 counttime=0
-            for i,res_frame in enumerate(recon):
-                #self.__pushmedia(res_frame,loop,audio_track,video_track)
-                res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
-                index = index + 1
+            for i,res_frame in zip(speak_ids,recon):
+                res_frames[i] = res_frame
+        for i in range(batch_size):
+            #self.__pushmedia(res_frame,loop,audio_track,video_track)
+            res_frame_queue.put((res_frames[i],indices[i],audio_frames[i*2:i*2+2]))
             #print('total batch time:',time.perf_counter()-starttime)            
     logger.info('musereal inference processor stop')
 
@@ -218,10 +230,11 @@ class MuseReal(BaseReal):
 
         self.batch_size = opt.batch_size
         self.idx = 0
-        self.res_frame_queue = mp.Queue(self.batch_size*2)
+        self.res_frame_queue = Queue(self.batch_size*2)  #mp.Queue, frames are handed over in process
 
         self.vae, self.unet, self.pe, self.timesteps, self.audio_processor = model
-        self.frame_list_cycle,self.mask_list_cycle,self.coord_list_cycle,self.mask_coords_list_cycle, self.input_latent_list_cycle = avatar
+        self.batch_key = self.unet #sessions sharing the unet can be batched together
+        self.frame_list_cycle,self.mask_list_cycle,self.coord_list_cycle,self.mask_coords_list_cycle, self.input_latent_list_cycle, self.blender = avatar
         #self.__loadavatar()
 
         self.asr = MuseASR(opt,self,self.audio_processor)
@@ -233,49 +246,23 @@ class MuseReal(BaseReal):
         logger.info(f'musereal({self.sessionid}) delete')
     
 
-    def __mirror_index(self, index):
-        size = len(self.coord_list_cycle)
-        turn = index // size
-        res = index % size
-        if turn % 2 == 0:
-            return res
-        else:
-            return size - res - 1  
+    def prepare_infer(self,whisper_chunks,indices):
+        return prepare_batch(whisper_chunks,self.input_latent_list_cycle,indices)
 
-    def __warm_up(self): 
-        self.asr.run_step()
-        whisper_chunks = self.asr.get_next_feat()
-        whisper_batch = np.stack(whisper_chunks)
-        latent_batch = []
-        for i in range(self.batch_size):
-            idx = self.__mirror_index(self.idx+i)
-            latent = self.input_latent_list_cycle[idx]
-            latent_batch.append(latent)
-        latent_batch = torch.cat(latent_batch, dim=0)
-        logger.info('infer=======')
-        # for i, (whisper_batch,latent_batch) in enumerate(gen):
-        audio_feature_batch = torch.from_numpy(whisper_batch)
-        audio_feature_batch = audio_feature_batch.to(device=self.unet.device,
-                                                        dtype=self.unet.model.dtype)
-        audio_feature_batch = self.pe(audio_feature_batch)
-        latent_batch = latent_batch.to(dtype=self.unet.model.dtype)
+    def infer(self,whisper_batch,latent_batch):
+        return infer_batch(whisper_batch,latent_batch,self.vae,self.unet,self.pe,self.timesteps)
 
-        pred_latents = self.unet.model(latent_batch, 
-                                    self.timesteps, 
-                                    encoder_hidden_states=audio_feature_batch).sample
-        recon = self.vae.decode_latents(pred_latents)
-      
+    def finish_infer(self,res_frames,indices):
+        return self.blender(res_frames,indices)
 
-    def paste_back_frame(self,pred_frame,idx:int):
-        bbox = self.coord_list_cycle[idx]
-        ori_frame = copy.deepcopy(self.frame_list_cycle[idx])
-        x1, y1, x2, y2 = bbox
-
-        res_frame = cv2.resize(pred_frame.astype(np.uint8),(x2-x1,y2-y1))
-        mask = self.mask_list_cycle[idx]
-        mask_crop_box = self.mask_coords_list_cycle[idx]
+    def face_box(self,idx:int):
+        return self.coord_list_cycle[idx]
 
-        combine_frame = get_image_blending(ori_frame,res_frame,bbox,mask,mask_crop_box)
+    def paste_back_frame(self,pred_frame,idx:int):
+        #pred_frame is the face box already blended by FaceBlender
+        x1, y1, x2, y2 = self.coord_list_cycle[idx]
+        combine_frame = self.copy_frame(idx)
+        combine_frame[y1:y2, x1:x2] = pred_frame
         return combine_frame
             
     def render(self,quit_event,loop=None,audio_track=None,video_track=None):
@@ -288,16 +275,22 @@ class MuseReal(BaseReal):
         process_thread.start()
 
         self.render_event.set() #start infer process render
-        Thread(target=inference, args=(self.render_event,self.batch_size,self.input_latent_list_cycle,
-                                           self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
-                                           self.vae, self.unet, self.pe,self.timesteps)).start() #mp.Process
+        if self.infer_scheduler:
+            self.infer_scheduler.register(self)
+        else:
+            Thread(target=inference, args=(self.render_event,self.batch_size,self.input_latent_list_cycle,
+                                           self.asr.feat_queue,self.asr,self.res_frame_queue,
+                                           self.vae, self.unet, self.pe,self.timesteps,self.blender,self.infer_stats)).start() #mp.Process
         count=0
         totaltime=0
         _starttime=time.perf_counter()
         #_totalframe=0
+        self.clock.reset()
         while not quit_event.is_set(): #todo
             # update texture every frame
             # audio stream thread...
+            #一个batch的音频按25fps媒体时钟送入,下游队列满时阻塞
+            self.clock.advance(self.batch_size,quit_event)
             t = time.perf_counter()
             self.asr.run_step()
             #self.test_step(loop,audio_track,video_track)
@@ -307,9 +300,6 @@ class MuseReal(BaseReal):
             #     print(f"------actual avg infer fps:{count/totaltime:.4f}")
             #     count=0
             #     totaltime=0
-            if video_track and video_track._queue.qsize()>=1.5*self.opt.batch_size:
-                logger.debug('sleep qsize=%d',video_track._queue.qsize())
-                time.sleep(0.04*video_track._queue.qsize()*0.8)
             # if video_track._queue.qsize()>=5:
             #     print('sleep qsize=',video_track._queue.qsize())
             #     time.sleep(0.04*video_track._queue.qsize()*0.8)
@@ -318,5 +308,7 @@ class MuseReal(BaseReal):
             # if delay > 0:
             #     time.sleep(delay)
         self.render_event.clear() #end infer process render
+        if self.infer_scheduler:
+            self.infer_scheduler.unregister(self)
         logger.info('musereal thread stop')
             
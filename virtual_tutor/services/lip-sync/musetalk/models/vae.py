@@ -106,6 +106,18 @@ class VAE():
         image = (image * 255).round().astype("uint8")
         image = image[...,::-1] # RGB to BGR
         return image
+
+    def decode_latents_tensor(self, latents):
+        """
+        Decode latent variables and keep the image on the device.
+        :param latents: The latent variables to decode.
+        :return: A (B,3,H,W) BGR float tensor in 0..255.
+        """
+        latents = (1/  self.scaling_factor) * latents
+        image = self.vae.decode(latents.to(self.vae.dtype)).sample
+        image = (image / 2 + 0.5).clamp(0, 1)
+        image = (image.float() * 255).round()
+        return image.flip(1) # RGB to BGR
     
     def get_latents_for_unet(self,img):
         """
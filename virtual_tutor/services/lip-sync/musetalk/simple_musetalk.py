@@ -1,19 +1,21 @@
 import argparse
-import glob
 import json
 import os
 import pickle
-import shutil
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import cv2
 import numpy as np
 import torch
-import torchvision.transforms as transforms
 from PIL import Image
 from diffusers import AutoencoderKL
 from face_alignment import NetworkSize
-from mmpose.apis import inference_topdown, init_model
-from mmpose.structures import merge_data_samples
+from mmengine.dataset import Compose, pseudo_collate
+from mmpose.apis import init_model
 from tqdm import tqdm
 
 try:
@@ -21,83 +23,110 @@ try:
 except ModuleNotFoundError:
     from musetalk.utils.face_parsing import FaceParsing
 
+# the blend material is read by the runtime, built by the same avatarstore code
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from avatarstore import get_blend_material
 
-def video2imgs(vid_path, save_path, ext='.png', cut_frame=10000000):
+
+class StageTimer:
+    '''wall time of every build stage, gpu work is synchronized at the end of a stage'''
+    def __init__(self):
+        self.times = OrderedDict()
+
+    @contextmanager
+    def __call__(self, name):
+        print(f'stage: {name}', flush=True)  # progress marker read by avatarjobs
+        t = time.perf_counter()
+        yield
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - t
+
+    def report(self, frames, fps=25):
+        total = sum(self.times.values())
+        print(f'build of {frames} frames ({frames / fps:.1f}s of video) in {total:.1f}s')
+        for name, t in self.times.items():
+            print(f'  {name:<12} {t:8.2f}s  {frames / max(t, 1e-6):8.1f} frames/s')
+
+
+def decode_video(vid_path, cut_frame=10000000):
+    '''frames of the video in memory, with the watermark video2imgs used to draw'''
     cap = cv2.VideoCapture(vid_path)
-    count = 0
-    while True:
-        if count > cut_frame:
-            break
+    frames = []
+    while len(frames) <= cut_frame:
         ret, frame = cap.read()
-        if ret:
-            cv2.putText(frame, "LiveTalking", (10, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.3, (128,128,128), 1)
-            cv2.imwrite(f"{save_path}/{count:08d}.png", frame)
-            count += 1
-        else:
+        if not ret:
             break
+        cv2.putText(frame, "LiveTalking", (10, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.3, (128,128,128), 1)
+        frames.append(frame)
+    cap.release()
+    return frames
 
 
-def read_imgs(img_list):
-    frames = []
+def read_imgs(img_list, pool=None):
     print('reading images...')
-    for img_path in tqdm(img_list):
-        frame = cv2.imread(img_path)
-        frames.append(frame)
-    return frames
+    if pool is not None:
+        return list(tqdm(pool.map(cv2.imread, img_list), total=len(img_list)))
+    return [cv2.imread(img_path) for img_path in tqdm(img_list)]
+
+
+def _pose_input(frame):
+    # inference_topdown without bboxes: the whole image is the person box
+    h, w = frame.shape[:2]
+    data_info = dict(img=frame, bbox=np.array([[0, 0, w, h]], dtype=np.float32),
+                     bbox_score=np.ones(1, dtype=np.float32))
+    data_info.update(model.dataset_meta)
+    return pose_pipeline(data_info)
+
+
+def _face_box(face_land_mark, f, upperbondrange):
+    half_face_coord = face_land_mark[29]  # np.mean([face_land_mark[28], face_land_mark[29]], axis=0)
+    if upperbondrange != 0:
+        half_face_coord[1] = upperbondrange + half_face_coord[1]  # 手动调整  + 向下（偏29）  - 向上（偏28）
+    half_face_dist = np.max(face_land_mark[:, 1]) - half_face_coord[1]
+    upper_bond = half_face_coord[1] - half_face_dist
 
+    f_landmark = (
+        np.min(face_land_mark[:, 0]), int(upper_bond), np.max(face_land_mark[:, 0]),
+        np.max(face_land_mark[:, 1]))
+    x1, y1, x2, y2 = f_landmark
 
-def get_landmark_and_bbox(img_list, upperbondrange=0):
-    frames = read_imgs(img_list)
-    batch_size_fa = 1
-    batches = [frames[i:i + batch_size_fa] for i in range(0, len(frames), batch_size_fa)]
+    if y2 - y1 <= 0 or x2 - x1 <= 0 or x1 < 0:  # if the landmark bbox is not suitable, reuse the bbox
+        print("error bbox:", f)
+        return f
+    return f_landmark
+
+
+def get_landmark_and_bbox(frames, upperbondrange=0, batch_size=8, pool=None):
+    '''face box of every frame: dwpose landmarks and face detection, batch_size frames per forward pass'''
+    batches = [frames[i:i + batch_size] for i in range(0, len(frames), batch_size)]
     coords_list = []
-    landmarks = []
     if upperbondrange != 0:
         print('get key_landmark and face bounding boxes with the bbox_shift:', upperbondrange)
     else:
         print('get key_landmark and face bounding boxes with the default value')
-    average_range_minus = []
-    average_range_plus = []
     coord_placeholder = (0.0, 0.0, 0.0, 0.0)
     for fb in tqdm(batches):
-        results = inference_topdown(model, np.asarray(fb)[0])
-        results = merge_data_samples(results)
-        keypoints = results.pred_instances.keypoints
-        face_land_mark = keypoints[0][23:91]
-        face_land_mark = face_land_mark.astype(np.int32)
+        # affine crops of the pose model are prepared on the worker pool
+        data_list = list(pool.map(_pose_input, fb)) if pool is not None else [_pose_input(f) for f in fb]
+        with torch.no_grad():
+            results = model.test_step(pseudo_collate(data_list))
 
         # get bounding boxes by face detetion
-        bbox = fa.get_detections_for_batch(np.asarray(fb))
+        if len({f.shape for f in fb}) == 1:
+            bbox = fa.get_detections_for_batch(np.asarray(fb))
+        else:  # images of different sizes can not be stacked
+            bbox = [fa.get_detections_for_batch(np.asarray([f]))[0] for f in fb]
 
         # adjust the bounding box refer to landmark
         # Add the bounding box to a tuple and append it to the coordinates list
-        for j, f in enumerate(bbox):
+        for result, f in zip(results, bbox):
             if f is None:  # no face in the image
                 coords_list += [coord_placeholder]
                 continue
-
-            half_face_coord = face_land_mark[29]  # np.mean([face_land_mark[28], face_land_mark[29]], axis=0)
-            range_minus = (face_land_mark[30] - face_land_mark[29])[1]
-            range_plus = (face_land_mark[29] - face_land_mark[28])[1]
-            average_range_minus.append(range_minus)
-            average_range_plus.append(range_plus)
-            if upperbondrange != 0:
-                half_face_coord[1] = upperbondrange + half_face_coord[1]  # 手动调整  + 向下（偏29）  - 向上（偏28）
-            half_face_dist = np.max(face_land_mark[:, 1]) - half_face_coord[1]
-            upper_bond = half_face_coord[1] - half_face_dist
-
-            f_landmark = (
-                np.min(face_land_mark[:, 0]), int(upper_bond), np.max(face_land_mark[:, 0]),
-                np.max(face_land_mark[:, 1]))
-            x1, y1, x2, y2 = f_landmark
-
-            if y2 - y1 <= 0 or x2 - x1 <= 0 or x1 < 0:  # if the landmark bbox is not suitable, reuse the bbox
-                coords_list += [f]
-                w, h = f[2] - f[0], f[3] - f[1]
-                print("error bbox:", f)
-            else:
-                coords_list += [f_landmark]
-    return coords_list, frames
+            face_land_mark = result.pred_instances.keypoints[0][23:91].astype(np.int32)
+            coords_list += [_face_box(face_land_mark, f, upperbondrange)]
+    return coords_list
 
 
 class FaceAlignment:
@@ -152,31 +181,6 @@ def get_mask_tensor():
     return mask_tensor
 
 
-def preprocess_img(img_name, half_mask=False):
-    window = []
-    if isinstance(img_name, str):
-        window_fnames = [img_name]
-        for fname in window_fnames:
-            img = cv2.imread(fname)
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            img = cv2.resize(img, (256, 256),
-                             interpolation=cv2.INTER_LANCZOS4)
-            window.append(img)
-    else:
-        img = cv2.cvtColor(img_name, cv2.COLOR_BGR2RGB)
-        window.append(img)
-    x = np.asarray(window) / 255.
-    x = np.transpose(x, (3, 0, 1, 2))
-    x = torch.squeeze(torch.FloatTensor(x))
-    if half_mask:
-        x = x * (get_mask_tensor() > 0.5)
-    normalize = transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
-    x = normalize(x)
-    x = x.unsqueeze(0)  # [1, 3, 256, 256] torch tensor
-    x = x.to(device)
-    return x
-
-
 def encode_latents(image):
     with torch.no_grad():
         init_latent_dist = vae.encode(image.to(vae.dtype)).latent_dist
@@ -184,13 +188,18 @@ def encode_latents(image):
     return init_latents
 
 
-def get_latents_for_unet(img):
-    ref_image = preprocess_img(img, half_mask=True)  # [1, 3, 256, 256] RGB, torch tensor
-    masked_latents = encode_latents(ref_image)  # [1, 4, 32, 32], torch tensor
-    ref_image = preprocess_img(img, half_mask=False)  # [1, 3, 256, 256] RGB, torch tensor
-    ref_latents = encode_latents(ref_image)  # [1, 4, 32, 32], torch tensor
-    latent_model_input = torch.cat([masked_latents, ref_latents], dim=1)
-    return latent_model_input
+def get_latents_for_unet(crops):
+    '''
+    crops: 256x256 BGR faces. The half masked and the full faces of the whole batch go through
+    one vae.encode, returns one [1, 8, 32, 32] latent (masked, reference) per face
+    '''
+    x = torch.from_numpy(np.stack(crops)).to(device)
+    x = x.flip(-1).permute(0, 3, 1, 2).float() / 255.  # [B, 3, 256, 256] RGB
+    masked = x * (get_mask_tensor().to(device) > 0.5)
+    x = torch.cat([masked, x]) * 2 - 1  # Normalize(mean=0.5, std=0.5)
+    latents = encode_latents(x)  # [2B, 4, 32, 32]
+    latents = torch.cat([latents[:len(crops)], latents[len(crops):]], dim=1)
+    return [latent[None].clone() for latent in latents]
 
 
 def get_crop_box(box, expand):
@@ -202,28 +211,19 @@ def get_crop_box(box, expand):
     return crop_box, s
 
 
-def face_seg(image):
-    seg_image = fp(image)
-    if seg_image is None:
-        print("error, no person_segment")
-        return None
-
-    seg_image = seg_image.resize(image.size)
-    return seg_image
-
-
-def get_image_prepare_material(image, face_box, upper_boundary_ratio=0.5, expand=1.2):
+def crop_face_large(image, face_box, expand=1.2):
     body = Image.fromarray(image[:, :, ::-1])
+    crop_box, s = get_crop_box(face_box, expand)
+    return body.crop(crop_box), crop_box
+
 
+def mask_from_segment(seg_image, face_box, crop_box, upper_boundary_ratio=0.5):
+    '''blurred lower face mask of the crop, from the face parsing of the crop'''
     x, y, x1, y1 = face_box
-    # print(x1-x,y1-y)
-    crop_box, s = get_crop_box(face_box, expand)
     x_s, y_s, x_e, y_e = crop_box
+    ori_shape = (x_e - x_s, y_e - y_s)
 
-    face_large = body.crop(crop_box)
-    ori_shape = face_large.size
-
-    mask_image = face_seg(face_large)
+    mask_image = seg_image.resize(ori_shape)
     mask_small = mask_image.crop((x - x_s, y - y_s, x1 - x_s, y1 - y_s))
     mask_image = Image.new('L', ori_shape, 0)
     mask_image.paste(mask_small, (x - x_s, y - y_s, x1 - x_s, y1 - y_s))
@@ -236,9 +236,29 @@ def get_image_prepare_material(image, face_box, upper_boundary_ratio=0.5, expand
 
     blur_kernel_size = int(0.1 * ori_shape[0] // 2 * 2) + 1
     mask_array = cv2.GaussianBlur(np.array(modified_mask_image), (blur_kernel_size, blur_kernel_size), 0)
+    return mask_array
+
+
+def get_image_prepare_material(image, face_box, upper_boundary_ratio=0.5, expand=1.2):
+    face_large, crop_box = crop_face_large(image, face_box, expand)
+    mask_array = mask_from_segment(fp(face_large), face_box, crop_box, upper_boundary_ratio)
     return mask_array, crop_box
 
 
+def get_prepare_material_batch(frames, face_boxes, pool):
+    '''get_image_prepare_material of a batch: crops and masks on the pool, one face parsing pass'''
+    crops = list(pool.map(crop_face_large, frames, face_boxes))
+    valid = [i for i, (face_large, _) in enumerate(crops) if face_large.size[0] > 0 and face_large.size[1] > 0]
+    segments = dict(zip(valid, fp.parse_batch([crops[i][0] for i in valid]))) if valid else {}
+
+    def finish(i):
+        crop_box = crops[i][1]
+        if i not in segments:  # no face in this frame
+            return np.zeros((1, 1), dtype=np.uint8), crop_box
+        return mask_from_segment(segments[i], face_boxes[i], crop_box), crop_box
+    return list(pool.map(finish, range(len(frames))))
+
+
 ##todo 简单根据文件后缀判断  要更精确的可以自己修改 使用 magic
 def is_video_file(file_path):
     video_exts = ['.mp4', '.mkv', '.flv', '.avi', '.mov']  # 这里列出了一些常见的视频文件扩展名，可以根据需要添加更多
@@ -254,74 +274,96 @@ def create_dir(dir_path):
 current_dir = os.path.dirname(os.path.abspath(__file__))
 
 
-def create_musetalk_human(file, avatar_id):
+def create_musetalk_human(file, avatar_id, save_path=None, bbox_shift=5, batch_size_fa=8,
+                          batch_size_vae=32, batch_size_parse=16, workers=8):
     # 保存文件设置 可以不动
-    save_path = os.path.join(current_dir, f'../data/avatars/avator_{avatar_id}')
-    save_full_path = os.path.join(current_dir, f'../data/avatars/avator_{avatar_id}/full_imgs')
+    if save_path is None:
+        save_path = os.path.join(current_dir, f'../data/avatars/avator_{avatar_id}')
+    save_full_path = os.path.join(save_path, 'full_imgs')
     create_dir(save_path)
     create_dir(save_full_path)
-    mask_out_path = os.path.join(current_dir, f'../data/avatars/avator_{avatar_id}/mask')
+    mask_out_path = os.path.join(save_path, 'mask')
     create_dir(mask_out_path)
 
     # 模型
-    mask_coords_path = os.path.join(current_dir, f'{save_path}/mask_coords.pkl')
-    coords_path = os.path.join(current_dir, f'{save_path}/coords.pkl')
-    latents_out_path = os.path.join(current_dir, f'{save_path}/latents.pt')
+    mask_coords_path = os.path.join(save_path, 'mask_coords.pkl')
+    coords_path = os.path.join(save_path, 'coords.pkl')
+    latents_out_path = os.path.join(save_path, 'latents.pt')
+    blend_masks_path = os.path.join(save_path, 'blend_masks.npy')
+    blend_geometry_path = os.path.join(save_path, 'blend_geometry.npy')
 
-    with open(os.path.join(current_dir, f'{save_path}/avator_info.json'), "w") as f:
+    with open(os.path.join(save_path, 'avator_info.json'), "w") as f:
         json.dump({
             "avatar_id": avatar_id,
             "video_path": file,
-            "bbox_shift": 5
+            "bbox_shift": bbox_shift
         }, f)
 
-    if os.path.isfile(file):
-        if is_video_file(file):
-            video2imgs(file, save_full_path, ext='png')
+    timer = StageTimer()
+    pool = ThreadPoolExecutor(max_workers=workers)  # cv2 and PIL release the GIL
+    writes = []
+
+    with timer('decode'):
+        if os.path.isfile(file):
+            if is_video_file(file):
+                frame_list = decode_video(file)
+            else:
+                frame_list = read_imgs([file])
         else:
-            shutil.copyfile(file, f"{save_full_path}/{os.path.basename(file)}")
-    else:
-        files = os.listdir(file)
-        files.sort()
-        files = [file for file in files if file.split(".")[-1] == "png"]
-        for filename in files:
-            shutil.copyfile(f"{file}/{filename}", f"{save_full_path}/{filename}")
-    input_img_list = sorted(glob.glob(os.path.join(save_full_path, '*.[jpJP][pnPN]*[gG]')))
+            files = sorted(name for name in os.listdir(file) if name.split(".")[-1] == "png")
+            frame_list = read_imgs([os.path.join(file, name) for name in files], pool)
+    # png encoding of the full images runs on the pool while the gpu stages run
+    for i, frame in enumerate(frame_list):
+        writes.append(pool.submit(cv2.imwrite, f"{save_full_path}/{str(i).zfill(8)}.png", frame))
+
     print("extracting landmarks...")
-    coord_list, frame_list = get_landmark_and_bbox(input_img_list, 5)
-    input_latent_list = []
-    idx = -1
+    with timer('landmarks'):
+        coord_list = get_landmark_and_bbox(frame_list, bbox_shift, batch_size_fa, pool)
+
     # maker if the bbox is not sufficient
     coord_placeholder = (0.0, 0.0, 0.0, 0.0)
-    for bbox, frame in zip(coord_list, frame_list):
-        idx = idx + 1
-        if bbox == coord_placeholder:
-            continue
-        x1, y1, x2, y2 = bbox
-        crop_frame = frame[y1:y2, x1:x2]
-        resized_crop_frame = cv2.resize(crop_frame, (256, 256), interpolation=cv2.INTER_LANCZOS4)
-        latents = get_latents_for_unet(resized_crop_frame)
-        input_latent_list.append(latents)
+    with timer('latents'):
+        def crop_face(i):
+            x1, y1, x2, y2 = coord_list[i]
+            crop_frame = frame_list[i][y1:y2, x1:x2]
+            return cv2.resize(crop_frame, (256, 256), interpolation=cv2.INTER_LANCZOS4)
+        valid = [i for i, bbox in enumerate(coord_list) if bbox != coord_placeholder]
+        input_latent_list = []
+        for start in tqdm(range(0, len(valid), batch_size_vae)):
+            crops = list(pool.map(crop_face, valid[start:start + batch_size_vae]))
+            input_latent_list += get_latents_for_unet(crops)
 
     frame_list_cycle = frame_list #+ frame_list[::-1]
     coord_list_cycle = coord_list #+ coord_list[::-1]
     input_latent_list_cycle = input_latent_list #+ input_latent_list[::-1]
     mask_coords_list_cycle = []
-    mask_list_cycle = []
-    for i, frame in enumerate(tqdm(frame_list_cycle)):
-        cv2.imwrite(f"{save_full_path}/{str(i).zfill(8)}.png", frame)
-        face_box = coord_list_cycle[i]
-        mask, crop_box = get_image_prepare_material(frame, face_box)
-        cv2.imwrite(f"{mask_out_path}/{str(i).zfill(8)}.png", mask)
-        mask_coords_list_cycle += [crop_box]
-        mask_list_cycle.append(mask)
-
-    with open(mask_coords_path, 'wb') as f:
-        pickle.dump(mask_coords_list_cycle, f)
-
-    with open(coords_path, 'wb') as f:
-        pickle.dump(coord_list_cycle, f)
-    torch.save(input_latent_list_cycle, os.path.join(latents_out_path))
+    blend_mask_list = []
+    blend_geometry = []
+    with timer('masks'):
+        for start in tqdm(range(0, len(frame_list_cycle), batch_size_parse)):
+            frames = frame_list_cycle[start:start + batch_size_parse]
+            face_boxes = coord_list_cycle[start:start + batch_size_parse]
+            for i, (mask, crop_box) in enumerate(get_prepare_material_batch(frames, face_boxes, pool), start):
+                writes.append(pool.submit(cv2.imwrite, f"{mask_out_path}/{str(i).zfill(8)}.png", mask))
+                mask_coords_list_cycle += [crop_box]
+                blend_mask, geometry = get_blend_material(mask, coord_list_cycle[i], crop_box)
+                blend_mask_list.append(blend_mask.reshape(-1))
+                blend_geometry.append(geometry)
+
+    with timer('save'):
+        np.save(blend_masks_path, np.concatenate(blend_mask_list))
+        np.save(blend_geometry_path, np.asarray(blend_geometry, dtype=np.int32))
+
+        with open(mask_coords_path, 'wb') as f:
+            pickle.dump(mask_coords_list_cycle, f)
+
+        with open(coords_path, 'wb') as f:
+            pickle.dump(coord_list_cycle, f)
+        torch.save(input_latent_list_cycle, os.path.join(latents_out_path))
+        for write in writes:  # pending png writes
+            write.result()
+    pool.shutdown()
+    timer.report(len(frame_list))
 
 
 # initialize the mmpose model
@@ -330,6 +372,7 @@ fa = FaceAlignment(1, flip_input=False, device=device)
 config_file = os.path.join(current_dir, 'utils/dwpose/rtmpose-l_8xb32-270e_coco-ubody-wholebody-384x288.py')
 checkpoint_file = os.path.abspath(os.path.join(current_dir, '../models/dwpose/dw-ll_ucoco_384.pth'))
 model = init_model(config_file, checkpoint_file, device=device)
+pose_pipeline = Compose(model.cfg.test_dataloader.dataset.pipeline)
 vae = AutoencoderKL.from_pretrained(os.path.abspath(os.path.join(current_dir, '../models/sd-vae-ft-mse')))
 vae.to(device)
 fp = FaceParsing(os.path.abspath(os.path.join(current_dir, '../models/face-parse-bisent/resnet18-5c106cde.pth')),
@@ -345,5 +388,12 @@ if __name__ == '__main__':
                         type=str,
                         default='3',
                         )
+    parser.add_argument("--save_path", type=str, default=None, help="avatar directory, default data/avatars/avator_<avatar_id>")
+    parser.add_argument("--bbox_shift", type=int, default=5)
+    parser.add_argument("--batch_size_fa", type=int, default=8, help="frames per face detection and landmark pass")
+    parser.add_argument("--batch_size_vae", type=int, default=32, help="faces per vae encode")
+    parser.add_argument("--batch_size_parse", type=int, default=16, help="faces per face parsing pass")
+    parser.add_argument("--workers", type=int, default=min(8, os.cpu_count() or 1), help="threads of the cpu steps")
     args = parser.parse_args()
-    create_musetalk_human(args.file, args.avatar_id)
+    create_musetalk_human(args.file, args.avatar_id, args.save_path, args.bbox_shift, args.batch_size_fa,
+                          args.batch_size_vae, args.batch_size_parse, args.workers)
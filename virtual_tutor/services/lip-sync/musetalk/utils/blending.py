@@ -1,6 +1,9 @@
 from PIL import Image
 import numpy as np
 import cv2
+import torch
+import torch.nn.functional as F
+from threading import local
 from face_parsing import FaceParsing
 import copy
 
@@ -122,4 +125,67 @@ def get_image_blending(image,face,face_box,mask_array,crop_box):
     body[y_s:y_e, x_s:x_e] = cv2.blendLinear(face_large,body[y_s:y_e, x_s:x_e],mask_image,1-mask_image)
 
     #body.paste(face_large, crop_box[:2], mask_image)
-    return body
\ No newline at end of file
+    return body
+
+class FaceBlender:
+    '''
+    Batched get_image_blending on the device of the model.
+    Outside the face box the pasted face_large equals the original frame, so only the face box
+    is blended: patch = body + mask*(face-body), one fused multiply-add. blend_masks are the float16
+    (h,w,1) masks cut to the face box, blend_bodies the uint8 (h,w,3) frame pixels of the face box
+    and geometry the per frame table written by the avatar build (see avatarstore.BLEND_GEOMETRY),
+    masks and bodies memory mapped from the avatar pack.
+    Nothing per frame stays on the device: the face boxes and masks of a batch are gathered into
+    pinned staging buffers padded to the largest face box and uploaded with one copy each.
+    '''
+    def __init__(self,blend_masks,blend_bodies,geometry,device):
+        self.blend_masks = blend_masks
+        self.blend_bodies = blend_bodies
+        self.geometry = np.asarray(geometry).tolist()
+        self.device = torch.device(device)
+        sizes = np.asarray(geometry)[:,8:10].reshape(-1,2)
+        self.max_w,self.max_h = (int(v) for v in sizes.max(axis=0)) if len(sizes) else (0,0)
+        self._local = local() #staging buffers of the calling inference thread
+
+    def _staging(self,batch_size):
+        staging = getattr(self._local,'staging',None)
+        if staging is None or staging[0].shape[0]<batch_size:
+            pin = self.device.type=='cuda'
+            staging = (torch.empty((batch_size,self.max_h,self.max_w,3),dtype=torch.uint8,pin_memory=pin),
+                       torch.zeros((batch_size,self.max_h,self.max_w,1),dtype=torch.float16,pin_memory=pin))
+            self._local.staging = staging
+        return staging
+
+    @torch.no_grad()
+    def __call__(self,faces,indices):
+        '''
+        faces: (B,3,h,w) BGR 0..255 predicted faces on the device, indices: their avatar frames.
+        returns the blended face box of every frame as uint8 (y1-y,x1-x,3), ready to be pasted
+        '''
+        if len(indices)==0:
+            return []
+        batch_size = len(indices)
+        sizes = [self.geometry[idx][8:10] for idx in indices]
+        bodies,masks = self._staging(batch_size)
+        bodies_np,masks_np = bodies.numpy(),masks.numpy()
+        for i,(idx,(w,h)) in enumerate(zip(indices,sizes)):
+            if w and h: #the padding is never read back
+                bodies_np[i,:h,:w] = self.blend_bodies[idx]
+                masks_np[i,:h,:w] = self.blend_masks[idx]
+        body = bodies[:batch_size].to(faces.device,non_blocking=True).float()
+        mask = masks[:batch_size].to(faces.device,non_blocking=True).float()
+        #resize every face to its own box inside the padded canvas with one grid_sample,
+        #the same sampling as F.interpolate(bilinear, align_corners=False)
+        theta = np.zeros((batch_size,2,3),dtype=np.float32)
+        for i,(w,h) in enumerate(sizes):
+            sx = self.max_w/w if w else 1.
+            sy = self.max_h/h if h else 1.
+            theta[i,0,0],theta[i,0,2] = sx,sx-1
+            theta[i,1,1],theta[i,1,2] = sy,sy-1
+        theta = torch.from_numpy(theta).to(faces.device)
+        grid = F.affine_grid(theta,(batch_size,3,self.max_h,self.max_w),align_corners=False)
+        face = F.grid_sample(faces.float(),grid,mode='bilinear',padding_mode='border',align_corners=False)
+        patch = torch.addcmul(body,mask,face.permute(0,2,3,1)-body)
+        #one device to host copy for the whole batch, every frame is a view of its face box
+        patch = patch.round_().clamp_(0,255).to(torch.uint8).cpu().numpy()
+        return [patch[i,:h,:w] for i,(w,h) in enumerate(sizes)]
@@ -50,6 +50,21 @@ class FaceParsing():
         parsing = Image.fromarray(parsing.astype(np.uint8))
         return parsing
 
+    def parse_batch(self, images, size=(512, 512)):
+        '''__call__ for a list of PIL images, one forward pass'''
+        with torch.no_grad():
+            img = torch.stack([self.preprocess(image.resize(size, Image.BILINEAR)) for image in images])
+            if torch.cuda.is_available():
+                img = img.cuda()
+            out = self.net(img)[0]
+            parsing = out.argmax(1).cpu().numpy()
+        results = []
+        for p in parsing:
+            p[p>13] = 0
+            p[p>=1] = 255
+            results.append(Image.fromarray(p.astype(np.uint8)))
+        return results
+
 if __name__ == "__main__":
     fp = FaceParsing()
     segmap = fp('154_small.png')
@@ -1,7 +1,9 @@
 import os
 from .whisper import load_model
+from .whisper.audio import N_FFT, N_MELS, HOP_LENGTH, mel_filters
 import soundfile as sf
 import numpy as np
+import torch
 import time
 import sys
 sys.path.append("..")
@@ -111,6 +113,79 @@ class Audio2Feature():
         concatenated_array = np.concatenate(embed_list, axis=0)
         return concatenated_array
 
+class Audio2FeatureStream():
+    """
+    Streaming whisper features for one live audio stream.
+    Log-mel frames are computed once, for the newly pushed samples only, and kept in a rolling
+    buffer that the overlapping windows share. Each step encodes just the current window with a
+    trimmed positional embedding instead of padding it to a 30s segment.
+    """
+    def __init__(self, audio_processor:Audio2Feature):
+        self.model = audio_processor.model
+        self.device = self.model.device
+        self.dtype = torch.float16 if self.device.type == 'cuda' else torch.float32
+        self.stft_window = torch.hann_window(N_FFT).to(self.device)
+        self.filters = mel_filters(self.device)
+        self.half_fft = N_FFT // 2
+        # samples from self.audio_start on, the stream starts with half a window of silence
+        self.audio = np.zeros(self.half_fft, dtype=np.float32)
+        self.audio_start = -self.half_fft
+        self.total = 0
+        # log10 mel frames from self.mel_start on, frame g is centered on sample g*HOP_LENGTH
+        self.mel = torch.zeros((N_MELS, 0), device=self.device)
+        self.mel_start = 0
+
+    def _log10_mel(self, samples):
+        audio = torch.from_numpy(samples).to(self.device)
+        stft = torch.stft(audio, N_FFT, HOP_LENGTH, window=self.stft_window, center=False, return_complex=True)
+        mel_spec = self.filters @ (stft.abs() ** 2)
+        return torch.clamp(mel_spec, min=1e-10).log10()
+
+    def push(self, audio):
+        """
+        append 16k samples and compute the mel frames they complete
+        :param audio: float32 pcm
+        """
+        self.audio = np.concatenate([self.audio, audio.astype(np.float32)])
+        self.total += len(audio)
+        mel_end = (self.total - self.half_fft) // HOP_LENGTH + 1
+        mel_have = self.mel_start + self.mel.shape[1]
+        if mel_end > mel_have:
+            begin = mel_have * HOP_LENGTH - self.half_fft - self.audio_start
+            end = (mel_end - 1) * HOP_LENGTH + self.half_fft - self.audio_start
+            self.mel = torch.cat([self.mel, self._log10_mel(self.audio[begin:end])], dim=1)
+
+    @torch.no_grad()
+    def encode(self, num_samples):
+        """
+        encode the window made of the last num_samples pushed samples
+        :param num_samples: window length, a multiple of 2*HOP_LENGTH
+        :return: features of shape (num_samples/320, n_layer+1, 384), the same as audio2feat
+        """
+        mel_start = (self.total - num_samples) // HOP_LENGTH
+        mel_end = self.total // HOP_LENGTH
+        mel_have = self.mel_start + self.mel.shape[1]
+        mel = self.mel[:, mel_start - self.mel_start:mel_have - self.mel_start]
+        if mel_end > mel_have:
+            # the last frames need samples not pushed yet, pad them by reflection as torch.stft(center=True) does
+            tail = self.audio[mel_have * HOP_LENGTH - self.half_fft - self.audio_start:]
+            pad = (mel_end - 1) * HOP_LENGTH + self.half_fft - self.total
+            tail = np.pad(tail, (0, pad), mode='reflect')
+            mel = torch.cat([mel, self._log10_mel(tail)], dim=1)
+        mel = torch.maximum(mel, mel.max() - 8.0)
+        mel = (mel + 4.0) / 4.0
+
+        embeddings = self.model.encoder.embed_window(mel.unsqueeze(0).to(self.dtype))
+        features = embeddings[0].transpose(0, 1).cpu().numpy()
+
+        # the next window starts later, drop what is before this one
+        self.mel = self.mel[:, mel_start - self.mel_start:]
+        self.mel_start = mel_start
+        keep = mel_start * HOP_LENGTH - self.half_fft
+        self.audio = self.audio[keep - self.audio_start:]
+        self.audio_start = keep
+        return features
+
 if __name__ == "__main__":
     audio_processor = Audio2Feature(model_path="../../models/whisper/whisper_tiny.pt")
     audio_path = "./test.mp3"
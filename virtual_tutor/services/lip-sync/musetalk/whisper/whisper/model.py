@@ -170,6 +170,27 @@ class AudioEncoder(nn.Module):
         else:
             return x
 
+    def embed_window(self, x: Tensor):
+        """
+        x : torch.Tensor, shape = (batch_size, n_mels, n_frames), n_frames <= 2*n_ctx
+            a short mel window, encoded with the matching slice of the positional embedding
+            instead of being padded to 30 seconds
+        return the input and intermediate embeddings of all layers,
+            shape = (batch_size, n_layer+1, n_frames//2, n_state), kept on the model device
+        """
+        x = F.gelu(self.conv1(x))
+        x = F.gelu(self.conv2(x))
+        x = x.permute(0, 2, 1)
+
+        assert x.shape[1] <= self.positional_embedding.shape[0], "audio window too long"
+        x = (x + self.positional_embedding[:x.shape[1]]).to(x.dtype)
+
+        embeddings = [x]
+        for block in self.blocks:
+            x = block(x)
+            embeddings.append(x)
+        return torch.stack(embeddings, dim=1)
+
 
 class TextDecoder(nn.Module):
     def __init__(self, n_vocab: int, n_ctx: int, n_state: int, n_head: int, n_layer: int):
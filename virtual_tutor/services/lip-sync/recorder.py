@@ -0,0 +1,145 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+'''
+In process recording of a session into one muxed mp4.
+process_frames only enqueues, the encoding runs on the recorder thread. Every frame
+carries its timestamp from the moment it was offered, so a frame dropped because the
+encoder fell behind leaves a gap (the previous video frame is held, the audio is filled
+with silence) instead of shifting audio and video against each other.
+'''
+
+import os
+import queue
+import time
+from fractions import Fraction
+from threading import Thread
+
+import av
+import numpy as np
+
+from logger import logger
+
+VIDEO_QUEUE = 50 #2s at 25fps
+AUDIO_QUEUE = 500 #10s of 20ms frames
+
+
+class SessionRecorder:
+    def __init__(self, path, width, height, fps=25, sample_rate=16000):
+        self.path = path
+        self.width = width&~1 #yuv420p needs even dims
+        self.height = height&~1
+        self.fps = fps
+        self.sample_rate = sample_rate
+        self._video = queue.Queue(maxsize=VIDEO_QUEUE)
+        self._audio = queue.Queue(maxsize=AUDIO_QUEUE)
+        self._video_pts = 0 #frames offered so far
+        self._audio_pts = 0 #samples offered so far
+        self.recording = False
+        self.stats = {'record_video_frames':0,'record_video_dropped':0,
+                      'record_audio_frames':0,'record_audio_dropped':0}
+        self._thread = None
+
+    def start(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.recording = True
+        self._thread = Thread(target=self._run, daemon=True, name="recorder")
+        self._thread.start()
+
+    def put_video(self, image):
+        '''bgr24 image of the next video frame, never blocks'''
+        if not self.recording:
+            return
+        pts = self._video_pts
+        self._video_pts += 1
+        if self._video.full(): #only the recorder thread takes, full stays full
+            self.stats['record_video_dropped'] += 1
+            return
+        self._video.put_nowait((pts,image.copy()))
+
+    def put_audio(self, frame):
+        '''int16 mono samples of the next audio frame, never blocks'''
+        if not self.recording:
+            return
+        pts = self._audio_pts
+        self._audio_pts += len(frame)
+        try:
+            self._audio.put_nowait((pts,frame.copy()))
+        except queue.Full:
+            self.stats['record_audio_dropped'] += 1
+
+    def stop(self):
+        '''stop, flush the encoders and close the file, returns its path'''
+        if not self.recording:
+            return self.path
+        self.recording = False
+        self._thread.join()
+        return self.path
+
+    def get_stats(self)->dict:
+        return dict(self.stats)
+
+    def _run(self):
+        container = av.open(self.path, mode="w")
+        videostream = container.add_stream("libx264", rate=self.fps)
+        videostream.width = self.width
+        videostream.height = self.height
+        videostream.pix_fmt = "yuv420p"
+        videostream.time_base = Fraction(1, self.fps)
+        audiostream = container.add_stream("aac", rate=self.sample_rate)
+        audiostream.layout = "mono"
+        audiostream.time_base = Fraction(1, self.sample_rate)
+        audio_next = 0 #samples written
+        t = time.perf_counter()
+        try:
+            while self.recording or not self._video.empty() or not self._audio.empty():
+                try:
+                    pts,image = self._video.get(timeout=0.02)
+                    frame = av.VideoFrame.from_ndarray(image, format="bgr24") #scaled by encode if the size differs
+                    frame.pts = pts
+                    frame.time_base = videostream.time_base
+                    container.mux(videostream.encode(frame))
+                    self.stats['record_video_frames'] += 1
+                except queue.Empty:
+                    pass
+                while True:
+                    try:
+                        pts,samples = self._audio.get_nowait()
+                    except queue.Empty:
+                        break
+                    if pts > audio_next: #dropped audio, keep the timeline
+                        samples = np.concatenate((np.zeros(pts-audio_next,dtype=np.int16),samples))
+                    elif pts < audio_next:
+                        samples = samples[audio_next-pts:]
+                    if len(samples)==0:
+                        continue
+                    frame = av.AudioFrame.from_ndarray(samples.reshape(1,-1), format='s16', layout='mono')
+                    frame.sample_rate = self.sample_rate
+                    frame.pts = audio_next
+                    frame.time_base = audiostream.time_base
+                    audio_next += len(samples)
+                    container.mux(audiostream.encode(frame))
+                    self.stats['record_audio_frames'] += 1
+            container.mux(videostream.encode(None))
+            container.mux(audiostream.encode(None))
+        except Exception:
+            logger.exception('recorder')
+        finally:
+            container.close()
+        logger.info('record %s: %d video frames (%d dropped), %.1fs audio in %.1fs',self.path,
+                    self.stats['record_video_frames'],self.stats['record_video_dropped'],
+                    audio_next/self.sample_rate,time.perf_counter()-t)
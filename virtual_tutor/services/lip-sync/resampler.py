@@ -0,0 +1,142 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+'''
+Streaming resampling of tts audio into fixed 20ms frames.
+One StreamResampler per tts stream: the polyphase filter of a rate pair is designed once
+per process, the filter history and the samples that do not fill a frame yet are carried
+from one network chunk to the next, so chunk boundaries are neither clicked nor dropped.
+'''
+
+from math import gcd
+
+import numpy as np
+
+TAPS_PER_PHASE = 32
+KAISER_BETA = 8.0
+ROLLOFF = 0.94
+
+_filters = {} #(up,down) -> (L,J) polyphase filter bank
+
+
+def _polyphase_filter(up, down):
+    '''windowed sinc lowpass at the upsampled rate, split into up phases of TAPS_PER_PHASE taps'''
+    key = (up,down)
+    if key not in _filters:
+        ntaps = TAPS_PER_PHASE*up - 1 #odd: integer group delay
+        cutoff = ROLLOFF*0.5/max(up,down) #cycles per upsampled sample
+        t = np.arange(ntaps) - (ntaps-1)/2
+        h = 2*cutoff*np.sinc(2*cutoff*t)*np.kaiser(ntaps, KAISER_BETA)
+        h = np.append(h*up/h.sum(), 0) #unity dc gain after zero stuffing
+        #bank[p,j] = h[p+j*up], applied to x[i0-j]
+        _filters[key] = np.ascontiguousarray(h.reshape(TAPS_PER_PHASE,up).T).astype(np.float32)
+    return _filters[key]
+
+
+class StreamResampler:
+    '''
+    push() any number of samples at sr_orig, get back the complete frames of frame samples
+    at sr_new as a (n,frame) float32 array. flush() returns the tail, zero padded to a frame.
+    '''
+    def __init__(self, sr_new=16000, frame=320):
+        self.sr_new = sr_new
+        self.frame = frame
+        self.sr_orig = None
+        self._pending = np.zeros(0, dtype=np.float32) #resampled, not a full frame yet
+        self._odd = b'' #half of an int16 sample split by the network
+
+    def _reset(self, sr_orig):
+        self.sr_orig = sr_orig
+        g = gcd(sr_orig, self.sr_new)
+        self.up = self.sr_new//g
+        self.down = sr_orig//g
+        if self.up==1 and self.down==1:
+            return
+        self.bank = _polyphase_filter(self.up, self.down)
+        taps = self.bank.shape[1]
+        self._history = np.zeros(taps-1, dtype=np.float32) #last input samples, x[-taps+1:]
+        self._consumed = 0 #absolute input index of self._history[-1]+1
+        #linear phase delay, the first output sample lines up with the first input sample
+        self._delay = (self.bank.size-2)//2
+        self._next = 0 #next output sample
+
+    def _resample(self, x):
+        if self.up==1 and self.down==1:
+            return x
+        taps = self.bank.shape[1]
+        buf = np.concatenate((self._history, x))
+        base = self._consumed - (taps-1) #absolute input index of buf[0]
+        end = self._consumed + len(x)
+        #output n covers input (n*down+delay)//up and the taps-1 samples before it
+        last = (end*self.up - self._delay - 1)//self.down #last output whose newest input is available
+        if last < self._next:
+            out = np.zeros(0, dtype=np.float32)
+        else:
+            n = np.arange(self._next, last+1, dtype=np.int64)
+            t = n*self.down + self._delay
+            i0 = t//self.up - base
+            phase = t % self.up
+            idx = i0[:,None] - np.arange(taps)[None,:]
+            out = np.einsum('ij,ij->i', buf[np.maximum(idx,0)]*(idx>=0), self.bank[phase]).astype(np.float32)
+            self._next = last+1
+        self._history = buf[-(taps-1):] if taps>1 else buf[:0]
+        self._consumed = end
+        return out
+
+    def _frames(self, y):
+        y = np.concatenate((self._pending, y)) if len(self._pending) else y
+        n = len(y)//self.frame
+        self._pending = y[n*self.frame:]
+        return y[:n*self.frame].reshape(n, self.frame)
+
+    def push(self, samples, sr_orig):
+        if sr_orig != self.sr_orig:
+            if self.sr_orig is not None:
+                self._pending = np.concatenate((self._pending, self._drain()))
+            self._reset(sr_orig)
+        return self._frames(self._resample(np.asarray(samples, dtype=np.float32)))
+
+    def push_pcm16(self, data, sr_orig):
+        data = self._odd + data
+        if len(data) % 2:
+            self._odd = data[-1:]
+            data = data[:-1]
+        else:
+            self._odd = b''
+        return self.push(np.frombuffer(data, dtype=np.int16).astype(np.float32)/32767, sr_orig)
+
+    def _drain(self):
+        '''the output still held back by the filter delay'''
+        if self.sr_orig is None or (self.up==1 and self.down==1):
+            return np.zeros(0, dtype=np.float32)
+        taps = self.bank.shape[1]
+        total = (self._consumed*self.up + self.down - 1)//self.down #output samples of the whole input
+        zeros = np.zeros(taps + self._delay//self.up + 1, dtype=np.float32)
+        end = self._next
+        y = self._resample(zeros)
+        return y[:max(total-end,0)]
+
+    def flush(self):
+        '''remaining audio of the stream, the last frame zero padded'''
+        y = np.concatenate((self._pending, self._drain()))
+        self._pending = np.zeros(0, dtype=np.float32)
+        self._odd = b''
+        self.sr_orig = None
+        if len(y)==0:
+            return y.reshape(0, self.frame)
+        y = np.pad(y, (0, -len(y) % self.frame))
+        return y.reshape(-1, self.frame)
@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+from threading import Thread
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from audioring import AudioFifo
+
+# =============================================================================
+# Audio FIFO Flush Test
+# =============================================================================
+
+CHUNK = 320
+CAPACITY = 4
+
+
+def test_put_blocked_across_flush():
+    """
+    Test a tts frame blocked in put of the full fifo while the utterance is flushed
+    Method:
+      1. Fill the fifo with frames of generation 0, a tts thread blocks putting one more
+      2. Flush: the generation becomes 1 and the fifo is cleared, the blocked put lands
+      3. Put a frame of generation 1, read with generation 1
+    Expected Result:
+      - The frame that was blocked across the flush is dropped, not played
+      - The frame of the new generation is read with its eventpoint
+    """
+    print("\n=== AudioFifo put blocked across flush ===")
+    fifo = AudioFifo(CHUNK, CAPACITY)
+    for _ in range(CAPACITY):
+        fifo.put(np.ones(CHUNK, np.float32), None, 0)
+    blocked = Thread(target=fifo.put, args=(np.full(CHUNK, 2.0, np.float32), {"status": "end"}, 0))
+    blocked.start()
+    time.sleep(0.05)
+    assert blocked.is_alive()
+
+    fifo.clear()
+    blocked.join(timeout=5)
+    assert not blocked.is_alive()
+    assert fifo.qsize() == 1
+
+    out = np.zeros(CHUNK, np.float32)
+    assert fifo.get_into(out, 1) == (False, None)
+    assert fifo.qsize() == 0
+    print("✓ stale frame dropped")
+
+    fifo.put(np.full(CHUNK, 3.0, np.float32), {"status": "start"}, 1)
+    assert fifo.get_into(out, 1) == (True, {"status": "start"})
+    assert np.all(out == 3.0)
+    print("✓ frame of the new generation read")
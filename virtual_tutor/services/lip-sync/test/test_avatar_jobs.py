@@ -0,0 +1,70 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import avatarjobs
+from avatarjobs import AvatarJob, AvatarJobManager
+
+# =============================================================================
+# Avatar Job Queue Restart Test
+# =============================================================================
+
+
+def write_job(jobs_dir, job_id, avatar_name, state, with_input):
+    work_dir = os.path.join(jobs_dir, job_id)
+    os.makedirs(work_dir)
+    job = AvatarJob(job_id, avatar_name, False, work_dir)
+    job.state = state
+    if state == "running":
+        job.stage = "landmarks"
+        job.stages["landmarks"]["state"] = "running"
+    with open(os.path.join(work_dir, "job.json"), "w", encoding="utf-8") as f:
+        json.dump(job.to_dict(), f)
+    if with_input:
+        with open(job.input_path, "wb") as f:
+            f.write(b"video")
+    return job
+
+
+def test_reload_jobs_dir(tmp_path, monkeypatch):
+    """
+    Test resolving the jobs of a previous run when the manager starts
+    Method:
+      1. Write a jobs directory with a created job (upload interrupted), a queued job
+         with its input, a queued job without input and a running job
+      2. Create an AvatarJobManager on it, _run is replaced so nothing is built
+    Expected Result:
+      - Only the queued job with its input is requeued
+      - The created, input-less queued and running jobs are failed
+      - Their avatar names can be used by a new job and they do not count as pending
+    """
+    print("\n=== Avatar jobs reload after restart ===")
+    jobs_dir = str(tmp_path)
+    write_job(jobs_dir, "created0001", "avatar_created", "created", with_input=False)
+    write_job(jobs_dir, "queued00001", "avatar_queued", "queued", with_input=True)
+    write_job(jobs_dir, "queued00002", "avatar_no_input", "queued", with_input=False)
+    write_job(jobs_dir, "running0001", "avatar_running", "running", with_input=True)
+
+    ran = []
+    monkeypatch.setattr(AvatarJobManager, "_run", lambda self, job: ran.append(job.job_id))
+    manager = AvatarJobManager(jobs_dir, workers=1, max_pending=2)
+    manager.pool.shutdown(wait=True)
+
+    assert ran == ["queued00001"]
+    assert manager.get("queued00001").state == "queued"
+    for job_id in ("created0001", "queued00002", "running0001"):
+        job = manager.get(job_id)
+        assert job.state == "failed", job_id
+        assert "restart" in job.error
+        with open(os.path.join(jobs_dir, job_id, "job.json"), encoding="utf-8") as f:
+            assert json.load(f)["state"] == "failed"
+    assert manager.get("running0001").stages["landmarks"]["state"] == "failed"
+
+    # the failed jobs no longer block their avatar name
+    manager.pool = avatarjobs.ThreadPoolExecutor(max_workers=1)
+    for avatar_name in ("avatar_created", "avatar_no_input", "avatar_running"):
+        job = manager.new_job(avatar_name)
+        manager.cancel(job.job_id)
+    print("✓ stale jobs failed, queued job requeued")
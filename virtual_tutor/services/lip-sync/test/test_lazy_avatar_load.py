@@ -0,0 +1,72 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import avatarpack
+import avatarstore
+import musereal
+
+# =============================================================================
+# Lazy Avatar Load Test
+# =============================================================================
+
+FRAMES = 200
+PREFETCH = 10
+
+
+def write_avatar(avatar_path):
+    """musetalk avatar package with png frames, so the frames are decoded lazily"""
+    os.makedirs(avatar_path)
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 255, (FRAMES, 32, 32, 3), dtype=np.uint8)
+    masks = rng.integers(0, 255, (FRAMES, 24, 24, 3), dtype=np.uint8)
+    coords = np.tile([8, 8, 24, 24], (FRAMES, 1))
+    mask_coords = np.tile([4, 4, 28, 28], (FRAMES, 1))
+    geometry = np.tile([8, 8, 24, 24, 4, 4, 28, 28, 16, 16], (FRAMES, 1)).astype(np.int32)
+    blend_masks = np.concatenate([avatarstore.get_blend_material(mask, box, crop)[0].reshape(-1)
+                                  for mask, box, crop in zip(masks, coords, mask_coords)])
+    writer = avatarpack.PackWriter(avatarpack.pack_file_of(avatar_path))
+    writer.add_frames("full_imgs", frames, "png", mark=True)
+    writer.add_frames("mask", masks, "png")
+    writer.add_array("coords", coords)
+    writer.add_array("mask_coords", mask_coords)
+    writer.add_array("latents", rng.random((FRAMES, 8, 4, 4), dtype=np.float32))
+    writer.add_array(avatarstore.BLEND_MASKS, blend_masks)
+    writer.add_array(avatarstore.BLEND_BODIES, avatarstore.build_blend_bodies(frames, geometry))
+    writer.add_array(avatarstore.BLEND_GEOMETRY, geometry)
+    writer.close()
+
+
+def test_musereal_load_is_lazy(tmp_path, monkeypatch):
+    """
+    Test that loading a musetalk avatar with --frame_cache_mb does not decode the avatar
+    Method:
+      1. Package a 200 frame avatar with png frames
+      2. Enable lazy loading (prefetch 10 frames), count the decoded frames
+      3. musereal.load_avatar, then read one frame through a session reader
+    Expected Result:
+      - The load decodes at most the prefetch window, not every frame
+      - A session read decodes the frame and at most the prefetch window after it
+    """
+    print("\n=== MuseReal lazy avatar load ===")
+    monkeypatch.chdir(tmp_path)
+    write_avatar(os.path.join("data", "avatars", "lazy_avatar"))
+    monkeypatch.setattr(avatarpack, "frame_cache_mb", 1)
+    monkeypatch.setattr(avatarpack, "prefetch_frames", PREFETCH)
+    decoded = []
+    decode = avatarpack._decode
+    monkeypatch.setattr(avatarpack, "_decode", lambda *args, **kwargs: decoded.append(1) or decode(*args, **kwargs))
+
+    frame_list_cycle, mask_list_cycle, *_, blender = musereal.load_avatar("lazy_avatar")
+    assert isinstance(frame_list_cycle, avatarpack.LazyFrames)
+    assert isinstance(mask_list_cycle, avatarpack.LazyFrames)
+    assert len(decoded) <= PREFETCH
+    print(f"✓ load decoded {len(decoded)} of {FRAMES} frames")
+
+    reader = frame_list_cycle.reader()
+    assert reader[0].shape == (32, 32, 3)
+    assert len(decoded) <= 1 + 2 * PREFETCH
+    print(f"✓ first read decoded {len(decoded)} frames")
@@ -0,0 +1,136 @@
+import asyncio
+import os
+import sys
+import time
+from threading import Event
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import ttsreal
+from ttsreal import EdgeTTS
+
+# =============================================================================
+# TTS Flush (Barge-in) Test
+# =============================================================================
+
+STREAM_CHUNKS = 50
+
+
+class FakeCommunicate:
+    """
+    edge_tts.Communicate streaming STREAM_CHUNKS audio chunks of its text, 20ms apart.
+    The stream of "a" holds after its second chunk until resume is set.
+    """
+    streamed = {}
+    resume = Event()
+
+    def __init__(self, text, voice):
+        self.text = text
+
+    async def stream(self):
+        for _ in range(STREAM_CHUNKS):
+            await asyncio.sleep(0.02)
+            FakeCommunicate.streamed[self.text] = FakeCommunicate.streamed.get(self.text, 0) + 1
+            yield {"type": "audio", "data": self.text.encode()}
+            while self.text == "a" and FakeCommunicate.streamed["a"] >= 2 and not FakeCommunicate.resume.is_set():
+                await asyncio.sleep(0.01)
+
+
+class Parent:
+    def __init__(self):
+        self.frames = []
+
+    def put_audio_frame(self, audio_chunk, eventpoint=None):
+        self.frames.append((float(audio_chunk[0]), eventpoint))
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_flush_during_edgetts_stream(monkeypatch):
+    """
+    Test flushing a sentence while edge tts is still streaming it
+    Method:
+      1. Queue sentence "a", flush once its stream has started, then queue sentence "b";
+         "a" streams on once "b" was taken up and set the state back to RUNNING
+      2. Every sentence decodes to frames holding its own value: "a" 1.0, "b" 2.0
+    Expected Result:
+      - The stream of "a" stops early instead of running to its end
+      - No frame of "a" is played, all frames of "b" are played
+    """
+    print("\n=== EdgeTTS flush during stream ===")
+    FakeCommunicate.streamed = {}
+    FakeCommunicate.resume.clear()
+    monkeypatch.setattr(ttsreal.edge_tts, "Communicate", FakeCommunicate)
+    monkeypatch.setattr(EdgeTTS, "_EdgeTTS__create_bytes_stream",
+                        lambda self, stream: np.full(self.chunk * 5, 1.0 if stream.getvalue()[:1] == b"a" else 2.0,
+                                                     dtype=np.float32))
+    opt = SimpleNamespace(fps=50, tts_prefetch=2, REF_FILE="zh-CN-YunxiaNeural")
+    parent = Parent()
+    tts = EdgeTTS(opt, parent)
+    quit_event = Event()
+    tts.render(quit_event)
+    try:
+        tts.put_msg_txt("a")
+        wait_for(lambda: FakeCommunicate.streamed.get("a", 0) >= 2)
+        tts.flush_talk()
+        tts.put_msg_txt("b")
+        wait_for(lambda: "b" in FakeCommunicate.streamed)
+        assert tts.state == ttsreal.State.RUNNING
+        FakeCommunicate.resume.set()
+        wait_for(lambda: sum(value == 2.0 for value, _ in parent.frames) == 5)
+    finally:
+        quit_event.set()
+
+    assert FakeCommunicate.streamed["a"] < STREAM_CHUNKS
+    assert all(value == 2.0 for value, _ in parent.frames)
+    print("✓ flushed sentence stopped streaming and was not played")
+
+
+def test_flush_after_dequeue(monkeypatch):
+    """
+    Test flushing right after the prefetch took a sentence from the message queue
+    Method:
+      1. Queue sentence "a", the message queue flushes as soon as "a" is dequeued
+      2. Run one prefetch step with an executor recording the submitted sentences
+      3. Queue sentence "b" and run another prefetch step
+    Expected Result:
+      - "a" is dropped: no job is queued and nothing is synthesized
+      - "b", queued after the flush, is synthesized
+    """
+    print("\n=== Flush after dequeue ===")
+    opt = SimpleNamespace(fps=50, tts_prefetch=2, REF_FILE="zh-CN-YunxiaNeural")
+    tts = EdgeTTS(opt, Parent())
+    try:
+        submitted = []
+        executor = SimpleNamespace(submit=lambda fn, job: submitted.append(job.msg[0]))
+        get = tts.msgqueue.get
+
+        def get_then_flush(*args, **kwargs):
+            item = get(*args, **kwargs)
+            tts.flush_talk()
+            return item
+
+        monkeypatch.setattr(tts.msgqueue, "get", get_then_flush)
+        tts.put_msg_txt("a")
+        tts._BaseTTS__prefetch(executor, block=True)
+        assert submitted == []
+        assert len(tts._jobs) == 0
+        assert tts.state == ttsreal.State.PAUSE
+        print("✓ sentence dequeued before the flush was dropped")
+
+        monkeypatch.setattr(tts.msgqueue, "get", get)
+        tts.put_msg_txt("b")
+        tts._BaseTTS__prefetch(executor, block=True)
+        assert submitted == ["b"]
+        assert tts.state == ttsreal.State.RUNNING
+        print("✓ sentence queued after the flush was synthesized")
+    finally:
+        tts.close()
@@ -0,0 +1,152 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+'''
+Keep-alive http client of the tts backends.
+One requests.Session per tts server, shared by every session of the process, so a
+sentence reuses an open tcp/tls connection instead of paying the handshake before
+its first audio. Every request is timed: headers (connect+request+server until the
+response headers), first chunk and total, plus whether a new connection was opened.
+'''
+
+import time
+from threading import Lock
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from logger import logger
+
+POOL_MAXSIZE = 16 #concurrent requests per server, >= sessions*tts_prefetch
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 60
+
+_sessions = {} #scheme://host:port -> requests.Session
+_lock = Lock()
+
+
+def _origin(url):
+    parts = urlsplit(url)
+    return f'{parts.scheme}://{parts.netloc}'
+
+def get_session(url)->requests.Session:
+    origin = _origin(url)
+    with _lock:
+        session = _sessions.get(origin)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE, pool_block=False)
+            session.mount(origin, adapter)
+            _sessions[origin] = session
+        return session
+
+def _num_connections(session, url):
+    try:
+        return session.get_adapter(url).poolmanager.connection_from_url(url).num_connections
+    except Exception:
+        return 0
+
+
+class RequestStats:
+    '''accumulated timing of the tts requests of one session'''
+    def __init__(self):
+        self._lock = Lock()
+        self.requests = 0
+        self.errors = 0
+        self.new_connections = 0
+        self.headers_time = 0.0
+        self.first_chunk_time = 0.0
+        self.total_time = 0.0
+        self.last = {}
+
+    def add(self, timing):
+        with self._lock:
+            self.requests += 1
+            self.new_connections += timing['new_connection']
+            self.headers_time += timing['headers']
+            self.first_chunk_time += timing['first_chunk']
+            self.total_time += timing['total']
+            self.last = timing
+
+    def add_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def get_stats(self)->dict:
+        with self._lock:
+            n = max(self.requests,1)
+            return {'tts_requests':self.requests,'tts_errors':self.errors,
+                    'tts_new_connections':self.new_connections,
+                    'tts_headers_ms':round(self.headers_time/n*1000,1),
+                    'tts_first_chunk_ms':round(self.first_chunk_time/n*1000,1),
+                    'tts_total_ms':round(self.total_time/n*1000,1)}
+
+
+class TimedResponse:
+    '''streamed response whose iter_content records the timing when the body is consumed'''
+    def __init__(self, res, start, headers_time, new_connection, stats, name):
+        self.res = res
+        self.status_code = res.status_code
+        self._start = start
+        self._headers_time = headers_time
+        self._new_connection = new_connection
+        self._stats = stats
+        self._name = name
+
+    @property
+    def text(self):
+        return self.res.text
+
+    def json(self):
+        return self.res.json()
+
+    def close(self):
+        self.res.close()
+
+    def iter_content(self, chunk_size=None):
+        first_chunk = None
+        try:
+            for chunk in self.res.iter_content(chunk_size=chunk_size):
+                if first_chunk is None:
+                    first_chunk = time.perf_counter()-self._start
+                yield chunk
+        finally:
+            self.res.close() #back to the pool, also when the sentence was flushed
+            total = time.perf_counter()-self._start
+            timing = {'new_connection':int(self._new_connection),'headers':self._headers_time,
+                      'first_chunk':first_chunk if first_chunk is not None else total,'total':total}
+            if self._stats is not None:
+                self._stats.add(timing)
+            logger.info('%s headers:%.3fs first chunk:%.3fs total:%.3fs new connection:%d', self._name,
+                        timing['headers'], timing['first_chunk'], total, timing['new_connection'])
+
+
+def post(url, stats=None, name='tts', **kwargs)->TimedResponse:
+    '''streamed POST on the pooled session of the server of url'''
+    session = get_session(url)
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    connections = _num_connections(session, url)
+    start = time.perf_counter()
+    try:
+        res = session.post(url, stream=True, **kwargs)
+    except Exception:
+        if stats is not None:
+            stats.add_error()
+        raise
+    headers_time = time.perf_counter()-start
+    return TimedResponse(res, start, headers_time, _num_connections(session, url)>connections, stats, name)
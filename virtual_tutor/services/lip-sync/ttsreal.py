@@ -31,12 +31,15 @@ import uuid
 
 from typing import Iterator
 
-import requests
+import ttshttp
+from resampler import StreamResampler
 
 import queue
 from queue import Queue
 from io import BytesIO
-from threading import Thread, Event
+from threading import Thread, Event, Lock, local
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from enum import Enum
 
 from typing import TYPE_CHECKING
@@ -48,6 +51,13 @@ class State(Enum):
     RUNNING=0
     PAUSE=1
 
+class _TTSJob:
+    '''one sentence: synthesized by a prefetch worker into frames, played in order by process_tts'''
+    def __init__(self, msg):
+        self.msg = msg
+        self.frames = Queue() #(audio_chunk,eventpoint), None when synthesis is done
+        self.cancel = Event()
+
 class BaseTTS:
     def __init__(self, opt, parent:BaseReal):
         self.opt=opt
@@ -56,66 +66,176 @@ class BaseTTS:
         self.fps = opt.fps # 20 ms per frame
         self.sample_rate = 16000
         self.chunk = self.sample_rate // self.fps # 320 samples per chunk (20ms * 16000 / 1000)
-        self.input_stream = BytesIO()
 
         self.msgqueue = Queue()
         self.state = State.RUNNING
+        self.prefetch = max(1,opt.tts_prefetch) #sentences synthesized ahead of playback
+        self._jobs = deque() #in playback order
+        self._jobs_lock = Lock()
+        self._generation = 0 #bumped by flush_talk, queued sentences of older generations are dropped
+        self._local = local() #job of the current prefetch worker
+        self.http_stats = ttshttp.RequestStats()
 
     def flush_talk(self):
-        self.msgqueue.queue.clear()
-        self.state = State.PAUSE
+        with self._jobs_lock:
+            self._generation += 1
+            self.msgqueue.queue.clear()
+            self.state = State.PAUSE
+            for job in self._jobs:
+                job.cancel.set()
+            self._jobs.clear()
 
     def put_msg_txt(self,msg:str,eventpoint=None): 
         if len(msg)>0:
-            self.msgqueue.put((msg,eventpoint))
+            with self._jobs_lock:
+                self.msgqueue.put(((msg,eventpoint),self._generation))
+
+    def put_audio_frame(self,audio_chunk,eventpoint=None):
+        '''16khz 20ms pcm of the sentence being synthesized by this thread'''
+        job = getattr(self._local,'job',None)
+        if job is None:
+            self.parent.put_audio_frame(audio_chunk,eventpoint)
+        elif not job.cancel.is_set():
+            job.frames.put((audio_chunk,eventpoint))
+
+    def is_running(self)->bool:
+        '''false once the sentence being synthesized by this thread was flushed'''
+        job = getattr(self._local,'job',None)
+        if job is not None:
+            return not job.cancel.is_set()
+        return self.state==State.RUNNING
+
+    def running_check(self):
+        '''is_running bound to the sentence of the calling thread, for code that runs on another thread'''
+        job = getattr(self._local,'job',None)
+        if job is None:
+            return lambda: self.state==State.RUNNING
+        return lambda: not job.cancel.is_set() and self.state==State.RUNNING
+
+    def get_stats(self)->dict:
+        return self.http_stats.get_stats()
 
     def render(self,quit_event):
         process_thread = Thread(target=self.process_tts, args=(quit_event,))
         process_thread.start()
+
+    def close(self):
+        pass
+
+    def __synthesize(self,job):
+        self._local.job = job
+        try:
+            if not job.cancel.is_set():
+                self.txt_to_audio(job.msg)
+        except Exception:
+            logger.exception('tts')
+        finally:
+            self._local.job = None
+            job.frames.put(None)
+
+    def __prefetch(self,executor,block):
+        '''start synthesis of the next queued sentences, at most self.prefetch ahead'''
+        while len(self._jobs) < self.prefetch:
+            try:
+                msg,generation = self.msgqueue.get(block=block, timeout=1)
+            except queue.Empty:
+                return
+            block = False
+            job = _TTSJob(msg)
+            with self._jobs_lock:
+                if generation != self._generation: #flushed after it was queued, maybe while dequeued
+                    continue
+                self.state=State.RUNNING
+                self._jobs.append(job)
+            executor.submit(self.__synthesize,job)
     
-    def process_tts(self,quit_event):        
+    def process_tts(self,quit_event):
+        #合成与播放流水线: 当前句播放时,后面的句子已在合成
+        executor = ThreadPoolExecutor(max_workers=self.prefetch, thread_name_prefix='tts')
         while not quit_event.is_set():
+            self.__prefetch(executor,block=not self._jobs)
+            with self._jobs_lock:
+                job = self._jobs[0] if self._jobs else None
+            if job is None:
+                continue
             try:
-                msg = self.msgqueue.get(block=True, timeout=1)
-                self.state=State.RUNNING
+                item = job.frames.get(block=True, timeout=0.1)
             except queue.Empty:
                 continue
-            self.txt_to_audio(msg)
+            if item is None or job.cancel.is_set():
+                with self._jobs_lock:
+                    if self._jobs and self._jobs[0] is job:
+                        self._jobs.popleft()
+                continue
+            self.parent.put_audio_frame(*item)
+        self.flush_talk()
+        executor.shutdown(wait=False)
+        self.close()
         logger.info('ttsreal thread stop')
     
     def txt_to_audio(self,msg):
         pass
+
+    def stream_tts(self,audio_stream,msg,sample_rate):
+        '''int16 pcm chunks at sample_rate from the network -> 20ms frames at 16k'''
+        resampler = StreamResampler(self.sample_rate,self.chunk)
+        self.put_stream_frames((resampler.push_pcm16(chunk,sample_rate) for chunk in audio_stream if chunk),resampler,msg)
+
+    def put_stream_frames(self,frame_batches,resampler,msg):
+        text,textevent = msg
+        first = True
+        for frames in frame_batches:
+            for frame in frames:
+                eventpoint=None
+                if first:
+                    eventpoint={'status':'start','text':text,'msgevent':textevent}
+                    first = False
+                self.put_audio_frame(frame,eventpoint)
+        if self.is_running():
+            for frame in resampler.flush(): #tail of the sentence, zero padded
+                self.put_audio_frame(frame)
+        eventpoint={'status':'end','text':text,'msgevent':textevent}
+        self.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)
     
 
 ###########################################################################################
 class EdgeTTS(BaseTTS):
+    def __init__(self, opt, parent):
+        super().__init__(opt,parent)
+        #one event loop per session, shared by the sentences instead of a new loop per sentence
+        self.loop = asyncio.new_event_loop()
+        Thread(target=self.loop.run_forever, name='edgetts_loop', daemon=True).start()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
     def txt_to_audio(self,msg):
         voicename = self.opt.REF_FILE #"zh-CN-YunxiaNeural"
         text,textevent = msg
         t = time.time()
-        asyncio.new_event_loop().run_until_complete(self.__main(voicename,text))
+        input_stream = BytesIO() #per sentence, sentences are synthesized concurrently
+        running = self.running_check() #the loop thread has no job of its own
+        asyncio.run_coroutine_threadsafe(self.__main(voicename,text,input_stream,running),self.loop).result()
         logger.info(f'-------edge tts time:{time.time()-t:.4f}s')
-        if self.input_stream.getbuffer().nbytes<=0: #edgetts err
+        if input_stream.getbuffer().nbytes<=0: #edgetts err
             logger.error('edgetts err!!!!!')
             return
         
-        self.input_stream.seek(0)
-        stream = self.__create_bytes_stream(self.input_stream)
+        input_stream.seek(0)
+        stream = self.__create_bytes_stream(input_stream)
         streamlen = stream.shape[0]
         idx=0
-        while streamlen >= self.chunk and self.state==State.RUNNING:
+        while streamlen >= self.chunk and self.is_running():
             eventpoint=None
             streamlen -= self.chunk
             if idx==0:
                 eventpoint={'status':'start','text':text,'msgevent':textevent}
             elif streamlen<self.chunk:
                 eventpoint={'status':'end','text':text,'msgevent':textevent}
-            self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
+            self.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
             idx += self.chunk
         #if streamlen>0:  #skip last frame(not 20ms)
         #    self.queue.put(stream[idx:])
-        self.input_stream.seek(0)
-        self.input_stream.truncate() 
 
     def __create_bytes_stream(self,byte_stream):
         #byte_stream=BytesIO(buffer)
@@ -133,7 +253,7 @@ class EdgeTTS(BaseTTS):
 
         return stream
     
-    async def __main(self,voicename: str, text: str):
+    async def __main(self,voicename: str, text: str, input_stream: BytesIO, running):
         try:
             communicate = edge_tts.Communicate(text, voicename)
 
@@ -142,9 +262,11 @@ class EdgeTTS(BaseTTS):
             async for chunk in communicate.stream():
                 if first:
                     first = False
-                if chunk["type"] == "audio" and self.state==State.RUNNING:
+                if not running():
+                    break
+                if chunk["type"] == "audio":
                     #self.push_audio(chunk["data"])
-                    self.input_stream.write(chunk["data"])
+                    input_stream.write(chunk["data"])
                     #file.write(chunk["data"])
                 elif chunk["type"] == "WordBoundary":
                     pass
@@ -163,11 +285,11 @@ class FishTTS(BaseTTS):
                 "zh", #en args.language,
                 self.opt.TTS_SERVER, #"http://127.0.0.1:5000", #args.server_url,
             ),
-            msg
+            msg,
+            44100
         )
 
     def fish_speech(self, text, reffile, reftext,language, server_url) -> Iterator[bytes]:
-        start = time.perf_counter()
         req={
             'text':text,
             'reference_id':reffile,
@@ -176,57 +298,32 @@ class FishTTS(BaseTTS):
             'use_memory_cache':'on'
         }
         try:
-            res = requests.post(
+            res = ttshttp.post(
                 f"{server_url}/v1/tts",
+                stats=self.http_stats,
+                name='fish_speech',
                 json=req,
-                stream=True,
                 headers={
                     "content-type": "application/json",
                 },
             )
-            end = time.perf_counter()
-            logger.info(f"fish_speech Time to make POST: {end-start}s")
 
             if res.status_code != 200:
                 logger.error("Error:%s", res.text)
+                self.http_stats.add_error()
+                res.close()
                 return
-                
-            first = True
         
             for chunk in res.iter_content(chunk_size=17640): # 1764 44100*20ms*2
                 #print('chunk len:',len(chunk))
-                if first:
-                    end = time.perf_counter()
-                    logger.info(f"fish_speech Time to first chunk: {end-start}s")
-                    first = False
-                if chunk and self.state==State.RUNNING:
+                if not self.is_running():
+                    break #interrupted: the response is closed and the download aborted
+                if chunk:
                     yield chunk
             #print("gpt_sovits response.elapsed:", res.elapsed)
         except Exception as e:
             logger.exception('fishtts')
 
-    def stream_tts(self,audio_stream,msg):
-        text,textevent = msg
-        first = True
-        for chunk in audio_stream:
-            if chunk is not None and len(chunk)>0:          
-                stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
-                stream = resampy.resample(x=stream, sr_orig=44100, sr_new=self.sample_rate)
-                #byte_stream=BytesIO(buffer)
-                #stream = self.__create_bytes_stream(byte_stream)
-                streamlen = stream.shape[0]
-                idx=0
-                while streamlen >= self.chunk:
-                    eventpoint=None
-                    if first:
-                        eventpoint={'status':'start','text':text,'msgevent':textevent}
-                        first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
-                    streamlen -= self.chunk
-                    idx += self.chunk
-        eventpoint={'status':'end','text':text,'msgevent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
-
 ###########################################################################################
 class SovitsTTS(BaseTTS):
     def txt_to_audio(self,msg): 
@@ -243,7 +340,6 @@ class SovitsTTS(BaseTTS):
         )
 
     def gpt_sovits(self, text, reffile, reftext,language, server_url) -> Iterator[bytes]:
-        start = time.perf_counter()
         req={
             'text':text,
             'text_lang':language,
@@ -260,72 +356,59 @@ class SovitsTTS(BaseTTS):
         # #req["stream_chunk_size"] = stream_chunk_size  # you can reduce it to get faster response, but degrade quality
         # req["streaming_mode"] = True
         try:
-            res = requests.post(
+            res = ttshttp.post(
                 f"{server_url}/tts",
+                stats=self.http_stats,
+                name='gpt_sovits',
                 json=req,
-                stream=True,
             )
-            end = time.perf_counter()
-            logger.info(f"gpt_sovits Time to make POST: {end-start}s")
 
             if res.status_code != 200:
                 logger.error("Error:%s", res.text)
+                self.http_stats.add_error()
+                res.close()
                 return
-                
-            first = True
         
             for chunk in res.iter_content(chunk_size=None): #12800 1280 32K*20ms*2
-                logger.info('chunk len:%d',len(chunk))
-                if first:
-                    end = time.perf_counter()
-                    logger.info(f"gpt_sovits Time to first chunk: {end-start}s")
-                    first = False
-                if chunk and self.state==State.RUNNING:
+                logger.debug('chunk len:%d',len(chunk))
+                if not self.is_running():
+                    break #interrupted: the response is closed and the download aborted
+                if chunk:
                     yield chunk
             #print("gpt_sovits response.elapsed:", res.elapsed)
         except Exception as e:
             logger.exception('sovits')
 
-    def __create_bytes_stream(self,byte_stream):
+    def __decode_chunk(self,byte_stream):
         #byte_stream=BytesIO(buffer)
         stream, sample_rate = sf.read(byte_stream) # [T*sample_rate,] float64
-        logger.info(f'[INFO]tts audio stream {sample_rate}: {stream.shape}')
+        logger.debug(f'[INFO]tts audio stream {sample_rate}: {stream.shape}')
         stream = stream.astype(np.float32)
 
         if stream.ndim > 1:
             logger.info(f'[WARN] audio has {stream.shape[1]} channels, only use the first.')
             stream = stream[:, 0]
-    
-        if sample_rate != self.sample_rate and stream.shape[0]>0:
-            logger.info(f'[WARN] audio sample rate is {sample_rate}, resampling into {self.sample_rate}.')
-            stream = resampy.resample(x=stream, sr_orig=sample_rate, sr_new=self.sample_rate)
-
-        return stream
+        return stream,sample_rate
 
-    def stream_tts(self,audio_stream,msg):
-        text,textevent = msg
-        first = True
-        for chunk in audio_stream:
-            if chunk is not None and len(chunk)>0:          
-                #stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
-                #stream = resampy.resample(x=stream, sr_orig=32000, sr_new=self.sample_rate)
-                byte_stream=BytesIO(chunk)
-                stream = self.__create_bytes_stream(byte_stream)
-                streamlen = stream.shape[0]
-                idx=0
-                while streamlen >= self.chunk:
-                    eventpoint=None
-                    if first:
-                        eventpoint={'status':'start','text':text,'msgevent':textevent}
-                        first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
-                    streamlen -= self.chunk
-                    idx += self.chunk
-        eventpoint={'status':'end','text':text,'msgevent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)
+    def stream_tts(self,audio_stream,msg,sample_rate=None):
+        #every chunk is a complete ogg file, resampled by one resampler for the whole sentence
+        resampler = StreamResampler(self.sample_rate,self.chunk)
+        self.put_stream_frames((resampler.push(*self.__decode_chunk(BytesIO(chunk))) for chunk in audio_stream if chunk),resampler,msg)
 
 ###########################################################################################
 class CosyVoiceTTS(BaseTTS):
+    def __init__(self, opt, parent):
+        super().__init__(opt,parent)
+        self.ref_wav = None #(reffile,bytes,speaker_id) read once per session
+
+    def get_ref_wav(self,reffile):
+        if self.ref_wav is None or self.ref_wav[0]!=reffile:
+            with open(reffile, 'rb') as f:
+                data = f.read()
+            #the server caches the prompt features of a speaker under the sha256 of its wav
+            self.ref_wav = (reffile,data,hashlib.sha256(data).hexdigest())
+        return self.ref_wav[1:]
+
     def txt_to_audio(self,msg):
         text,textevent = msg 
         self.stream_tts(
@@ -336,60 +419,38 @@ class CosyVoiceTTS(BaseTTS):
                 "zh", #en args.language,
                 self.opt.TTS_SERVER, #"http://127.0.0.1:5000", #args.server_url,
             ),
-            msg
+            msg,
+            24000
         )
 
     def cosy_voice(self, text, reffile, reftext,language, server_url) -> Iterator[bytes]:
-        start = time.perf_counter()
         payload = {
             'tts_text': text,
             'prompt_text': reftext
         }
         try:
-            files = [('prompt_wav', ('prompt_wav', open(reffile, 'rb'), 'application/octet-stream'))]
-            res = requests.request("POST", f"{server_url}/inference_zero_shot", data=payload, files=files, stream=True)
-            
-            end = time.perf_counter()
-            logger.info(f"cosy_voice Time to make POST: {end-start}s")
+            ref_wav,speaker_id = self.get_ref_wav(reffile)
+            #only the speaker_id, the wav is uploaded when the server does not know the speaker (yet)
+            res = ttshttp.post(f"{server_url}/inference_zero_shot", stats=self.http_stats, name='cosy_voice', data={**payload,'speaker_id':speaker_id})
+            if res.status_code in (404,422):
+                res.close()
+                files = [('prompt_wav', ('prompt_wav', ref_wav, 'application/octet-stream'))]
+                res = ttshttp.post(f"{server_url}/inference_zero_shot", stats=self.http_stats, name='cosy_voice', data={**payload,'speaker_id':speaker_id}, files=files)
 
             if res.status_code != 200:
                 logger.error("Error:%s", res.text)
+                self.http_stats.add_error()
+                res.close()
                 return
-                
-            first = True
         
             for chunk in res.iter_content(chunk_size=9600): # 960 24K*20ms*2
-                if first:
-                    end = time.perf_counter()
-                    logger.info(f"cosy_voice Time to first chunk: {end-start}s")
-                    first = False
-                if chunk and self.state==State.RUNNING:
+                if not self.is_running():
+                    break #interrupted: the response is closed and the download aborted
+                if chunk:
                     yield chunk
         except Exception as e:
             logger.exception('cosyvoice')
 
-    def stream_tts(self,audio_stream,msg):
-        text,textevent = msg
-        first = True
-        for chunk in audio_stream:
-            if chunk is not None and len(chunk)>0:          
-                stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
-                stream = resampy.resample(x=stream, sr_orig=24000, sr_new=self.sample_rate)
-                #byte_stream=BytesIO(buffer)
-                #stream = self.__create_bytes_stream(byte_stream)
-                streamlen = stream.shape[0]
-                idx=0
-                while streamlen >= self.chunk:
-                    eventpoint=None
-                    if first:
-                        eventpoint={'status':'start','text':text,'msgevent':textevent}
-                        first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
-                    streamlen -= self.chunk
-                    idx += self.chunk
-        eventpoint={'status':'end','text':text,'msgevent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
-
 ###########################################################################################
 _PROTOCOL = "https://"
 _HOST = "tts.cloud.tencent.com"
@@ -449,11 +510,11 @@ class TencentTTS(BaseTTS):
                 "zh", #en args.language,
                 self.opt.TTS_SERVER, #"http://127.0.0.1:5000", #args.server_url,
             ),
-            msg
+            msg,
+            self.sample_rate
         )
 
     def tencent_voice(self, text, reffile, reftext,language, server_url) -> Iterator[bytes]:
-        start = time.perf_counter()
         session_id = str(uuid.uuid1())
         params = self.__gen_params(session_id, text)
         signature = self.__gen_signature(params)
@@ -463,11 +524,8 @@ class TencentTTS(BaseTTS):
         }
         url = _PROTOCOL + _HOST + _PATH
         try:
-            res = requests.post(url, headers=headers,
-                          data=json.dumps(params), stream=True)
-            
-            end = time.perf_counter()
-            logger.info(f"tencent Time to make POST: {end-start}s")
+            res = ttshttp.post(url, stats=self.http_stats, name='tencent', headers=headers,
+                          data=json.dumps(params))
                 
             first = True
         
@@ -479,41 +537,17 @@ class TencentTTS(BaseTTS):
                         #response["Code"] = rsp["Response"]["Error"]["Code"]
                         #response["Message"] = rsp["Response"]["Error"]["Message"]
                         logger.error("tencent tts:%s",rsp["Response"]["Error"]["Message"])
+                        self.http_stats.add_error()
                         return
                     except:
-                        end = time.perf_counter()
-                        logger.info(f"tencent Time to first chunk: {end-start}s")
                         first = False                    
-                if chunk and self.state==State.RUNNING:
+                if not self.is_running():
+                    break #interrupted: the response is closed and the download aborted
+                if chunk:
                     yield chunk
         except Exception as e:
             logger.exception('tencent')
 
-    def stream_tts(self,audio_stream,msg):
-        text,textevent = msg
-        first = True
-        last_stream = np.array([],dtype=np.float32)
-        for chunk in audio_stream:
-            if chunk is not None and len(chunk)>0:          
-                stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
-                stream = np.concatenate((last_stream,stream))
-                #stream = resampy.resample(x=stream, sr_orig=24000, sr_new=self.sample_rate)
-                #byte_stream=BytesIO(buffer)
-                #stream = self.__create_bytes_stream(byte_stream)
-                streamlen = stream.shape[0]
-                idx=0
-                while streamlen >= self.chunk:
-                    eventpoint=None
-                    if first:
-                        eventpoint={'status':'start','text':text,'msgevent':textevent}
-                        first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
-                    streamlen -= self.chunk
-                    idx += self.chunk
-                last_stream = stream[idx:] #get the remain stream
-        eventpoint={'status':'end','text':text,'msgevent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
-
 ###########################################################################################
 
 class XTTS(BaseTTS):
@@ -531,62 +565,40 @@ class XTTS(BaseTTS):
                 self.opt.TTS_SERVER, #"http://localhost:9000", #args.server_url,
                 "20" #args.stream_chunk_size
             ),
-            msg
+            msg,
+            24000
         )
 
     def get_speaker(self,ref_audio,server_url):
-        files = {"wav_file": ("reference.wav", open(ref_audio, "rb"))}
-        response = requests.post(f"{server_url}/clone_speaker", files=files)
+        with open(ref_audio, "rb") as f:
+            files = {"wav_file": ("reference.wav", f.read())}
+        response = ttshttp.get_session(server_url).post(f"{server_url}/clone_speaker", files=files,
+                                                        timeout=(ttshttp.CONNECT_TIMEOUT,ttshttp.READ_TIMEOUT))
         return response.json()
 
     def xtts(self,text, speaker, language, server_url, stream_chunk_size) -> Iterator[bytes]:
-        start = time.perf_counter()
+        speaker = dict(speaker) #shared by the concurrently synthesized sentences
         speaker["text"] = text
         speaker["language"] = language
         speaker["stream_chunk_size"] = stream_chunk_size  # you can reduce it to get faster response, but degrade quality
         try:
-            res = requests.post(
+            res = ttshttp.post(
                 f"{server_url}/tts_stream",
+                stats=self.http_stats,
+                name='xtts',
                 json=speaker,
-                stream=True,
             )
-            end = time.perf_counter()
-            logger.info(f"xtts Time to make POST: {end-start}s")
 
             if res.status_code != 200:
-                print("Error:", res.text)
+                logger.error("Error:%s", res.text)
+                self.http_stats.add_error()
+                res.close()
                 return
-
-            first = True
         
             for chunk in res.iter_content(chunk_size=9600): #24K*20ms*2
-                if first:
-                    end = time.perf_counter()
-                    logger.info(f"xtts Time to first chunk: {end-start}s")
-                    first = False
+                if not self.is_running():
+                    break #interrupted: the response is closed and the download aborted
                 if chunk:
                     yield chunk
         except Exception as e:
-            print(e)
-    
-    def stream_tts(self,audio_stream,msg):
-        text,textevent = msg
-        first = True
-        for chunk in audio_stream:
-            if chunk is not None and len(chunk)>0:          
-                stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
-                stream = resampy.resample(x=stream, sr_orig=24000, sr_new=self.sample_rate)
-                #byte_stream=BytesIO(buffer)
-                #stream = self.__create_bytes_stream(byte_stream)
-                streamlen = stream.shape[0]
-                idx=0
-                while streamlen >= self.chunk:
-                    eventpoint=None
-                    if first:
-                        eventpoint={'status':'start','text':text,'msgevent':textevent}
-                        first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
-                    streamlen -= self.chunk
-                    idx += self.chunk
-        eventpoint={'status':'end','text':text,'msgevent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)  
\ No newline at end of file
+            logger.exception('xtts')
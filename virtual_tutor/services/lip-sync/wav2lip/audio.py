@@ -50,6 +50,80 @@ def melspectrogram(wav):
         return _normalize(S)
     return S
 
+class MelStream:
+    """
+    Incremental melspectrogram() of a live 16k stream.
+    Only the stft frames completed by newly pushed samples are computed; the hann window,
+    mel basis, pre-emphasis state and mel frames are kept between calls. Frame g is centered
+    on sample g*hop_size of the stream, as librosa.stft(center=True) frames a whole clip.
+    """
+    def __init__(self, capacity=1024):
+        self.hop = get_hop_size()
+        self.half = hp.n_fft // 2
+        window = signal.get_window('hann', hp.win_size, fftbins=True)
+        lpad = (hp.n_fft - hp.win_size) // 2
+        self.window = np.pad(window, (lpad, hp.n_fft - hp.win_size - lpad)).astype(np.float32)
+        global _mel_basis
+        if _mel_basis is None:
+            _mel_basis = _build_mel_basis()
+        self.mel_basis = _mel_basis.astype(np.float32)
+        self.min_level = np.float32(np.exp(hp.min_level_db / 20 * np.log(10)))
+        self.last_sample = 0.
+
+        self.audio = np.zeros(self.half, dtype=np.float32)  #pre-emphasized samples from self.audio_start on
+        self.audio_start = -self.half
+        self.total = 0
+        self.mel = np.zeros((hp.num_mels, capacity), dtype=np.float32)  #normalized mel frames from self.mel_start on
+        self.mel_start = 0
+        self.count = 0
+
+    def push(self, wav):
+        wav = wav.astype(np.float32)
+        if hp.preemphasize:
+            emph = np.empty_like(wav)
+            emph[0] = wav[0] - hp.preemphasis * self.last_sample
+            emph[1:] = wav[1:] - hp.preemphasis * wav[:-1]
+            self.last_sample = wav[-1]
+            wav = emph
+        self.audio = np.concatenate([self.audio, wav])
+        self.total += len(wav)
+
+        mel_have = self.mel_start + self.count
+        mel_end = (self.total - self.half) // self.hop + 1
+        if mel_end <= mel_have:
+            return
+        begin = mel_have * self.hop - self.half - self.audio_start
+        frames = np.lib.stride_tricks.sliding_window_view(self.audio[begin:], hp.n_fft)[::self.hop][:mel_end - mel_have]
+        S = np.abs(np.fft.rfft(frames * self.window, axis=1))
+        S = _amp_to_db(np.dot(self.mel_basis, S.T)) - hp.ref_level_db
+        if hp.signal_normalization:
+            S = _normalize(S)
+        n = S.shape[1]
+        if self.count + n > self.mel.shape[1]:
+            self.mel = np.concatenate([self.mel, np.zeros_like(self.mel)], axis=1)
+        self.mel[:, self.count:self.count + n] = S
+        self.count += n
+
+        keep = mel_end * self.hop - self.half  #first sample the next frame needs
+        self.audio = self.audio[keep - self.audio_start:]
+        self.audio_start = keep
+
+    def get_chunks(self, starts, size, out):
+        """
+        copy the mel windows [start, start+size) of every start into out, shape (len(starts), num_mels, size)
+        windows past the computed frames are clamped to the last full one
+        """
+        view = np.lib.stride_tricks.sliding_window_view(self.mel[:, :self.count], size, axis=1)
+        idx = np.minimum(np.asarray(starts) - self.mel_start, view.shape[1] - 1)
+        np.take(view, idx, axis=1, out=out.transpose(1, 0, 2), mode='clip')
+        # later windows start after this one
+        drop = max(0, min(int(idx[0]), self.count - size))
+        if drop > 0:
+            self.mel[:, :self.count - drop] = self.mel[:, drop:self.count]
+            self.mel_start += drop
+            self.count -= drop
+        return out
+
 def _lws_processor():
     import lws
     return lws.lws(hp.n_fft, get_hop_size(), fftsize=hp.win_size, mode="speech")
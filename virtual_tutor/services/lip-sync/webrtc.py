@@ -33,6 +33,9 @@ VIDEO_PTIME = 0.040 #1 / 25  # 30fps
 VIDEO_TIME_BASE = fractions.Fraction(1, VIDEO_CLOCK_RATE)
 SAMPLE_RATE = 16000
 AUDIO_TIME_BASE = fractions.Fraction(1, SAMPLE_RATE)
+#frames waiting to be sent, process_frames blocks when the queue is full
+MAX_VIDEO_QUEUE = 25 #1s
+MAX_AUDIO_QUEUE = 50
 
 #from aiortc.contrib.media import MediaPlayer, MediaRelay
 #from aiortc.rtcrtpsender import RTCRtpSender
@@ -44,6 +47,59 @@ logging.basicConfig()
 logger = logging.getLogger(__name__)
 from logger import logger as mylogger
 
+def set_bitrate_limits(min_bitrate=0,max_bitrate=0):
+    '''
+    Process wide bounds of the aiortc video encoders (bps, 0 keeps the default).
+    The congestion controller of every sender is clamped to them, a flat avatar
+    rarely needs the default 3Mbps ceiling.
+    '''
+    from aiortc.codecs import h264, vpx
+    for codec in (h264,vpx):
+        if min_bitrate>0:
+            codec.MIN_BITRATE = min_bitrate
+        if max_bitrate>0:
+            codec.MAX_BITRATE = max(max_bitrate,codec.MIN_BITRATE)
+        if codec.DEFAULT_BITRATE > codec.MAX_BITRATE or codec.DEFAULT_BITRATE < codec.MIN_BITRATE:
+            codec.DEFAULT_BITRATE = min(max(codec.DEFAULT_BITRATE,codec.MIN_BITRATE),codec.MAX_BITRATE)
+
+def _pc_closed(pc):
+    return pc is not None and pc.connectionState in ('closed','failed')
+
+async def apply_encoder_settings(sender,bitrate=0,keyframe_interval=0,pc=None,timeout=60):
+    '''
+    Per session encoder settings of a video sender: start bitrate (bps) and a keyframe
+    every keyframe_interval seconds (0: only when the receiver asks with a PLI).
+    aiortc creates the encoder with the first frame and has no public api for either,
+    so this uses the private state of RTCRtpSender and does nothing if it is missing.
+    Gives up when pc closes or no frame was encoded within timeout seconds
+    (negotiation or ice failed, the rtp task is never started).
+    '''
+    if bitrate<=0 and keyframe_interval<=0:
+        return
+    encoder = None
+    deadline = time.monotonic()+timeout
+    while encoder is None:
+        task = getattr(sender,'_RTCRtpSender__rtp_task',None)
+        if (task is not None and task.done()) or _pc_closed(pc):
+            return
+        encoder = getattr(sender,'_RTCRtpSender__encoder',None)
+        if encoder is None:
+            if time.monotonic()>deadline:
+                mylogger.warning('video encoder not started after %ds, encoder settings not applied',timeout)
+                return
+            await asyncio.sleep(0.1)
+    if bitrate>0 and hasattr(encoder,'target_bitrate'):
+        encoder.target_bitrate = bitrate #clamped to MIN_BITRATE..MAX_BITRATE by the encoder
+        mylogger.info('video encoder %s target bitrate %d',type(encoder).__name__,encoder.target_bitrate)
+    if keyframe_interval<=0 or not hasattr(sender,'_RTCRtpSender__force_keyframe'):
+        return
+    while True:
+        await asyncio.sleep(keyframe_interval)
+        task = getattr(sender,'_RTCRtpSender__rtp_task',None)
+        if task is None or task.done() or _pc_closed(pc):
+            return
+        sender._RTCRtpSender__force_keyframe = True
+
 
 class PlayerStreamTrack(MediaStreamTrack):
     """
@@ -54,7 +110,7 @@ class PlayerStreamTrack(MediaStreamTrack):
         super().__init__()  # don't forget this!
         self.kind = kind
         self._player = player
-        self._queue = asyncio.Queue()
+        self._queue = asyncio.Queue(maxsize=MAX_VIDEO_QUEUE if kind=='video' else MAX_AUDIO_QUEUE)
         self.timelist = [] #记录最近包的时间戳
         self.current_frame_count = 0
         if self.kind == 'video':
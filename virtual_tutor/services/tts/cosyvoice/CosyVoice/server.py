@@ -1,10 +1,17 @@
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from typing import Optional
+from collections import OrderedDict
+from threading import Lock
+import hashlib
+import time
 import io
 import uvicorn
 import torchaudio
 import soundfile as sf
 import numpy as np
+import torch
 import os
 import sys
 import argparse
@@ -41,26 +48,83 @@ print(f">>> Model loaded from {model_dir}!")
 
 app = FastAPI()
 
+# ========== Speaker prompt cache =========
+# speaker_id (sha256 of the reference wav) -> (16k prompt speech, extracted prompt features)
+SPEAKER_CACHE_SIZE = 32
+SPEAKERS = OrderedDict()
+RESAMPLERS = {}  # orig sample rate -> Resample transform
+# streamed responses advance the model from the threadpool, one model step at a time
+MODEL_LOCK = Lock()
+SPEAKERS_LOCK = Lock()  # SPEAKERS is used from the threadpool
 
-def generate_tts(tts_text: str, ref_wav_bytes: bytes, prompt_text: str) -> bytes:
-    ref_audio_buf = io.BytesIO(ref_wav_bytes)
-    prompt_speech, sr = torchaudio.load(ref_audio_buf)
+
+def speaker_id_of(ref_wav_bytes: bytes) -> str:
+    return hashlib.sha256(ref_wav_bytes).hexdigest()
+
+
+def register_speaker(ref_wav_bytes: bytes):
+    """
+    Decode, resample and extract the prompt features of a reference wav once.
+    The same wav always gets the same speaker_id, registering it again is a cache hit.
+    Blocking, called from the threadpool. Returns (speaker_id, (prompt speech, features)).
+    """
+    speaker_id = speaker_id_of(ref_wav_bytes)
+    speaker = get_speaker(speaker_id)
+    if speaker is not None:
+        return speaker_id, speaker
+
+    prompt_speech, sr = torchaudio.load(io.BytesIO(ref_wav_bytes))
     print(f">>> Reference audio sample rate: {sr}")
     # 强制重采样为 16000Hz
-    resampler = torchaudio.transforms.Resample(orig_freq=sr, new_freq=16000)
-    prompt_speech = resampler(prompt_speech)
+    if sr != 16000:
+        if sr not in RESAMPLERS:
+            RESAMPLERS[sr] = torchaudio.transforms.Resample(orig_freq=sr, new_freq=16000)
+        prompt_speech = RESAMPLERS[sr](prompt_speech)
+
+    # speech tokens, speaker embedding and prompt feats, as inference_instruct2 extracts them
+    with MODEL_LOCK:
+        model.add_zero_shot_spk('<|endofprompt|>', prompt_speech, speaker_id)
+        features = model.frontend.spk2info.pop(speaker_id)
+    speaker = (prompt_speech, features)
+    with SPEAKERS_LOCK:
+        SPEAKERS[speaker_id] = speaker
+        while len(SPEAKERS) > SPEAKER_CACHE_SIZE:
+            SPEAKERS.popitem(last=False)
+    print(f">>> Registered speaker {speaker_id[:12]}, cached speakers: {len(SPEAKERS)}")
+    return speaker_id, speaker
+
+
+def get_speaker(speaker_id: str):
+    """(prompt speech, features) of a registered speaker, None if unknown or evicted"""
+    with SPEAKERS_LOCK:
+        speaker = SPEAKERS.get(speaker_id)
+        if speaker is not None:
+            SPEAKERS.move_to_end(speaker_id)
+    return speaker
+
+
+def generate_tts(tts_text: str, speaker_id: str, speaker, prompt_text: str) -> bytes:
+    """speaker: the (prompt speech, features) resolve_speaker returned, it may be evicted since"""
+    prompt_speech, features = speaker
 
     # 生成 TTS 音频
     print(">>> Generating TTS output...")
     print(f">>> TTS text: {tts_text}")
-    chunks = list(
-        model.inference_instruct2(
-            tts_text,
-            "",
-            prompt_speech,
-            stream=False
-        )
-    )
+    with MODEL_LOCK:
+        # the frontend consumes the entry it is given, hand it a copy of the cached features
+        model.frontend.spk2info[speaker_id] = dict(features)
+        try:
+            chunks = list(
+                model.inference_instruct2(
+                    tts_text,
+                    "",
+                    prompt_speech,
+                    zero_shot_spk_id=speaker_id,
+                    stream=False
+                )
+            )
+        finally:
+            model.frontend.spk2info.pop(speaker_id, None)
     waveform = chunks[0]["tts_speech"]
 
     # 将 waveform 写入内存中的 WAV 二进制流
@@ -71,23 +135,100 @@ def generate_tts(tts_text: str, ref_wav_bytes: bytes, prompt_text: str) -> bytes
     return out_wav_bytes
 
 
-@app.post("/generate")
-async def tts_zero_shot(
-        tts_text: str = Form(...),
-        prompt_text: str = Form(...),
-        prompt_wav: UploadFile = File(...)
-):
-    # 1. 读取上传的参考音频
+def stream_tts(tts_text: str, speaker_id: str, speaker):
+    """
+    Raw 24k mono int16 pcm, yielded chunk by chunk as the model produces it (stream=True).
+    The model lock is only held while the model computes the next chunk, not while the
+    chunk is sent, so concurrent streams interleave.
+    """
+    prompt_speech, features = speaker
+    start = time.time()
+    speech_iter = model.inference_instruct2(
+        tts_text,
+        "",
+        prompt_speech,
+        zero_shot_spk_id=speaker_id,
+        stream=True
+    )
+    first = True
+    samples = 0
+    try:
+        while True:
+            with MODEL_LOCK:
+                if first:
+                    # the frontend runs on the first step and consumes the entry it is given
+                    model.frontend.spk2info[speaker_id] = dict(features)
+                try:
+                    chunk = next(speech_iter, None)
+                finally:
+                    if first:
+                        model.frontend.spk2info.pop(speaker_id, None)
+                        first = False
+            if chunk is None:
+                break
+            speech = chunk["tts_speech"].squeeze(0)
+            if samples == 0:
+                print(f">>> Time to first audio: {time.time() - start:.3f}s")
+            samples += speech.shape[0]
+            yield (speech.clamp(-1, 1) * 32767).to(torch.int16).cpu().numpy().tobytes()
+    except Exception as e:
+        print(f">>> TTS stream failed: {e}")
+    finally:
+        speech_iter.close()
+        if samples:
+            print(f">>> RTF: {(time.time() - start) / (samples / model.sample_rate):.4f} (Real-Time Factor)")
+
+
+async def resolve_speaker(speaker_id: Optional[str], prompt_wav: Optional[UploadFile]):
+    """
+    (speaker_id, speaker) of the request: a registered id, or the uploaded wav registered
+    on the fly in the threadpool. The request keeps the speaker even if the cache evicts it.
+    """
+    speaker = get_speaker(speaker_id) if speaker_id else None
+    if speaker is not None:
+        return speaker_id, speaker
+    if prompt_wav is None:
+        if speaker_id:
+            # evicted or registered on a previous run of the server, the client uploads the wav again
+            raise HTTPException(status_code=404, detail=f"Unknown speaker_id '{speaker_id}'")
+        raise HTTPException(status_code=400, detail="prompt_wav or speaker_id is required")
     try:
         ref_wav_bytes = await prompt_wav.read()
+        return await run_in_threadpool(register_speaker, ref_wav_bytes)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Load wav failed : {e}")
 
-    # 2. 调用你的 TTS 生成函数
+
+@app.post("/register_speaker")
+async def post_register_speaker(
+        prompt_wav: UploadFile = File(...)
+):
+    """
+    Upload a reference wav once, synthesis requests then only send its speaker_id.
+    Returns:
+        {
+            "speaker_id": str,
+            "cached_speakers": int
+        }
+    """
+    speaker_id, _ = await resolve_speaker(None, prompt_wav)
+    return {"speaker_id": speaker_id, "cached_speakers": len(SPEAKERS)}
+
+
+@app.post("/generate")
+async def tts_zero_shot(
+        tts_text: str = Form(...),
+        prompt_text: str = Form(""),
+        prompt_wav: Optional[UploadFile] = File(None),
+        speaker_id: Optional[str] = Form(None)
+):
+    # 1. 参考音频: 已注册的 speaker_id, 或上传的音频 (注册并缓存)
+    speaker_id, speaker = await resolve_speaker(speaker_id, prompt_wav)
+
+    # 2. 调用你的 TTS 生成函数 (threadpool, the event loop keeps serving the streams)
     try:
-        import time
         start = time.time()
-        out_wav: bytes = generate_tts(tts_text, ref_wav_bytes, prompt_text)
+        out_wav: bytes = await run_in_threadpool(generate_tts, tts_text, speaker_id, speaker, prompt_text)
         end = time.time()
 
         info_out = sf.info(io.BytesIO(out_wav))
@@ -99,12 +240,6 @@ async def tts_zero_shot(
         rtf = (end - start) / duration_out
         print(f">>> RTF: {rtf:.4f} (Real-Time Factor)")
 
-        # save output in temp file
-        with open("temp_out.wav", "wb") as f:
-            f.write(out_wav)
-        print(f">>> Output saved to temp_out.wav")
-
-        import torch
         torch.cuda.empty_cache()
     except Exception as e:
         # 内部运算失败
@@ -119,14 +254,19 @@ def health():
     return {"status": "running"}
 
 
-# Alias for /generate to support /inference_zero_shot endpoint
-@app.get("/inference_zero_shot")
-async def tts_zero_shot_get(
+# Streaming synthesis: chunked 24k int16 pcm, sent as soon as the model produces it
+@app.api_route("/inference_zero_shot", methods=["GET", "POST"])
+@app.post("/inference_stream")
+async def tts_zero_shot_stream(
         tts_text: str = Form(...),
-        prompt_text: str = Form(...),
-        prompt_wav: UploadFile = File(...)
+        prompt_text: str = Form(""),
+        prompt_wav: Optional[UploadFile] = File(None),
+        speaker_id: Optional[str] = Form(None)
 ):
-    return await tts_zero_shot(tts_text, prompt_text, prompt_wav)
+    speaker_id, speaker = await resolve_speaker(speaker_id, prompt_wav)
+    return StreamingResponse(stream_tts(tts_text, speaker_id, speaker),
+                             media_type="application/octet-stream",
+                             headers={"X-Sample-Rate": str(model.sample_rate)})
 
 
 if __name__ == '__main__':
@@ -134,8 +274,10 @@ if __name__ == '__main__':
     parser.add_argument('--model_name', required=True)
     parser.add_argument('--port', type=int, default=5033)
     parser.add_argument('--use_gpu', type=bool, default=True)
+    parser.add_argument('--speaker_cache', type=int, default=SPEAKER_CACHE_SIZE, help="reference speakers kept with their extracted prompt features")
     # 实际上 model_name & use_gpu 参数在 CosyVoice2 中未使用（必须用GPU运算），
     # 但保留以兼容原有接口
     args = parser.parse_args()
+    SPEAKER_CACHE_SIZE = args.speaker_cache
 
     uvicorn.run(app, host='0.0.0.0', port=args.port)
\ No newline at end of file
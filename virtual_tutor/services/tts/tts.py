@@ -9,6 +9,7 @@ import json
 import time
 import os
 import numpy as np
+import hashlib
 import io
 import soundfile as sf  # pip install soundfile
 from fastapi import Response, HTTPException
@@ -46,6 +47,9 @@ EDGE_TIMVRES_MAP = {
     "ChineseFemaleB": "zh-CN-XiaoyiNeural",
 }
 
+# tts servers with a speaker prompt cache (/register_speaker, speaker_id on /generate)
+SPEAKER_CACHE_SERVERS = {"cosyvoice"}
+
 TACO_TIMVRES_MAP = {
     "MaleA": "40",
     "MaleB": "45",
@@ -263,12 +267,38 @@ async def start_tts_server(
         raise HTTPException(status_code=500, detail="Failed to start TTS server.")
 
 
+# register a reference voice on the TTS server
+@app.post("/tts/register_speaker")
+async def register_speaker(
+        prompt_wav: UploadFile = File(...)
+):
+    """
+    Upload a reference wav once, /tts/response then only needs its speaker_id.
+    Args:
+        prompt_wav (UploadFile): The reference audio of the cloned voice.
+    Returns:
+        {
+            "speaker_id": str,
+            "cached_speakers": int
+        }
+    """
+    if CURENT_TTS_SERVER not in SPEAKER_CACHE_SERVERS:
+        raise HTTPException(status_code=400, detail=f"TTS server '{CURENT_TTS_SERVER}' does not support speaker registration.")
+    files = {"prompt_wav": (prompt_wav.filename, await prompt_wav.read(), prompt_wav.content_type)}
+    async with httpx.AsyncClient() as client:
+        response = await client.post(f"http://localhost:{TTS_SERVER_PORT}/register_speaker", files=files, timeout=30.0)
+    if response.status_code != 200:
+        raise HTTPException(status_code=500, detail="Failed to register speaker on TTS server")
+    return response.json()
+
+
 # generate TTS response
 @app.post("/tts/response")
 async def get_tts_response(
         tts_text: str = Form(...),
         prompt_text: Optional[str] = Form(None),
-        prompt_wav: Optional[UploadFile] = File(None)
+        prompt_wav: Optional[UploadFile] = File(None),
+        speaker_id: Optional[str] = Form(None)
 ):
     """
     if a TTS server running, send a request to the TTS server to generate a response wav.
@@ -276,6 +306,7 @@ async def get_tts_response(
         tts_text (str): The text to be converted to speech.
         prompt_text (str): The text prompt for the TTS model.
         prompt_wav (UploadFile): An optional audio file to use as a prompt.
+        speaker_id (str): An optional voice registered with /tts/register_speaker, instead of prompt_wav.
     Returns:
         Response: The generated audio file in WAV format.
     """
@@ -300,12 +331,26 @@ async def get_tts_response(
         "prompt_text": (None, prompt_text or "")
     }
 
+    prompt_file = None
     if prompt_wav:
-        files["prompt_wav"] = (prompt_wav.filename, await prompt_wav.read(), prompt_wav.content_type)
+        prompt_file = (prompt_wav.filename, await prompt_wav.read(), prompt_wav.content_type)
+
+    use_speaker_id = CURENT_TTS_SERVER in SPEAKER_CACHE_SERVERS
+    if use_speaker_id and prompt_file:
+        # the server keys its speaker cache by the sha256 of the wav, send only the id
+        speaker_id = hashlib.sha256(prompt_file[1]).hexdigest()
+    if use_speaker_id and speaker_id:
+        files["speaker_id"] = (None, speaker_id)
+    elif prompt_file:
+        files["prompt_wav"] = prompt_file
 
     async with httpx.AsyncClient() as client:
         # TODO: change to actual api
         response = await client.post(f"http://localhost:{TTS_SERVER_PORT}/generate", files=files, timeout=30.0)
+        if response.status_code == 404 and prompt_file and "prompt_wav" not in files:
+            # not cached on the server (yet): upload the wav, the server registers it
+            files["prompt_wav"] = prompt_file
+            response = await client.post(f"http://localhost:{TTS_SERVER_PORT}/generate", files=files, timeout=30.0)
 
     if response.status_code != 200:
         raise HTTPException(status_code=500, detail="Failed to get response from TTS server")